@@ -1,4 +1,4 @@
-from flask import Flask, send_from_directory
+from flask import Flask, send_from_directory, request
 import logging
 from flask_sqlalchemy import SQLAlchemy  # ✅ This import is required
 from flask_migrate import Migrate
@@ -32,14 +32,25 @@ def create_app():
     from .routes import api
     app.register_blueprint(api, url_prefix='/api')
 
+    # Background delivery of receipts queued with submit_receipt?async=true
+    from utils.fiscalization_outbox import outbox_dispatcher
+    from .routes import deliver_outbox_receipt
+    outbox_dispatcher.init_app(app, deliver_outbox_receipt)
+
+    # Register maintenance CLI commands (flask fiscal-counters ..., flask offline upload, flask fleet ...)
+    from .commands import register_commands
+    register_commands(app)
+
+    # HTML pages and templates are compiled/read once; hot-reloaded only in debug mode
+    from utils.template_registry import template_registry
+    template_registry.init_app(app)
+
     # Add root route to serve index.html
     @app.route('/')
     def index():
         """Serve the main index page"""
         try:
-            with open('static/index.html', 'r', encoding='utf-8') as f:
-                html_content = f.read()
-            return html_content, 200, {'Content-Type': 'text/html'}
+            return template_registry.page_response('index.html', request)
         except FileNotFoundError:
             return {"error": "Index file not found"}, 404
         except Exception as e:
@@ -50,9 +61,7 @@ def create_app():
     def invoices():
         """Serve the invoices page"""
         try:
-            with open('static/invoices.html', 'r', encoding='utf-8') as f:
-                html_content = f.read()
-            return html_content, 200, {'Content-Type': 'text/html'}
+            return template_registry.page_response('invoices.html', request)
         except FileNotFoundError:
             return {"error": "Invoices file not found"}, 404
         except Exception as e:
@@ -72,6 +81,11 @@ def create_app():
 
     with app.app_context():
         db.create_all()  # create tables here
+
+        # Bootstrap per-device global number counters used by the allocator
+        from utils.invoice_utils import initialize_device_global_numbers
+        if not initialize_device_global_numbers():
+            app.logger.warning("Failed to initialize device global numbers")
    
    
     return app
@@ -0,0 +1,137 @@
+import click
+from flask.cli import AppGroup
+
+fiscal_counters_cli = AppGroup('fiscal-counters', help='Maintain the running fiscal day counters.')
+offline_cli = AppGroup('offline', help='Upload receipts fiscalized in offline mode.')
+fleet_cli = AppGroup('fleet', help='Open or close fiscal days across all devices.')
+
+
+def _fiscal_days(device_id: str = None, fiscal_day_no: int = None) -> list:
+    """List the (device_id, fiscal_day_no) pairs that have invoices, optionally filtered"""
+    from app import db
+    from app.models import Invoice
+
+    query = db.session.query(Invoice.device_id, Invoice.fiscal_day_number).filter(
+        Invoice.fiscal_day_number.isnot(None)
+    )
+    if device_id:
+        query = query.filter(Invoice.device_id == str(device_id))
+    if fiscal_day_no is not None:
+        query = query.filter(Invoice.fiscal_day_number == str(fiscal_day_no))
+
+    days = {(device, int(day)) for device, day in query.distinct().all() if str(day).isdigit()}
+    return sorted(days)
+
+
+@fiscal_counters_cli.command('rebuild')
+@click.option('--device', 'device_id', help='Only rebuild this device.')
+@click.option('--day', 'fiscal_day_no', type=int, help='Only rebuild this fiscal day number.')
+def rebuild_command(device_id, fiscal_day_no):
+    """Recompute the running counters from invoices (backfill or repair)."""
+    from app import db
+    from utils.fiscal_day_counters import rebuild_fiscal_day_counters
+
+    for device, day in _fiscal_days(device_id, fiscal_day_no):
+        rows = rebuild_fiscal_day_counters(device, day)
+        db.session.commit()
+        click.echo(f"Device {device} fiscal day {day}: {rows} counter rows")
+
+
+@fiscal_counters_cli.command('verify')
+@click.option('--device', 'device_id', help='Only verify this device.')
+@click.option('--day', 'fiscal_day_no', type=int, help='Only verify this fiscal day number.')
+def verify_command(device_id, fiscal_day_no):
+    """Compare the running counters with a full recomputation."""
+    from utils.fiscal_day_counters import verify_fiscal_day_counters
+
+    mismatched = 0
+    for device, day in _fiscal_days(device_id, fiscal_day_no):
+        differences = verify_fiscal_day_counters(device, day)
+        if differences:
+            mismatched += 1
+            click.echo(f"✗ Device {device} fiscal day {day}")
+            for difference in differences:
+                click.echo(f"    {difference}")
+        else:
+            click.echo(f"✓ Device {device} fiscal day {day}")
+
+    if mismatched:
+        raise click.ClickException(f"{mismatched} fiscal day(s) differ from their invoices")
+
+
+@offline_cli.command('upload')
+@click.option('--device', 'device_id', help='Only upload this device.')
+@click.option('--batch-size', type=int, help='Receipts per SubmitFile file.')
+def upload_command(device_id, batch_size):
+    """Upload pending offline receipts to ZIMRA in SubmitFile batches."""
+    from app import db
+    from app.models import OfflineReceipt
+    from utils.offline_receipts import PENDING, upload_offline_receipts
+
+    query = db.session.query(OfflineReceipt.device_id).filter(OfflineReceipt.status == PENDING)
+    if device_id:
+        query = query.filter(OfflineReceipt.device_id == str(device_id))
+    devices = sorted(device for (device,) in query.distinct().all())
+
+    failed = 0
+    for device in devices:
+        result = upload_offline_receipts(device, batch_size=batch_size)
+        if result['error'] is None:
+            click.echo(f"✓ Device {device}: {result['receipts_uploaded']} receipts in {result['files_uploaded']} files")
+        else:
+            failed += 1
+            click.echo(f"✗ Device {device}: {result['receipts_uploaded']} receipts uploaded, "
+                       f"{result['pending_receipts']} pending: {result['error']}")
+
+    if failed:
+        raise click.ClickException(f"{failed} device(s) still have pending offline receipts")
+
+
+def _echo_fleet_report(report: dict):
+    """Print a fleet report, one line per device, and fail if any device failed"""
+    for entry in report['results']:
+        mark = {'succeeded': '✓', 'prepared': '✓', 'skipped': '-'}.get(entry['status'], '✗')
+        day = f" fiscal day {entry['fiscal_day_no']}" if entry['fiscal_day_no'] is not None else ''
+        overdue = ' (overdue)' if entry['overdue'] else ''
+        detail = f": {entry['error']}" if entry['error'] else ''
+        click.echo(f"{mark} Device {entry['device_id']}{day} {entry['status']}{overdue}{detail}")
+
+    click.echo(f"{report['succeeded']} succeeded, {report['skipped']} skipped, {report['failed']} failed "
+               f"in {report['elapsed_ms'] / 1000:.1f}s")
+    if report['failed']:
+        raise click.ClickException(f"{report['failed']} device(s) failed")
+
+
+@fleet_cli.command('open-day')
+@click.option('--device', 'device_ids', multiple=True, help='Only open this device (repeatable).')
+@click.option('--concurrency', type=int, help='Devices processed at once.')
+def fleet_open_day_command(device_ids, concurrency):
+    """Open a fiscal day on every device that has none open."""
+    from utils.fiscal_day_fleet import open_fleet_fiscal_days
+
+    _echo_fleet_report(open_fleet_fiscal_days(list(device_ids) or None, concurrency=concurrency))
+
+
+@fleet_cli.command('close-day')
+@click.option('--device', 'device_ids', multiple=True, help='Only close this device (repeatable).')
+@click.option('--concurrency', type=int, help='Devices processed at once.')
+@click.option('--due-within', 'due_within_hours', type=float,
+              help='Only close days whose taxPayerDayMaxHrs deadline is within this many hours.')
+@click.option('--dry-run', is_flag=True, help='Build and sign the payloads without submitting them.')
+def fleet_close_day_command(device_ids, concurrency, due_within_hours, dry_run):
+    """Generate counters, sign and submit CloseDay for every open fiscal day."""
+    from utils.fiscal_day_fleet import close_fleet_fiscal_days
+
+    _echo_fleet_report(close_fleet_fiscal_days(
+        list(device_ids) or None,
+        concurrency=concurrency,
+        due_within_hours=due_within_hours,
+        dry_run=dry_run
+    ))
+
+
+def register_commands(app):
+    """Register the maintenance CLI commands on the Flask app"""
+    app.cli.add_command(fiscal_counters_cli)
+    app.cli.add_command(offline_cli)
+    app.cli.add_command(fleet_cli)
@@ -19,12 +19,22 @@ class FiscalDay(db.Model):
     is_open = db.Column(db.Boolean, default=True)
     fiscal_status = db.Column(db.String(30))
     fiscal_day_no = db.Column(db.Integer, nullable=True)
+    # Signed close of a day closed with offline receipts pending (JSON SubmitFile footer)
+    close_payload = db.Column(db.Text)
+    
+    __table_args__ = (
+        db.Index('ix_fiscal_day_device_day_no', 'device_id', 'fiscal_day_no'),
+        # Latest fiscal day of a device (submit_receipt orders by id)
+        db.Index('ix_fiscal_day_device_id', 'device_id', 'id'),
+        # Partial index for the "current open fiscal day" lookups
+        db.Index('ix_fiscal_day_device_open', 'device_id', 'fiscal_day_no', postgresql_where=db.text('is_open')),
+    )
 
 
 class DeviceConfiguration(db.Model):
     __tablename__ = 'device_configuration'
     id = db.Column(db.Integer, primary_key=True)
-    device_id = db.Column(db.String(50), db.ForeignKey('device_info.device_id'), nullable=False)
+    device_id = db.Column(db.String(50), db.ForeignKey('device_info.device_id'), nullable=False, index=True)
     
     # Tax Payer Information
     tax_payer_name = db.Column(db.String(255))
@@ -53,6 +63,9 @@ class DeviceConfiguration(db.Model):
     device_branch_contacts_phone_no = db.Column(db.String(50))
     device_branch_contacts_email = db.Column(db.String(255))
     
+    # Branch profile snapshot matching the address and contact above
+    branch_profile_id = db.Column(db.Integer, db.ForeignKey('branch_profile.id'))
+    
     # Timestamps
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -61,7 +74,7 @@ class DeviceConfiguration(db.Model):
 class DeviceConfig(db.Model):
     __tablename__ = 'device_config'
     id = db.Column(db.Integer, primary_key=True)
-    device_id = db.Column(db.String(50), db.ForeignKey('device_info.device_id'), nullable=False)
+    device_id = db.Column(db.String(50), db.ForeignKey('device_info.device_id'), nullable=False, index=True)
     config = db.Column(db.Text, nullable=False)  # JSON string containing device configuration
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -101,6 +114,20 @@ class Invoice(db.Model):
     debit_credit_note_invoice_ref = db.Column(db.String(100))
     debit_credit_note_invoice_ref_date = db.Column(db.DateTime)
     
+    # Branch address and contact at fiscalization time
+    branch_profile_id = db.Column(db.Integer, db.ForeignKey('branch_profile.id'))
+    
+    # Lazy by default; detail views pick a loading strategy (see utils.invoice_detail)
+    line_items = db.relationship(
+        'InvoiceLineItem', back_populates='invoice', order_by='InvoiceLineItem.receipt_line_no'
+    )
+    branch_profile = db.relationship('BranchProfile')
+    
+    # Idempotent replay: client key, fingerprint of the posted receipt and the response returned
+    idempotency_key = db.Column(db.String(100))
+    request_hash = db.Column(db.String(64))
+    fiscal_response = db.Column(db.Text)
+    
     # Timestamps
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -109,6 +136,14 @@ class Invoice(db.Model):
     # Composite unique constraint to prevent duplicates based on device_id and invoice_id
     __table_args__ = (
         db.UniqueConstraint('device_id', 'invoice_id', name='uq_device_invoice'),
+        # Access paths used by counters, global numbers, credit/debit notes and listings
+        db.Index('ix_invoice_device_fiscal_day', 'device_id', 'fiscal_day_number', 'receipt_global_no'),
+        db.Index('ix_invoice_device_global_no', 'device_id', 'receipt_global_no'),
+        db.Index('ix_invoice_device_zimra_receipt', 'device_id', 'zimra_receipt_number'),
+        db.Index('ix_invoice_invoice_id', 'invoice_id'),
+        db.Index('ix_invoice_created_at_id', 'created_at', 'id'),
+        db.Index('ix_invoice_device_created_at_id', 'device_id', 'created_at', 'id'),
+        db.Index('ix_invoice_device_idempotency_key', 'device_id', 'idempotency_key', unique=True),
     )
 
 
@@ -127,15 +162,27 @@ class InvoiceLineItem(db.Model):
     tax_percent = db.Column(db.Float, nullable=True)  # Allow NULL for exempt items
     tax_id = db.Column(db.Integer, nullable=False)
     
+    invoice = db.relationship('Invoice', back_populates='line_items')
+    
     # Timestamps
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    # Covering index so counter aggregation can read line totals without the heap
+    __table_args__ = (
+        db.Index(
+            'ix_invoice_line_item_invoice_id', 'invoice_id',
+            postgresql_include=['tax_code', 'tax_percent', 'tax_id', 'receipt_line_total']
+        ),
+    )
 
 
+# Legacy per-invoice copies of the branch address and contact, superseded by BranchProfile.
+# No longer written; kept so the backfill can be re-run and rolled back.
 class DeviceBranchAddress(db.Model):
     __tablename__ = 'device_branch_address'
     id = db.Column(db.Integer, primary_key=True)
-    invoice_id = db.Column(db.Integer, db.ForeignKey('invoice.id'), nullable=False)
+    invoice_id = db.Column(db.Integer, db.ForeignKey('invoice.id'), nullable=False, index=True)
     city = db.Column(db.String(100))
     house_no = db.Column(db.String(50))
     province = db.Column(db.String(100))
@@ -149,7 +196,7 @@ class DeviceBranchAddress(db.Model):
 class DeviceBranchContact(db.Model):
     __tablename__ = 'device_branch_contact'
     id = db.Column(db.Integer, primary_key=True)
-    invoice_id = db.Column(db.Integer, db.ForeignKey('invoice.id'), nullable=False)
+    invoice_id = db.Column(db.Integer, db.ForeignKey('invoice.id'), nullable=False, index=True)
     email = db.Column(db.String(255))
     phone_number = db.Column(db.String(50))
     
@@ -158,6 +205,33 @@ class DeviceBranchContact(db.Model):
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 
+class BranchProfile(db.Model):
+    __tablename__ = 'branch_profile'
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.String(50), nullable=False)
+    version = db.Column(db.Integer, nullable=False)  # 1, 2, ... per device
+    content_hash = db.Column(db.String(64), nullable=False)  # SHA-256 of the address and contact
+    
+    # Address Information
+    province = db.Column(db.String(100))
+    city = db.Column(db.String(100))
+    street = db.Column(db.String(255))
+    house_no = db.Column(db.String(50))
+    
+    # Contact Information
+    email = db.Column(db.String(255))
+    phone_number = db.Column(db.String(50))
+    
+    # Timestamps
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # One snapshot per distinct address and contact of a device
+    __table_args__ = (
+        db.UniqueConstraint('device_id', 'content_hash', name='uq_branch_profile_device_hash'),
+        db.UniqueConstraint('device_id', 'version', name='uq_branch_profile_device_version'),
+    )
+
+
 class DeviceGlobalNumber(db.Model):
     __tablename__ = 'device_global_number'
     id = db.Column(db.Integer, primary_key=True)
@@ -166,4 +240,149 @@ class DeviceGlobalNumber(db.Model):
     
     # Timestamps
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
\ No newline at end of file
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class ReceiptChainHead(db.Model):
+    __tablename__ = 'receipt_chain_head'
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.String(50), db.ForeignKey('device_info.device_id'), nullable=False)
+    fiscal_day_no = db.Column(db.Integer, nullable=False)
+    
+    # Last fiscalized receipt in the fiscal day
+    last_hash = db.Column(db.String(255))
+    receipt_counter = db.Column(db.Integer, nullable=False, default=0)  # Receipts fiscalized in this fiscal day
+    last_global_no = db.Column(db.Integer)
+    
+    # Timestamps
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    # One chain head per device and fiscal day
+    __table_args__ = (
+        db.UniqueConstraint('device_id', 'fiscal_day_no', name='uq_chain_head_device_day'),
+    )
+
+
+class FiscalDayCounter(db.Model):
+    __tablename__ = 'fiscal_day_counter'
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.String(50), db.ForeignKey('device_info.device_id'), nullable=False)
+    fiscal_day_no = db.Column(db.Integer, nullable=False)
+    
+    # Counter identity: SaleByTax, SaleTaxByTax, BalanceByMoneyType or ReceiptTotal (per-currency receipt totals)
+    counter_type = db.Column(db.String(30), nullable=False)
+    currency = db.Column(db.String(10), nullable=False)
+    counter_key = db.Column(db.String(50), nullable=False, default='')  # "<taxID>_<taxPercent>", money type or ''
+    tax_id = db.Column(db.Integer)
+    tax_percent = db.Column(db.Float)
+    money_type = db.Column(db.String(20))
+    
+    # Running totals
+    value = db.Column(db.Numeric(18, 4), nullable=False, default=0)
+    receipt_count = db.Column(db.Integer, nullable=False, default=0)
+    line_count = db.Column(db.Integer, nullable=False, default=0)
+    
+    # Timestamps
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    # One row per counter for a device and fiscal day
+    __table_args__ = (
+        db.UniqueConstraint('device_id', 'fiscal_day_no', 'counter_type', 'currency', 'counter_key',
+                            name='uq_fiscal_day_counter'),
+    )
+
+
+class FiscalizationOutbox(db.Model):
+    __tablename__ = 'fiscalization_outbox'
+    id = db.Column(db.Integer, primary_key=True)
+    tracking_id = db.Column(db.String(36), unique=True, nullable=False)
+    device_id = db.Column(db.String(50), db.ForeignKey('device_info.device_id'), nullable=False)
+    invoice_id = db.Column(db.String(100), nullable=False)  # POS invoice number
+    fiscal_day_no = db.Column(db.Integer, nullable=False)
+    receipt_global_no = db.Column(db.Integer, nullable=False)
+    
+    # Signed SubmitReceipt data, exactly as it will be sent to ZIMRA (JSON)
+    payload = db.Column(db.Text, nullable=False)
+    
+    # Idempotent replay: fingerprint of the receipt as posted and its Idempotency-Key
+    request_hash = db.Column(db.String(64))
+    idempotency_key = db.Column(db.String(100))
+    
+    # Delivery state: pending, submitting, fiscalized or failed
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_status_code = db.Column(db.Integer)
+    last_error = db.Column(db.Text)
+    
+    # Lease of the dispatcher process submitting the entry
+    claimed_by = db.Column(db.String(100))
+    claimed_at = db.Column(db.DateTime)
+    
+    # Result once accepted by ZIMRA / fiscalized
+    zimra_receipt_id = db.Column(db.String(50))
+    zimra_response = db.Column(db.Text)  # SubmitReceipt response from ZIMRA (JSON)
+    response = db.Column(db.Text)  # submit_receipt response body (JSON)
+    fiscalized_at = db.Column(db.DateTime)
+    
+    # Timestamps
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    # Dispatcher reads each device's queue in order
+    __table_args__ = (
+        db.Index('ix_outbox_device_status', 'device_id', 'status', 'id'),
+        db.Index('ix_outbox_device_invoice', 'device_id', 'invoice_id'),
+        db.Index('ix_outbox_device_idempotency_key', 'device_id', 'idempotency_key'),
+    )
+
+
+class OfflineFile(db.Model):
+    __tablename__ = 'offline_file'
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.String(50), db.ForeignKey('device_info.device_id'), nullable=False)
+    fiscal_day_no = db.Column(db.Integer, nullable=False)
+    file_sequence = db.Column(db.Integer, nullable=False)
+    
+    # Receipts carried by the file
+    receipt_count = db.Column(db.Integer, nullable=False, default=0)
+    first_global_no = db.Column(db.Integer)
+    last_global_no = db.Column(db.Integer)
+    file_size = db.Column(db.Integer)  # Bytes of the Base64-encoded file
+    
+    # ZIMRA SubmitFile result
+    operation_id = db.Column(db.String(100))
+    
+    # Timestamps
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # File sequence numbers are per device and fiscal day
+    __table_args__ = (
+        db.UniqueConstraint('device_id', 'fiscal_day_no', 'file_sequence', name='uq_offline_file_sequence'),
+    )
+
+
+class OfflineReceipt(db.Model):
+    __tablename__ = 'offline_receipt'
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.String(50), db.ForeignKey('device_info.device_id'), nullable=False)
+    invoice_id = db.Column(db.Integer, db.ForeignKey('invoice.id'), nullable=False)
+    fiscal_day_no = db.Column(db.Integer, nullable=False)
+    receipt_global_no = db.Column(db.Integer, nullable=False)
+    
+    # Signed SubmitReceipt data (zlib-compressed JSON)
+    payload = db.Column(db.LargeBinary, nullable=False)
+    
+    # Upload state: pending until acknowledged in a SubmitFile upload
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    offline_file_id = db.Column(db.Integer, db.ForeignKey('offline_file.id'))
+    
+    # Timestamps
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    uploaded_at = db.Column(db.DateTime)
+    
+    # Uploads read each device's pending receipts in global number order
+    __table_args__ = (
+        db.Index('ix_offline_receipt_device_status', 'device_id', 'status', 'receipt_global_no'),
+    )
@@ -1,21 +1,47 @@
-from flask import Blueprint, jsonify, request, current_app, send_from_directory, render_template_string, send_file
-from app.models import DeviceInfo, FiscalDay, Invoice, InvoiceLineItem, DeviceBranchAddress, DeviceBranchContact, DeviceConfiguration
+from flask import (
+    Blueprint, jsonify, request, current_app, send_from_directory, render_template_string, send_file,
+    Response, stream_with_context
+)
+from app.models import DeviceInfo, FiscalDay, Invoice, DeviceConfiguration, FiscalizationOutbox
 from app.config import zimra_config
 from app import db
-from utils.close_day_string_utilts import generate_close_day_string, add_zeros
-from utils.date_utils import  get_close_day_string_date
-from utils.generate_counters import generate_counters, analyze_invoice_currencies_and_taxes
+from utils.close_day_string_utilts import add_zeros
+from utils.date_utils import get_close_day_string_date
+from utils.generate_counters import analyze_invoice_currencies_and_taxes
 from utils.update_closeday import update_fiscal_counter_data
+from utils.fdms_session import get_fdms_session, fdms_sessions
+from utils.fdms_async import fdms_async_client, load_fdms_devices
+from utils.fiscal_day_fleet import open_fleet_fiscal_days, close_fleet_fiscal_days, build_close_day_payload
+from utils.key_store import get_device_private_key
+from utils.device_cache import device_cache, get_cached_device, get_cached_device_configuration, invalidate_device
+from utils.branch_profiles import get_or_create_branch_profile
+from utils.idempotency import receipt_request_hash, find_fiscalized_receipt, receipt_replay_cache
+from utils.fiscal_day_counters import get_fiscal_day_receipt_totals
+from utils.invoice_pagination import LISTING_ORDER, paginate_invoices_keyset
+from utils.invoice_detail import assemble_invoice, load_fiscal_day_invoice_details
+from utils.template_registry import template_registry
+from utils.qr_images import qr_image_cache, get_qr_png, get_qr_svg
+from utils.pdf_cache import invoice_pdf_cache, invoice_pdf_etag, get_invoice_pdf, iter_invoice_pdfs, prerender_invoice_pdfs
+from utils.pdf_renderer import pdf_render_service, PdfRenderQueueFull, PdfRenderTimeout, merge_pdfs
+from utils.request_timing import init_request_timing, request_timings, timing_span
+from utils.invoice_export import serialize_invoice, invoice_export_query, stream_invoices_jsonl, stream_invoices_csv
+from utils.offline_receipts import (
+    store_offline_receipt, has_pending_offline_receipts, is_offline_mode_forced, close_fiscal_day_offline,
+    is_offline_fallback_enabled, get_offline_status, upload_offline_receipts
+)
+from utils.fiscalization_outbox import (
+    outbox_dispatcher, enqueue_receipt, has_open_entries, get_open_entry, outbox_entry_to_dict
+)
 from utils.invoice_utils import (
-    invoice_exists, get_existing_invoice_info, get_fiscal_day_counter, get_global_number, calculate_tax_summary,
-    calculate_total_sales_amount_with_tax, create_invoice_line_items, create_invoice,
-    update_fiscalized_invoice, qr_string_generator, base64_to_hex_md5,
-    qr_date, receipt_date_print, get_fiscal_day_open_date_time, get_previous_hash,
-    get_credit_debit_note_invoice, ReceiptDeviceSignature, read_pem_file,
+    invoice_exists, get_existing_invoice_info, get_global_number, calculate_tax_summary,
+    calculate_total_sales_amount_with_tax, create_invoice_line_items, save_fiscalized_invoices, qr_string_generator, base64_to_hex_md5,
+    qr_date, receipt_date_print, get_chain_head, advance_chain_head,
+    get_credit_debit_note_invoice, ReceiptDeviceSignature,
     generate_close_day_payload
 )
 from datetime import datetime
 from enum import Enum
+from sqlalchemy.orm import selectinload
 from traceback import format_exc
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import padding
@@ -28,6 +54,8 @@ import logging
 import json
 import urllib3
 import hashlib
+import tempfile
+import zipfile
 from reportlab.lib.pagesizes import letter, A4
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
@@ -41,6 +69,7 @@ from datetime import datetime
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 api = Blueprint('api', __name__)
+init_request_timing(api)
 
 
 class FiscaldayStatusEnum(Enum):
@@ -55,7 +84,7 @@ def get_fiscal_number(device_id: str) -> int:
     Raises ValueError if no open fiscal day is found.
     """
     
-    device = DeviceInfo.query.filter_by(device_id=str(device_id)).first()
+    device = get_cached_device(device_id)
     current_app.logger.debug(f"mydeviceId: {device}")
 
     # Get the most recent open fiscal day (highest fiscal_day_no)
@@ -81,7 +110,7 @@ def get_latest_fiscal_number(device_id: str) -> int:
     Raises ValueError if no fiscal day is found.
     """
     
-    device = DeviceInfo.query.filter_by(device_id=str(device_id)).first()
+    device = get_cached_device(device_id)
     current_app.logger.debug(f"mydeviceId: {device}")
 
     # Get the highest fiscal day number (regardless of open/closed status)
@@ -102,8 +131,8 @@ def get_device_config(device_id):
     """
     Get device configuration from database and return with certificate/key paths.
     """
-    # Get device info for certificate and key paths
-    device = DeviceInfo.query.filter_by(device_id=str(device_id)).first()
+    # Get device info for certificate and key paths (cached per device)
+    device = get_cached_device(device_id)
     if not device:
         # Fallback to hardcoded paths if device not found
         return {
@@ -113,8 +142,8 @@ def get_device_config(device_id):
             "model_version_number": "v1"
         }
     
-    # Get device configuration from database
-    device_config = DeviceConfiguration.query.filter_by(device_id=str(device_id)).first()
+    # Get device configuration from the device cache
+    device_config = get_cached_device_configuration(device_id)
     
     config_data = {
         "certificate": device.certificate_path,
@@ -171,7 +200,7 @@ def get_status(device_id):
         device_config = get_device_config(device_id)
         cert_path = device_config["certificate"]
         key_path = device_config["key"]
-        device = DeviceInfo.query.filter_by(device_id=device_id).first()
+        device = get_cached_device(device_id)
 
         # Step 2: If device doesn't exist, create and add it
         if not device:
@@ -184,6 +213,7 @@ def get_status(device_id):
             )
             db.session.add(device)
             db.session.commit()
+            invalidate_device(device_id)
             current_app.logger.debug(f"New device added with device_id: {device_id}")
         else:
             current_app.logger.debug(f"Device with device_id {device_id} already exists.") 
@@ -193,8 +223,7 @@ def get_status(device_id):
 
 
 
-        session = requests.Session()
-        session.cert = (cert_path, key_path)
+        session = get_fdms_session(device_id, cert_path, key_path)
 
         headers = {
             "Content-Type": "application/json",
@@ -222,6 +251,37 @@ def get_status(device_id):
     
 
 
+@api.route("/getstatus", methods=["GET"])
+def get_fleet_status():
+    """
+    Run GetStatus for many devices concurrently.
+    
+    Query parameters:
+        device_id (str, optional): Comma-separated devices (default: every registered device)
+        
+    Returns:
+        JSON response with one GetStatus result per device
+    """
+    try:
+        device_ids = [d for d in request.args.get('device_id', '').split(',') if d.strip()]
+        devices = load_fdms_devices([d.strip() for d in device_ids] or None)
+        if not devices:
+            return jsonify({"error": "No devices found"}), 404
+        
+        results = fdms_async_client.run(
+            fdms_async_client.for_each_device(devices, lambda client, device: client.get_status(device))
+        )
+        return jsonify({
+            "devices": len(results),
+            "reachable": sum(1 for result in results if result['ok']),
+            "results": results
+        }), 200
+        
+    except Exception as e:
+        current_app.logger.error(f"Fleet status error: {e}")
+        return jsonify({"error": "Internal error", "details": str(e)}), 500
+
+
 @api.route('/openday/<device_id>', methods=['POST'])
 def open_day(device_id):
     # Load device config from DB or return 404 if not found
@@ -232,7 +292,7 @@ def open_day(device_id):
     cert_path = device_config["certificate"]
     key_path = device_config["key"]
 
-    device = DeviceInfo.query.filter_by(device_id=device_id).first()
+    device = get_cached_device(device_id)
 
         # Step 2: If device doesn't exist, create and add it
     if not device:
@@ -245,15 +305,15 @@ def open_day(device_id):
             )
             db.session.add(device)
             db.session.commit()
+            invalidate_device(device_id)
             current_app.logger.debug(f"New device added with device_id: {device_id}")
     else:
             current_app.logger.debug(f"Device with device_id {device_id} already exists.") 
 
 
 
-    # Prepare requests session with client cert and key
-    session = requests.Session()
-    session.cert = (cert_path, key_path)
+    # Get pooled session with client cert and key
+    session = get_fdms_session(device_id, cert_path, key_path)
     #current_app.logger.debug(f"OpenDay model: {device_config.model_name} , version: {device_config.model_version}")
     # Define headers
     headers = {
@@ -307,11 +367,12 @@ def close_day(device_id):
     """
     Close a fiscal day for a specific device according to ZIMRA API specification.
     
-    This endpoint uses the Django-style approach with generate_counters function.
+    The counters and signature come from build_close_day_payload, shared with the
+    fleet close (POST /api/fleet/close_day), so both submit the same CloseDay.
     """
     try:
         # 1. Load device config
-        device = DeviceInfo.query.filter_by(device_id=str(device_id)).first()
+        device = get_cached_device(device_id)
         if not device:
             return jsonify({"error": "Device not found"}), 404
 
@@ -330,75 +391,46 @@ def close_day(device_id):
         if not open_fiscal_day:
             return jsonify({"error": f"No open fiscal day {fiscal_day_number} found for this device"}), 404
 
-        # Use the current close date for signing as per ZIMRA spec
+        # Counters only include fiscalized receipts; wait for queued ones to be delivered
+        if has_open_entries(device_id):
+            return jsonify({
+                "error": "Receipts are still queued for asynchronous fiscalization on this device",
+                "details": "Close the fiscal day once the queue has been delivered"
+            }), 409
+
+        # With offline receipts pending the day is closed offline: the signed close goes to
+        # ZIMRA in the footer of the SubmitFile upload that carries the day's last receipt
+        close_offline = has_pending_offline_receipts(device_id)
         fiscal_close_date = get_close_day_string_date()
-        formatted_close_date = fiscal_close_date
-        
-        # 4. Generate counters using Django-style approach
+
+        # 4. Generate the counters and sign them, exactly as the fleet close does
         try:
-            # Read private key as string for generate_counters (same as Django implementation)
-            with open(key_path, 'r') as key_file:
-                private_key_string = key_file.read()
-            
-            # Generate the close day data using generate_counters
-            close_data = generate_counters(
-                private_key=private_key_string,
+            final_payload = build_close_day_payload(
                 device_id=str(device_id),
-                date_string=open_fiscal_day.fiscal_day_open,
-                close_day_date=fiscal_close_date,
-                fiscal_day_no=int(fiscal_day_number)  # Use the fiscal day number from get_fiscal_number
+                key_path=key_path,
+                fiscal_day_no=int(fiscal_day_number),
+                fiscal_day_open=open_fiscal_day.fiscal_day_open,
+                fiscal_close_date=fiscal_close_date,
+                offline=close_offline
             )
-    
         except ValueError as e:
             return jsonify({"error": str(e)}), 400
 
-        # 5. Update fiscal counter data (Django-style)
-        updated_counters = update_fiscal_counter_data(close_data['fiscalDayCounters'])
-        close_data['fiscalDayCounters'] = updated_counters
-
-        # 6. Generate string to sign using the canonical format (no dynamic Base64 counters)
-        string_to_sign = generate_close_day_string(
-            device_id=str(device_id),
-            fiscal_day_no=fiscal_day_number,
-            date=formatted_close_date,
-            receipt_close=close_data
-        )
-
-        current_app.logger.debug(f"String to sign for CloseDay: {string_to_sign}")
-        #return jsonify(string_to_sign), 200
-        # 7. Generate the signature using ReceiptDeviceSignature class (same as Django implementation)
-        # Read private key as string for signature generation (same as Django implementation)
-        with open(key_path, 'r') as key_file:
-            private_key_string = key_file.read()
-        
-        # Create ReceiptDeviceSignature object
-        receipt_device_signature = ReceiptDeviceSignature(
-            string_to_sign=string_to_sign, 
-            private_key=private_key_string
-        )
-        
-        # Generate signature (RSA-SHA256 over the original data) and SHA256 base64 hash of the data
-        fiscal_day_device_signature = receipt_device_signature.sign_data()
-        signature_hash = receipt_device_signature.get_hash()
-        
-        
-        
-        # Create the final payload in the correct ZIMRA format order
-        final_payload = {
-            "fiscalDayNo": close_data['fiscalDayNo'],
-            "fiscalDayCounters": close_data['fiscalDayCounters'],
-            "fiscalDayDeviceSignature": {
-                "hash": signature_hash,
-                "signature": fiscal_day_device_signature
-            },
-            "receiptCounter": close_data['receiptCounter']
-        }
+        if close_offline:
+            close_fiscal_day_offline(open_fiscal_day, final_payload, fiscal_close_date)
+            db.session.commit()
+            outbox_dispatcher.start()
+            return jsonify({
+                "status": open_fiscal_day.fiscal_status,
+                "fiscalDayNo": open_fiscal_day.fiscal_day_no,
+                "receiptCounter": final_payload['receiptCounter'],
+                "message": "Fiscal day closed offline; the close is submitted with the last SubmitFile upload of the day"
+            }), 202
         
-        # 9. Prepare secure session with ZIMRA
-        session = requests.Session()
-        session.cert = (cert_path, key_path)
+        # 5. Get pooled secure session with ZIMRA
+        session = get_fdms_session(device_id, cert_path, key_path)
 
-        # 10. Prepare headers according to ZIMRA API specification
+        # 6. Prepare headers according to ZIMRA API specification
         headers = {
             "Content-Type": "application/json",
             "Accept": "application/json",
@@ -406,16 +438,15 @@ def close_day(device_id):
             "DeviceModelVersion": device.model_version
         }
 
-        # 11. Send request to ZIMRA
+        # 7. Send request to ZIMRA
         json_data = json.dumps(final_payload)
         current_app.logger.debug(f"CloseDay Payload with signature: {json_data}")
-        return jsonify(json_data), 200
         url = zimra_config.get_api_url(device_id, "CloseDay")
         response = session.post(url, data=json_data, headers=headers, verify=False)
 
         current_app.logger.debug(f"ZIMRA CloseDay status: {response.status_code}")
 
-        # 12. Process response and update local DB if successful
+        # 8. Process response and update local DB if successful
         if response.status_code == 200:
             data = response.json()
             current_app.logger.debug(f"ZIMRA CloseDay response: {data}")
@@ -468,7 +499,7 @@ def close_day_summary(device_id):
     """
     try:
         # Get device info
-        device = DeviceInfo.query.filter_by(device_id=str(device_id)).first()
+        device = get_cached_device(device_id)
         if not device:
             return jsonify({
                 "success": False,
@@ -489,28 +520,22 @@ def close_day_summary(device_id):
         
         fiscal_day_no = fiscal_day.fiscal_day_no
         
-        # Get invoices for this fiscal day
-        invoices = Invoice.query.filter_by(
-            device_id=str(device_id),
-            fiscal_day_number=str(fiscal_day_no)
-        ).all()
+        # Receipt totals per currency from the running fiscal day counters
+        receipt_totals = get_fiscal_day_receipt_totals(device_id, fiscal_day_no)
         
         # Calculate summary
-        total_invoices = len(invoices)
-        total_amount = sum(float(inv.receipt_total or 0) for inv in invoices)
-        total_receipt_counter = sum(inv.receipt_counter or 0 for inv in invoices)
+        total_invoices = sum(entry['count'] for entry in receipt_totals.values())
+        total_amount = sum(entry['amount'] for entry in receipt_totals.values())
+        total_receipt_counter = sum(entry['receipt_counter'] for entry in receipt_totals.values())
         
         # Get currency breakdown
-        currency_breakdown = {}
-        for invoice in invoices:
-            currency = invoice.receipt_currency or 'ZWG'
-            if currency not in currency_breakdown:
-                currency_breakdown[currency] = {'count': 0, 'amount': 0.0}
-            currency_breakdown[currency]['count'] += 1
-            currency_breakdown[currency]['amount'] += float(invoice.receipt_total or 0)
+        currency_breakdown = {
+            currency: {'count': entry['count'], 'amount': entry['amount']}
+            for currency, entry in receipt_totals.items()
+        }
         
         # Get device configuration
-        device_config = DeviceConfiguration.query.filter_by(device_id=device.device_id).first()
+        device_config = get_cached_device_configuration(device.device_id)
         
         summary = {
             "device_id": device_id,
@@ -549,9 +574,365 @@ def close_day_summary(device_id):
         return jsonify(error_details), 500
 
 
+def validate_receipt_data(receipt_data: dict):
+    """
+    Check the fields SubmitReceipt needs before any number is allocated.
+    
+    Parameters:
+        receipt_data (dict): Receipt as posted by the POS
+        
+    Returns:
+        str: Error message, or None when the receipt is valid
+    """
+    # Validate required fields in receipt data
+    required_fields = ["invoiceNo", "receiptDate", "receiptType", "receiptTotal"]
+    for field in required_fields:
+        if field not in receipt_data:
+            return f"Missing required field: {field}"
+    
+    # Validate credit/debit note specific fields
+    if receipt_data.get('creditDebitNote') is not None:
+        if 'receiptID' not in receipt_data['creditDebitNote']:
+            return "Credit/Debit note must include receiptID in creditDebitNote"
+        if not receipt_data.get('receiptNotes'):
+            return "Credit/Debit note must include receiptNotes"
+    
+    return None
+
+
+def prepare_receipt_data(receipt_data: dict) -> dict:
+    """
+    Build the SubmitReceipt data for a receipt: date, receipt counter, credit/debit note
+    signs, taxes, total and payments. The global number and signature are added later.
+    
+    Parameters:
+        receipt_data (dict): Validated receipt as posted by the POS
+        
+    Returns:
+        dict: updated_data, receipt_lines, filtered_taxes, receipt_total, is_credit_note and is_debit_note
+    """
+    updated_data = receipt_data.copy()
+    updated_data['receiptDate'] = get_submit_receipt_date()
+    
+    # Set receiptCounter to the number of line items in the current invoice
+    receipt_lines = updated_data.get('receiptLines', [])
+    updated_data['receiptCounter'] = len(receipt_lines)
+    
+    # Check if this is a credit/debit note and handle receipt lines
+    is_credit_debit_note = updated_data.get('creditDebitNote') is not None
+    is_credit_note = False
+    is_debit_note = False
+    
+    if is_credit_debit_note:
+        # Determine if it's a credit note or debit note based on receiptType
+        receipt_type = updated_data.get('receiptType', '').lower()
+        if 'credit' in receipt_type:
+            is_credit_note = True
+        elif 'debit' in receipt_type:
+            is_debit_note = True
+        else:
+            # Default to credit note if receiptType is not specified
+            is_credit_note = True
+    
+    if is_credit_note:
+        # For credit notes, make all monetary values in receipt lines negative
+        for line in receipt_lines:
+            if 'receiptLinePrice' in line:
+                line['receiptLinePrice'] = -abs(line['receiptLinePrice'])
+            if 'receiptLineTotal' in line:
+                line['receiptLineTotal'] = -abs(line['receiptLineTotal'])
+    elif is_debit_note:
+        # For debit notes, ensure all monetary values in receipt lines are positive
+        for line in receipt_lines:
+            if 'receiptLinePrice' in line:
+                line['receiptLinePrice'] = abs(line['receiptLinePrice'])
+            if 'receiptLineTotal' in line:
+                line['receiptLineTotal'] = abs(line['receiptLineTotal'])
+    
+    # Calculate tax summary with enhanced logic
+    tax_summary = calculate_tax_summary(updated_data.get('receiptLines', []))
+    
+    # Create tax objects based on actual tax codes used in receipt lines
+    filtered_taxes = []
+    
+    # Add tax objects for each tax code that has sales
+    for tax_code, tax_data in tax_summary.items():
+        if abs(tax_data['salesAmountWithTax']) > 0:  # Include taxes with non-zero sales (positive or negative)
+            tax_object = {
+                'taxCode': tax_data['taxCode'],
+                'taxID': tax_data['taxID'],
+                'taxAmount': tax_data['taxAmount'],
+                'salesAmountWithTax': tax_data['salesAmountWithTax']
+            }
+            
+            # For credit notes, make all monetary values negative
+            if is_credit_note:
+                tax_object['taxAmount'] = -abs(tax_data['taxAmount'])
+                tax_object['salesAmountWithTax'] = -abs(tax_data['salesAmountWithTax'])
+            # For debit notes, ensure all monetary values are positive
+            elif is_debit_note:
+                tax_object['taxAmount'] = abs(tax_data['taxAmount'])
+                tax_object['salesAmountWithTax'] = abs(tax_data['salesAmountWithTax'])
+            
+            # Add taxPercent only for non-exempt items
+            if not zimra_config.is_exempt_tax_id(tax_data['taxID']):
+                tax_object['taxPercent'] = tax_data['taxPercent']
+            
+            filtered_taxes.append(tax_object)
+    
+    # Calculate total
+    receipt_total = calculate_total_sales_amount_with_tax(filtered_taxes)
+    
+    # For credit notes, ensure total is negative
+    if is_credit_note:
+        receipt_total = -abs(receipt_total)
+    # For debit notes, ensure total is positive
+    elif is_debit_note:
+        receipt_total = abs(receipt_total)
+    
+    # Ensure receiptPayments has the proper structure
+    if 'receiptPayments' not in updated_data or not updated_data['receiptPayments']:
+        updated_data['receiptPayments'] = [{'moneyTypeCode': 'Cash', 'paymentAmount': receipt_total}]
+    else:
+        # Update the first payment method with the calculated total
+        updated_data['receiptPayments'][0]['paymentAmount'] = receipt_total
+    
+    updated_data['receiptTotal'] = receipt_total
+    updated_data['receiptTaxes'] = filtered_taxes
+    
+    return {
+        'updated_data': updated_data,
+        'receipt_lines': receipt_lines,
+        'filtered_taxes': filtered_taxes,
+        'receipt_total': receipt_total,
+        'is_credit_note': is_credit_note,
+        'is_debit_note': is_debit_note
+    }
+
+
+def sign_receipt_data(device_id: str, prepared: dict, previous_receipt_hash: str, private_key) -> ReceiptDeviceSignature:
+    """
+    Sign a prepared receipt, chaining it to the previous receipt's hash.
+    
+    Parameters:
+        device_id (str): Device identifier
+        prepared (dict): Receipt as returned by prepare_receipt_data, with receiptGlobalNo set
+        previous_receipt_hash (str): Hash of the previous receipt in the fiscal day ('' for the first)
+        private_key: Device private key
+        
+    Returns:
+        ReceiptDeviceSignature: Signature object; the hash and signature are also added to the receipt
+    """
+    updated_data = prepared['updated_data']
+    
+    # Generate string to sign with previous hash if available
+    string_to_sign = generator_invoice_string(str(device_id), updated_data, prepared['filtered_taxes'])
+    
+    if previous_receipt_hash != '':
+        string_to_sign = string_to_sign + str(previous_receipt_hash)
+    
+    # Generate signature using ReceiptDeviceSignature class
+    receipt_device_signature_obj = ReceiptDeviceSignature(string_to_sign, private_key)
+    
+    # Add signature to receipt data
+    updated_data['receiptDeviceSignature'] = {
+        "hash": receipt_device_signature_obj.get_hash(),
+        "signature": receipt_device_signature_obj.sign_data()
+    }
+    
+    return receipt_device_signature_obj
+
+
+def build_fiscalized_receipt(device_id: str, updated_data: dict, fiscal_day_no: int, zimra_response: dict,
+                             device_config, config_data: dict, request_hash: str = None,
+                             idempotency_key: str = None) -> tuple:
+    """
+    Build the invoice rows and API response for a receipt accepted by ZIMRA.
+    
+    Parameters:
+        device_id (str): Device identifier
+        updated_data (dict): Signed receipt exactly as sent to ZIMRA
+        fiscal_day_no (int): Fiscal day the receipt was submitted in
+        zimra_response (dict): SubmitReceipt response from ZIMRA
+        device_config (DeviceConfiguration): Stored device configuration, or None
+        config_data (dict): Device configuration from get_device_config
+        request_hash (str): Fingerprint of the receipt as posted, for idempotent replay
+        idempotency_key (str): Idempotency-Key header of the submission
+        
+    Returns:
+        tuple: (invoice_data, update_data, response_data)
+    """
+    receipt_lines = updated_data.get('receiptLines', [])
+    receipt_total = updated_data['receiptTotal']
+    global_number = updated_data['receiptGlobalNo']
+    receipt_signature = updated_data['receiptDeviceSignature']
+    
+    # Create invoice data
+    invoice_data = {
+        'invoice_id': updated_data['invoiceNo'],
+        'device_id': str(device_id),
+        'receipt_currency': updated_data.get('receiptCurrency', 'USD'),
+        'money_type': 'Cash',
+        'receipt_type': updated_data['receiptType'],
+        'receipt_total': receipt_total,
+        'line_items': updated_data.get('receiptLines', [])
+    }
+    
+    # Generate QR code using stored QR URL from device config
+    qr_url = device_config.qr_url if device_config and device_config.qr_url else zimra_config.qr_url
+    qr_string = qr_string_generator(
+        device_id=str(device_id),
+        qr_url=qr_url,
+        receipt_date=qr_date(),
+        reciept_global_no=global_number,
+        reciept_signature=receipt_signature['signature']
+    )
+    
+    # Generate verification code
+    verification_string = base64_to_hex_md5(receipt_signature['signature'])
+    
+    # Handle credit/debit note logic
+    debit_credit_note_invoice_ref = None
+    debit_credit_note_invoice_ref_date = None
+    
+    if updated_data.get('creditDebitNote') is not None:
+        debited_credited_invoice = get_credit_debit_note_invoice(
+            device_id=str(device_id),
+            receipt_id=str(updated_data['creditDebitNote']['receiptID'])
+        )
+        
+        if debited_credited_invoice:
+            debit_credit_note_invoice_ref = debited_credited_invoice.invoice_id
+            debit_credit_note_invoice_ref_date = debited_credited_invoice.timestamp
+        else:
+            debit_credit_note_invoice_ref = str(updated_data['creditDebitNote']['receiptID'])
+    
+    # Prepare update data using stored device configuration
+    update_data = {
+        'invoice_id': updated_data['invoiceNo'],
+        'zimra_receipt_number': str(zimra_response.get('receiptID', '')),
+        'operation_id': str(zimra_response.get('operationID', '')),
+        'qr_code_string': qr_string,
+        'verification_number': verification_string,
+        'hash_string': receipt_signature['hash'],
+        'is_fiscalized': True,
+        'receipt_counter': len(receipt_lines),
+        'receipt_global_no': global_number,
+        'fiscal_day_number': str(fiscal_day_no),
+        'receipt_notes': updated_data.get('receiptNotes', ''),
+        'tax_payer_name': device_config.tax_payer_name if device_config else config_data.get('taxPayerName', ''),
+        'tax_payer_tin': str(device_config.tax_payer_tin if device_config else config_data.get('taxPayerTIN', '')),
+        'vat_number': str(device_config.vat_number if device_config else config_data.get('vatNumber', '')),
+        'device_branch_name': str(device_config.device_branch_name if device_config else config_data.get('deviceBranchName', '')),
+        'device_branch_address': {
+            'province': device_config.device_branch_address_province if device_config else config_data.get('deviceBranchAddress', {}).get('province', ''),
+            'city': device_config.device_branch_address_city if device_config else config_data.get('deviceBranchAddress', {}).get('city', ''),
+            'street': device_config.device_branch_address_street if device_config else config_data.get('deviceBranchAddress', {}).get('street', ''),
+            'houseNo': device_config.device_branch_address_house_no if device_config else config_data.get('deviceBranchAddress', {}).get('houseNo', '')
+        },
+        'device_branch_contact': {
+            'phoneNo': device_config.device_branch_contacts_phone_no if device_config else config_data.get('deviceBranchContacts', {}).get('phoneNo', ''),
+            'email': device_config.device_branch_contacts_email if device_config else config_data.get('deviceBranchContacts', {}).get('email', '')
+        },
+        'debit_credit_note_invoice_ref': debit_credit_note_invoice_ref,
+        'debit_credit_note_invoice_ref_date': debit_credit_note_invoice_ref_date,
+        # Current branch profile of the device; looked up by content when it has none
+        'branch_profile_id': device_config.branch_profile_id if device_config else None
+    }
+    
+    # Prepare response data using stored device configuration
+    response_data = {
+        "taxPayerName": device_config.tax_payer_name if device_config else config_data.get('taxPayerName', ''),
+        "taxPayerTIN": device_config.tax_payer_tin if device_config else config_data.get('taxPayerTIN', ''),
+        "vatNumber": device_config.vat_number if device_config else config_data.get('vatNumber', ''),
+        "deviceBranchName": device_config.device_branch_name if device_config else config_data.get('deviceBranchName', ''),
+        "deviceBranchAddress": {
+            "province": device_config.device_branch_address_province if device_config else config_data.get('deviceBranchAddress', {}).get('province', ''),
+            "city": device_config.device_branch_address_city if device_config else config_data.get('deviceBranchAddress', {}).get('city', ''),
+            "street": device_config.device_branch_address_street if device_config else config_data.get('deviceBranchAddress', {}).get('street', ''),
+            "houseNo": device_config.device_branch_address_house_no if device_config else config_data.get('deviceBranchAddress', {}).get('houseNo', '')
+        },
+        "deviceBranchContacts": {
+            "phoneNo": device_config.device_branch_contacts_phone_no if device_config else config_data.get('deviceBranchContacts', {}).get('phoneNo', ''),
+            "email": device_config.device_branch_contacts_email if device_config else config_data.get('deviceBranchContacts', {}).get('email', '')
+        },
+        "taxCode": "A",
+        "qrUrl": device_config.qr_url if device_config and device_config.qr_url else config_data.get('qrUrl', zimra_config.qr_url),
+        "deviceSerialNo": device_config.device_serial_no if device_config else config_data.get('deviceSerialNo', ''),
+        "receiptCounter": len(receipt_lines),
+        "receiptGlobalNo": global_number,
+        "fiscalDayNumber": str(fiscal_day_no),
+        "receiptID": zimra_response.get('receiptID', ''),
+        "invoiceNumber": updated_data['invoiceNo'],
+        "deviceID": str(device_id),
+        "date": receipt_date_print(),
+        "taxPercentage": "15",
+        "qrString": qr_string,
+        "verificationCode": verification_string,
+        # Include the calculated receipt data
+        "receiptTaxes": updated_data.get('receiptTaxes', []),
+        "receiptPayments": updated_data.get('receiptPayments', []),
+        "receiptTotal": updated_data.get('receiptTotal', 0),
+        "receiptLines": updated_data.get('receiptLines', [])
+    }
+    
+    # Stored with the invoice so a retried submission gets the same answer
+    update_data['request_hash'] = request_hash
+    update_data['idempotency_key'] = idempotency_key
+    update_data['fiscal_response'] = response_data
+    
+    return invoice_data, update_data, response_data
+
+
+def zimra_receipt_headers(device: DeviceInfo) -> dict:
+    """Build the SubmitReceipt request headers for a device"""
+    return {
+        "Content-Type": "application/json",
+        "Accept": "application/json",
+        "DeviceModelName": device.model_name,
+        "DeviceModelVersion": device.model_version
+    }
+
+
+def queued_receipt_response(entry: FiscalizationOutbox) -> dict:
+    """Build the 202 response body of a receipt queued with submit_receipt?async=true"""
+    return {
+        "status": entry.status,
+        "trackingID": entry.tracking_id,
+        "statusUrl": f"/api/fiscalization/{entry.tracking_id}",
+        "invoiceNumber": entry.invoice_id,
+        "receiptGlobalNo": entry.receipt_global_no,
+        "fiscalDayNumber": str(entry.fiscal_day_no),
+        "receiptTotal": json.loads(entry.payload).get('receiptTotal', 0)
+    }
+
+
+def duplicate_invoice_response(device_id: str, invoice_number: str):
+    """Reject a submission whose invoice number was already used with a different receipt"""
+    existing_invoice_info = get_existing_invoice_info(device_id=str(device_id), invoice_id=invoice_number)
+    return jsonify({
+        "error": "Duplicate Invoice Detected",
+        "message": f"Invoice number '{invoice_number}' already exists for device '{device_id}'",
+        "device_id": device_id,
+        "invoice_number": invoice_number,
+        "details": "Duplicate prevention: Invoice number and device ID combination must be unique",
+        "existing_invoice": {
+            "receipt_type": existing_invoice_info.get("receipt_type"),
+            "receipt_total": existing_invoice_info.get("receipt_total"),
+            "is_fiscalized": existing_invoice_info.get("is_fiscalized"),
+            "created_at": existing_invoice_info.get("created_at"),
+            "zimra_receipt_number": existing_invoice_info.get("zimra_receipt_number"),
+            "fiscal_day_number": existing_invoice_info.get("fiscal_day_number")
+        }
+    }), 400
+
+
 @api.route('/submit_receipt/<device_id>', methods=['POST'])
 def submit_receipt(device_id):
     try:
+        # Accept-then-fiscalize mode: ?async=true, or ZIMRA_ASYNC_FISCALIZATION=true by default
+        async_mode = is_async_fiscalization_requested()
+        
         # 1. Read and validate posted JSON
         posted_data = request.get_json()
         #current_app.logger.debug(f"Received SubmitReceipt payload: {posted_data}")
@@ -562,396 +943,683 @@ def submit_receipt(device_id):
         else:
             receipt_data = posted_data
         
-        # Validate required fields in receipt data
-        required_fields = ["invoiceNo", "receiptDate", "receiptType", "receiptTotal"]
-        for field in required_fields:
-            if field not in receipt_data:
-                return jsonify({"error": f"Missing required field: {field}"}), 400
-        
-        # Validate credit/debit note specific fields
-        if receipt_data.get('creditDebitNote') is not None:
-            if 'receiptID' not in receipt_data['creditDebitNote']:
-                return jsonify({"error": "Credit/Debit note must include receiptID in creditDebitNote"}), 400
-            if not receipt_data.get('receiptNotes'):
-                return jsonify({"error": "Credit/Debit note must include receiptNotes"}), 400
+        with timing_span('validate'):
+            validation_error = validate_receipt_data(receipt_data)
+        if validation_error:
+            return jsonify({"error": validation_error}), 400
 
         # 2. Load device config
-        device = DeviceInfo.query.filter_by(device_id=str(device_id)).first()
+        with timing_span('device'):
+            device = get_cached_device(device_id)
         if not device:
             return jsonify({"error": "Device not found"}), 404
 
+        # Replay a retried submission from its stored response, without FDMS.
+        # The fingerprint is taken before prepare_receipt_data rewrites the lines.
+        invoice_number = str(receipt_data["invoiceNo"])
+        idempotency_key = request.headers.get('Idempotency-Key')
+        with timing_span('replay'):
+            request_hash = receipt_request_hash(receipt_data)
+            previous = find_fiscalized_receipt(device_id, invoice_number, idempotency_key)
+        if previous:
+            if previous['invoice_id'] != invoice_number:
+                return jsonify({
+                    "error": "Idempotency-Key already used",
+                    "message": f"Idempotency-Key '{idempotency_key}' was used for invoice '{previous['invoice_id']}'",
+                    "device_id": device_id,
+                    "invoice_number": invoice_number
+                }), 422
+            if previous['response'] is not None and previous['request_hash'] == request_hash:
+                current_app.logger.debug(f"Replaying stored response for invoice {invoice_number}")
+                return jsonify(previous['response']), 200, {"Idempotent-Replayed": "true"}
+            return duplicate_invoice_response(device_id, invoice_number)
+
         cert_path = device.certificate_path
         key_path = device.key_path
 
         # 3. Get the last fiscal day (open or closed)
-        last_fiscal_day = FiscalDay.query.filter_by(device_id=device.device_id).order_by(FiscalDay.id.desc()).first()
+        with timing_span('fiscal_day'):
+            last_fiscal_day = FiscalDay.query.filter_by(device_id=device.device_id).order_by(FiscalDay.id.desc()).first()
         if not last_fiscal_day:
             return jsonify({"error": "No fiscal day found for this device"}), 404
 
-        # 4. Check for duplicate invoice
-        invoice_number = str(receipt_data["invoiceNo"])
-        existing_invoice_info = get_existing_invoice_info(device_id=str(device_id), invoice_id=invoice_number)
-        
-        if existing_invoice_info["exists"]:
+        # Offline mode signs and stores the receipt locally for a later SubmitFile upload.
+        # It stays on while offline receipts are waiting, so online receipts cannot overtake them.
+        with timing_span('queue'):
+            offline_mode = is_offline_fiscalization_requested(device_id)
+            queue_blocked = (offline_mode or not async_mode) and has_open_entries(device_id)
+
+        # Queued receipts are chained ahead of ZIMRA; a direct or offline submission must not overtake them
+        if queue_blocked:
+            return jsonify({
+                "error": "Receipts are queued for asynchronous fiscalization on this device",
+                "details": "Submit with ?async=true or retry once the queue has been delivered"
+            }), 409
+
+        # 4. Check for a queued submission of the same invoice; a retry of it gets its 202 again
+        with timing_span('queue'):
+            queued_entry = get_open_entry(device_id, invoice_number, idempotency_key)
+        if queued_entry:
+            if queued_entry.invoice_id != invoice_number:
+                return jsonify({
+                    "error": "Idempotency-Key already used",
+                    "message": f"Idempotency-Key '{idempotency_key}' was used for invoice '{queued_entry.invoice_id}'",
+                    "device_id": device_id,
+                    "invoice_number": invoice_number
+                }), 422
+            if queued_entry.request_hash == request_hash:
+                return jsonify(queued_receipt_response(queued_entry)), 202, {"Idempotent-Replayed": "true"}
             return jsonify({
                 "error": "Duplicate Invoice Detected",
-                "message": f"Invoice number '{invoice_number}' already exists for device '{device_id}'",
-                "device_id": device_id,
-                "invoice_number": invoice_number,
-                "details": "Duplicate prevention: Invoice number and device ID combination must be unique",
-                "existing_invoice": {
-                    "receipt_type": existing_invoice_info.get("receipt_type"),
-                    "receipt_total": existing_invoice_info.get("receipt_total"),
-                    "is_fiscalized": existing_invoice_info.get("is_fiscalized"),
-                    "created_at": existing_invoice_info.get("created_at"),
-                    "zimra_receipt_number": existing_invoice_info.get("zimra_receipt_number"),
-                    "fiscal_day_number": existing_invoice_info.get("fiscal_day_number")
-                }
+                "message": f"Invoice number '{invoice_number}' is already queued for device '{device_id}'",
+                "tracking_id": queued_entry.tracking_id,
+                "status": queued_entry.status
             }), 400
 
-        # 5. Calculate counters and get previous hash
-        formatted_datetime = get_submit_receipt_date()
+        # 5. Calculate date, counters, taxes, total and payments
+        with timing_span('prepare'):
+            prepared = prepare_receipt_data(receipt_data)
+        updated_data = prepared['updated_data']
+        is_credit_note = prepared['is_credit_note']
+        is_debit_note = prepared['is_debit_note']
         previous_receipt_hash = ''
 
-        counter = get_fiscal_day_counter(
-            device_id=str(device_id),
-            fiscal_open_date_time=get_fiscal_day_open_date_time(
-                open_day_date_time=last_fiscal_day.fiscal_day_open
-            )
-        )
-
-        if counter > 0:
-            previous_receipt_hash = get_previous_hash(
-                device_id=str(device_id),
-                fiscal_open_date_time=get_fiscal_day_open_date_time(
-                    open_day_date_time=last_fiscal_day.fiscal_day_open
-                )
-            )
-
-        # 6. Update receipt data with calculated values
-        updated_data = receipt_data.copy()
-        updated_data['receiptDate'] = formatted_datetime
-        
-       
-  
-        
-        # Set receiptCounter to the number of line items in the current invoice
-        receipt_lines = updated_data.get('receiptLines', [])
-        updated_data['receiptCounter'] = len(receipt_lines)
-        
-        # Check if this is a credit/debit note and handle receipt lines
-        is_credit_debit_note = updated_data.get('creditDebitNote') is not None
-        is_credit_note = False
-        is_debit_note = False
-        
-        if is_credit_debit_note:
-            # Determine if it's a credit note or debit note based on receiptType
-            receipt_type = updated_data.get('receiptType', '').lower()
-            if 'credit' in receipt_type:
-                is_credit_note = True
-            elif 'debit' in receipt_type:
-                is_debit_note = True
-            else:
-                # Default to credit note if receiptType is not specified
-                is_credit_note = True
-        
-        if is_credit_note:
-            # For credit notes, make all monetary values in receipt lines negative
-            for line in receipt_lines:
-                if 'receiptLinePrice' in line:
-                    line['receiptLinePrice'] = -abs(line['receiptLinePrice'])
-                if 'receiptLineTotal' in line:
-                    line['receiptLineTotal'] = -abs(line['receiptLineTotal'])
-        elif is_debit_note:
-            # For debit notes, ensure all monetary values in receipt lines are positive
-            for line in receipt_lines:
-                if 'receiptLinePrice' in line:
-                    line['receiptLinePrice'] = abs(line['receiptLinePrice'])
-                if 'receiptLineTotal' in line:
-                    line['receiptLineTotal'] = abs(line['receiptLineTotal'])
-
-        # Auto-generate global number
+        # 6. Auto-generate global number
         from utils.invoice_utils import increment_global_number
-        global_number = increment_global_number(str(device_id))
+        with timing_span('counters'):
+            global_number = increment_global_number(str(device_id))
         if global_number < 0:
             return jsonify({"error": "Global Value cannot be negative"}), 400
         current_app.logger.debug(f"Auto-generated global number: {global_number}")
         
         updated_data['receiptGlobalNo'] = global_number
 
-        # 7. Calculate tax summary with enhanced logic
-        tax_summary = calculate_tax_summary(updated_data.get('receiptLines', []))
+        # Read the fiscal day's hash-chain head (last hash and receipt count).
+        # This happens after the global number allocation, whose row lock keeps
+        # concurrent receipts for the same device from chaining off the same head.
+        with timing_span('counters'):
+            chain_head = get_chain_head(
+                device_id=str(device_id),
+                fiscal_day_no=last_fiscal_day.fiscal_day_no
+            )
+
+        if chain_head and chain_head.receipt_counter > 0:
+            previous_receipt_hash = chain_head.last_hash or ''
+
+        # 7. Sign the receipt, chained to the previous receipt's hash
+        with timing_span('sign'):
+            private_key = get_device_private_key(device_id, key_path)
+            sign_receipt_data(device_id, prepared, previous_receipt_hash, private_key)
         
-        # Create tax objects based on actual tax codes used in receipt lines
-        filtered_taxes = []
+        if offline_mode:
+            return store_receipt_offline(device_id, updated_data, last_fiscal_day.fiscal_day_no,
+                                         request_hash, idempotency_key)
         
-        # Map tax codes to their proper structure using configuration
-        tax_mapping = zimra_config.get_tax_mapping()
+        if async_mode:
+            # Queue the signed receipt; the chain head moves now so the next receipt chains off it
+            entry = enqueue_receipt(device_id, last_fiscal_day.fiscal_day_no, updated_data,
+                                    request_hash, idempotency_key)
+            advance_chain_head(
+                device_id=str(device_id),
+                fiscal_day_no=last_fiscal_day.fiscal_day_no,
+                hash_string=updated_data['receiptDeviceSignature']['hash'],
+                receipt_global_no=global_number
+            )
+            db.session.commit()
+            outbox_dispatcher.wake()
+            
+            return jsonify(queued_receipt_response(entry)), 202
         
-        # Check if this is a credit/debit note
-        is_credit_debit_note = updated_data.get('creditDebitNote') is not None
-        is_credit_note = False
-        is_debit_note = False
+        # 8. Prepare full payload
+        full_payload = {
+            "receipt": updated_data
+        }
         
-        if is_credit_debit_note:
-            # Determine if it's a credit note or debit note based on receiptType
-            receipt_type = updated_data.get('receiptType', '').lower()
-            if 'credit' in receipt_type:
-                is_credit_note = True
-            elif 'debit' in receipt_type:
-                is_debit_note = True
-            else:
-                # Default to credit note if receiptType is not specified
-                is_credit_note = True
-        
-        # Add tax objects for each tax code that has sales
-        for tax_code, tax_data in tax_summary.items():
-            if abs(tax_data['salesAmountWithTax']) > 0:  # Include taxes with non-zero sales (positive or negative)
-                tax_object = {
-                    'taxCode': tax_data['taxCode'],
-                    'taxID': tax_data['taxID'],
-                    'taxAmount': tax_data['taxAmount'],
-                    'salesAmountWithTax': tax_data['salesAmountWithTax']
-                }
-                
-                # For credit notes, make all monetary values negative
-                if is_credit_note:
-                    tax_object['taxAmount'] = -abs(tax_data['taxAmount'])
-                    tax_object['salesAmountWithTax'] = -abs(tax_data['salesAmountWithTax'])
-                # For debit notes, ensure all monetary values are positive
-                elif is_debit_note:
-                    tax_object['taxAmount'] = abs(tax_data['taxAmount'])
-                    tax_object['salesAmountWithTax'] = abs(tax_data['salesAmountWithTax'])
-                
-                # Add taxPercent only for non-exempt items
-                if not zimra_config.is_exempt_tax_id(tax_data['taxID']):
-                    tax_object['taxPercent'] = tax_data['taxPercent']
-                
-                filtered_taxes.append(tax_object)
+        # 9. Get pooled secure session with ZIMRA
+        session = get_fdms_session(device_id, cert_path, key_path)
+        headers = zimra_receipt_headers(device)
 
-        # Calculate total
-        receipt_total = calculate_total_sales_amount_with_tax(filtered_taxes)
+        # 10. Send request to ZIMRA
+        url = zimra_config.get_api_url(device_id, "SubmitReceipt")
         
-        # For credit notes, ensure total is negative
+        # Debug: Log the calculated values before sending
+        current_app.logger.debug(f"Calculated receiptTotal: {updated_data.get('receiptTotal')}")
+        current_app.logger.debug(f"Calculated receiptTaxes: {updated_data.get('receiptTaxes')}")
+        current_app.logger.debug(f"Calculated receiptPayments: {updated_data.get('receiptPayments')}")
         if is_credit_note:
-            receipt_total = -abs(receipt_total)
-        # For debit notes, ensure total is positive
+            current_app.logger.debug(f"Processing as Credit Note - all monetary values are negative")
         elif is_debit_note:
-            receipt_total = abs(receipt_total)
+            current_app.logger.debug(f"Processing as Debit Note - all monetary values are positive")
+        
+        json_data = json.dumps(full_payload)
+        current_app.logger.debug(f"SubmitReceipt Payload: {json_data}")
+        #return jsonify(json_data), 200
+        try:
+            with timing_span('fdms'):
+                response = session.post(url, data=json_data, headers=headers, verify=False)
+        except requests.ConnectionError as e:
+            # FDMS unreachable: fall back to offline fiscalization instead of failing the sale
+            if not is_offline_fallback_enabled():
+                raise
+            current_app.logger.warning(f"FDMS unreachable, storing receipt {updated_data['invoiceNo']} offline: {e}")
+            return store_receipt_offline(device_id, updated_data, last_fiscal_day.fiscal_day_no,
+                                         request_hash, idempotency_key)
+        #current_app.logger.debug(f"ZIMRA SubmitReceipt status: {json_data}")
         
-        # Ensure receiptPayments has the proper structure
-        if 'receiptPayments' not in updated_data or not updated_data['receiptPayments']:
-            updated_data['receiptPayments'] = [{'moneyTypeCode': 'Cash', 'paymentAmount': receipt_total}]
+        # 11. Process successful response
+        if response.status_code == 200:
+            zimra_response = response.json()
+            current_app.logger.debug(f"ZIMRA Response: {zimra_response}")
+            
+            try:
+                with timing_span('persist'):
+                    # Get device configuration from the device cache
+                    device_config = get_cached_device_configuration(device_id)
+                    config_data = get_device_config(str(device_id))
+                    
+                    invoice_data, update_data, response_data = build_fiscalized_receipt(
+                        device_id, updated_data, last_fiscal_day.fiscal_day_no,
+                        zimra_response, device_config, config_data, request_hash, idempotency_key
+                    )
+                
+                current_app.logger.debug(f"#################################################")
+                current_app.logger.debug(f"ZIMRA Response: {update_data['verification_number']}")
+                current_app.logger.debug(f"#################################################")
+                
+                # Insert the fiscalized invoice, line items, address and contact in one transaction
+                with timing_span('persist'):
+                    invoice = save_fiscalized_invoices([(invoice_data, update_data)])[0]
+                    db.session.commit()
+                current_app.logger.debug(f"Saved invoice {invoice.invoice_id} as id {invoice.id}")
+                receipt_replay_cache.put(device_id, invoice_number, request_hash, response_data, idempotency_key)
+                prerender_invoice_pdfs(current_app._get_current_object(), [invoice.invoice_id])
+                
+                return jsonify(response_data), 200
+                
+            except Exception as e:
+                db.session.rollback()
+                current_app.logger.error(
+                    f"Error saving receipt {updated_data['invoiceNo']} accepted by ZIMRA "
+                    f"(receiptID {zimra_response.get('receiptID')}): {str(e)}"
+                )
+                return jsonify({"error": "Database operation failed", "details": str(e)}), 500
         else:
-            # Update the first payment method with the calculated total
-            updated_data['receiptPayments'][0]['paymentAmount'] = receipt_total
+            # Roll back to release the global number reserved for this receipt
+            db.session.rollback()
+            try:
+                error_data = response.json()
+                current_app.logger.debug(f"ZIMRA Error Response: {error_data}")
+                return jsonify({"error": "ZIMRA request failed", "status_code": response.status_code, "details": error_data}), response.status_code
+            except:
+                current_app.logger.debug(f"ZIMRA Error Response (raw): {response.content}")
+                return jsonify({"error": "ZIMRA request failed", "status_code": response.status_code}), response.status_code
+
+    except Exception as e:
+        db.session.rollback()
+        error_details = {
+            "error_type": type(e).__name__,
+            "error_message": str(e),
+            "traceback": format_exc()
+        }
+        return jsonify(error_details), 500
+
+
+@api.route('/submit_receipts/<device_id>', methods=['POST'])
+def submit_receipts(device_id):
+    """
+    Submit an ordered batch of receipts for a device, e.g. when a POS replays its backlog.
+    
+    All receipts are validated before anything is allocated. Global numbers for the whole
+    batch are reserved in one step, the receipts are chained and signed in order, then
+    submitted to ZIMRA one after another over the device's pooled connection. Submission
+    stops at the first receipt ZIMRA rejects, since every later receipt is chained to it;
+    the unused global numbers are given back. Accepted receipts are bulk-inserted in a
+    single transaction.
+    
+    Parameters:
+        device_id (str): Device identifier (path parameter)
         
-        updated_data['receiptTotal'] = receipt_total
-        updated_data['receiptTaxes'] = filtered_taxes
+    Request body:
+        {"receipts": [<receipt>, ...]} or a plain list; each entry may be nested under "receipt"
+        
+    Returns:
+        JSON response with one result per receipt, in request order
+    """
+    try:
+        # 1. Read and validate the whole batch before allocating anything
+        posted_data = request.get_json()
+        receipts = posted_data.get('receipts') if isinstance(posted_data, dict) else posted_data
+        
+        if not isinstance(receipts, list) or not receipts:
+            return jsonify({"error": "Request must contain a non-empty 'receipts' list"}), 400
+        
+        max_batch_size = int(os.environ.get('ZIMRA_MAX_BATCH_RECEIPTS', '100'))
+        if len(receipts) > max_batch_size:
+            return jsonify({"error": f"Batch too large: {len(receipts)} receipts (maximum {max_batch_size})"}), 400
+        
+        receipts_data = [
+            receipt["receipt"] if isinstance(receipt, dict) and "receipt" in receipt else receipt
+            for receipt in receipts
+        ]
+        
+        validation_errors = []
+        seen_invoice_numbers = set()
+        for index, receipt_data in enumerate(receipts_data):
+            if not isinstance(receipt_data, dict):
+                validation_errors.append({"index": index, "error": "Receipt must be an object"})
+                continue
+            validation_error = validate_receipt_data(receipt_data)
+            if validation_error:
+                validation_errors.append({"index": index, "invoiceNo": receipt_data.get("invoiceNo"), "error": validation_error})
+                continue
+            invoice_number = str(receipt_data["invoiceNo"])
+            if invoice_number in seen_invoice_numbers:
+                validation_errors.append({"index": index, "invoiceNo": invoice_number, "error": "Invoice number repeated in batch"})
+            seen_invoice_numbers.add(invoice_number)
+        
+        if validation_errors:
+            return jsonify({"error": "Batch validation failed", "results": validation_errors}), 400
+
+        # 2. Load device config and the last fiscal day (open or closed)
+        device = get_cached_device(device_id)
+        if not device:
+            return jsonify({"error": "Device not found"}), 404
 
-        # 8. Generate string to sign with previous hash if available using new method
-        string_to_sign = generator_invoice_string(str(device_id), updated_data, filtered_taxes)
+        last_fiscal_day = FiscalDay.query.filter_by(device_id=device.device_id).order_by(FiscalDay.id.desc()).first()
+        if not last_fiscal_day:
+            return jsonify({"error": "No fiscal day found for this device"}), 404
 
-        if previous_receipt_hash != '':
-            string_to_sign = string_to_sign + str(previous_receipt_hash)
+        # Queued or offline receipts are chained ahead of ZIMRA; a batch must not overtake them
+        if has_open_entries(device_id) or has_pending_offline_receipts(device_id):
+            return jsonify({
+                "error": "Receipts are waiting for asynchronous or offline fiscalization on this device",
+                "details": "Retry once the queue has been delivered and offline receipts uploaded"
+            }), 409
+
+        # 3. Check every invoice number for duplicates in one query
+        existing_numbers = {
+            invoice_id for (invoice_id,) in db.session.query(Invoice.invoice_id).filter(
+                Invoice.device_id == str(device_id),
+                Invoice.invoice_id.in_(seen_invoice_numbers)
+            ).all()
+        }
+        if existing_numbers:
+            return jsonify({
+                "error": "Duplicate Invoice Detected",
+                "message": f"Invoice numbers already exist for device '{device_id}'",
+                "device_id": device_id,
+                "invoice_numbers": sorted(existing_numbers),
+                "details": "Duplicate prevention: Invoice number and device ID combination must be unique"
+            }), 400
 
+        # 4. Prepare every receipt, reserve the batch's global numbers and chain the signatures
+        request_hashes = [receipt_request_hash(receipt_data) for receipt_data in receipts_data]
+        prepared_receipts = [prepare_receipt_data(receipt_data) for receipt_data in receipts_data]
+        
+        from utils.global_number_allocator import global_number_allocator
+        first_global_number = global_number_allocator.reserve(str(device_id), count=len(prepared_receipts))
+        current_app.logger.debug(
+            f"Reserved global numbers {first_global_number}-{first_global_number + len(prepared_receipts) - 1}"
+        )
 
-        # 9. Generate signature using ReceiptDeviceSignature class
-        private_key = read_pem_file(key_path)
-        receipt_device_signature_obj = ReceiptDeviceSignature(string_to_sign, private_key)
+        chain_head = get_chain_head(
+            device_id=str(device_id),
+            fiscal_day_no=last_fiscal_day.fiscal_day_no
+        )
+        previous_receipt_hash = ''
+        if chain_head and chain_head.receipt_counter > 0:
+            previous_receipt_hash = chain_head.last_hash or ''
+
+        private_key = get_device_private_key(device_id, device.key_path)
+        for offset, prepared in enumerate(prepared_receipts):
+            prepared['updated_data']['receiptGlobalNo'] = first_global_number + offset
+            receipt_device_signature_obj = sign_receipt_data(device_id, prepared, previous_receipt_hash, private_key)
+            previous_receipt_hash = receipt_device_signature_obj.get_hash()
+
+        # 5. Submit in order over the device's pooled session, stopping at the first rejection
+        session = get_fdms_session(device_id, device.certificate_path, device.key_path)
+        headers = zimra_receipt_headers(device)
+        url = zimra_config.get_api_url(device_id, "SubmitReceipt")
+        
+        accepted = []
+        failure = None
+        # Set when ZIMRA may have taken the receipt that failed (timeout after sending, unreadable 200)
+        unconfirmed = False
+        for prepared in prepared_receipts:
+            json_data = json.dumps({"receipt": prepared['updated_data']})
+            try:
+                response = session.post(url, data=json_data, headers=headers, verify=False)
+            except requests.RequestException as e:
+                # Keep the receipts ZIMRA already accepted; stop at the one that failed.
+                # Only a connect timeout proves the receipt never reached ZIMRA.
+                current_app.logger.error(f"SubmitReceipt request failed: {e}")
+                failure = {"status_code": None, "details": str(e)}
+                unconfirmed = not isinstance(e, requests.ConnectTimeout)
+                break
+            if response.status_code != 200:
+                try:
+                    details = response.json()
+                except ValueError:
+                    details = None
+                current_app.logger.debug(f"ZIMRA Error Response: {details or response.content}")
+                failure = {"status_code": response.status_code, "details": details}
+                break
+            try:
+                accepted.append(response.json())
+            except ValueError as e:
+                current_app.logger.error(f"Unreadable SubmitReceipt response: {e}")
+                failure = {"status_code": response.status_code, "details": f"Unreadable response: {e}"}
+                unconfirmed = True
+                break
+
+        # Give back the global numbers of receipts that were not accepted; an unconfirmed
+        # receipt keeps its number until it is reconciled with ZIMRA
+        last_used = first_global_number + len(accepted) - 1 + (1 if unconfirmed else 0)
+        if last_used < first_global_number + len(prepared_receipts) - 1:
+            global_number_allocator.release(str(device_id), last_used)
+
+        # 6. Bulk-insert the accepted receipts in one transaction
+        device_config = get_cached_device_configuration(device_id)
+        config_data = get_device_config(str(device_id))
+        
+        records = []
+        results = []
+        for offset, zimra_response in enumerate(accepted):
+            invoice_data, update_data, response_data = build_fiscalized_receipt(
+                device_id, prepared_receipts[offset]['updated_data'], last_fiscal_day.fiscal_day_no,
+                zimra_response, device_config, config_data, request_hashes[offset]
+            )
+            records.append((invoice_data, update_data))
+            results.append({"index": offset, "status": "fiscalized", "receipt": response_data})
+        
+        if records:
+            save_fiscalized_invoices(records)
+        db.session.commit()
+        for offset, (invoice_data, update_data) in enumerate(records):
+            receipt_replay_cache.put(device_id, invoice_data['invoice_id'], request_hashes[offset], update_data['fiscal_response'])
+        prerender_invoice_pdfs(
+            current_app._get_current_object(), [invoice_data['invoice_id'] for invoice_data, _ in records]
+        )
         
-        receipt_device_signature_obj_data = {
-            "hash": receipt_device_signature_obj.get_hash(),
-            "signature": receipt_device_signature_obj.sign_data()
+        # 7. Report the rejected (or unconfirmed) receipt and the ones that were not sent after it
+        for offset in range(len(accepted), len(prepared_receipts)):
+            invoice_number = prepared_receipts[offset]['updated_data']['invoiceNo']
+            if offset == len(accepted) and unconfirmed:
+                updated_data = prepared_receipts[offset]['updated_data']
+                results.append({"index": offset, "invoiceNo": invoice_number, "status": "unconfirmed",
+                                "error": "ZIMRA may have accepted this receipt; reconcile it before resubmitting",
+                                "receipt": updated_data, **failure})
+            elif offset == len(accepted):
+                results.append({"index": offset, "invoiceNo": invoice_number, "status": "rejected",
+                                "error": "ZIMRA request failed", **failure})
+            else:
+                results.append({"index": offset, "invoiceNo": invoice_number, "status": "not_submitted",
+                                "error": "Not submitted after an earlier receipt was rejected"})
+        
+        all_fiscalized = len(accepted) == len(prepared_receipts)
+        return jsonify({
+            "success": all_fiscalized,
+            "device_id": str(device_id),
+            "fiscal_day_no": last_fiscal_day.fiscal_day_no,
+            "submitted": len(accepted),
+            "total": len(prepared_receipts),
+            "results": results
+        }), 200 if all_fiscalized else 207
+
+    except Exception as e:
+        db.session.rollback()
+        error_details = {
+            "error_type": type(e).__name__,
+            "error_message": str(e),
+            "traceback": format_exc()
         }
+        current_app.logger.error(f"Batch submit receipts error: {error_details}")
+        return jsonify(error_details), 500
+
+
+def is_async_fiscalization_requested() -> bool:
+    """Check whether this submission should be queued instead of sent to ZIMRA inline"""
+    default = os.environ.get('ZIMRA_ASYNC_FISCALIZATION', 'false')
+    return request.args.get('async', default).lower() in ('1', 'true', 'yes')
+
+
+def is_offline_fiscalization_requested(device_id: str) -> bool:
+    """
+    Check whether a receipt for this device must be fiscalized offline.
+    
+    True for ?offline=true, ZIMRA_OFFLINE_MODE=true, a device whose operating mode is
+    Offline, or a device that still has offline receipts waiting to be uploaded.
+    """
+    if request.args.get('offline', 'false').lower() in ('1', 'true', 'yes') or is_offline_mode_forced():
+        return True
+    if has_pending_offline_receipts(device_id):
+        return True
+    device_config = get_cached_device_configuration(device_id)
+    return bool(device_config and (device_config.device_operating_mode or '').lower() == 'offline')
+
+
+def store_receipt_offline(device_id: str, updated_data: dict, fiscal_day_no: int,
+                          request_hash: str = None, idempotency_key: str = None):
+    """
+    Save a locally signed receipt as an invoice and keep it for SubmitFile upload.
+    
+    The receipt carries its QR code and verification code like an online receipt; the
+    chain head and fiscal day counters move with it. The invoice stays unfiscalized,
+    with no ZIMRA receipt number, until ZIMRA acknowledges the file carrying it.
+    Commits and returns the response.
+    """
+    device_config = get_cached_device_configuration(device_id)
+    config_data = get_device_config(str(device_id))
+    invoice_data, update_data, response_data = build_fiscalized_receipt(
+        device_id, updated_data, fiscal_day_no, {}, device_config, config_data, request_hash, idempotency_key
+    )
+    update_data['is_fiscalized'] = False
+    response_data['offline'] = True
+    invoices = save_fiscalized_invoices([(invoice_data, update_data)])
+    store_offline_receipt(invoices[0], updated_data)
+    db.session.commit()
+    # The dispatcher uploads the receipt once FDMS accepts files again
+    outbox_dispatcher.start()
+    
+    if request_hash:
+        receipt_replay_cache.put(device_id, updated_data['invoiceNo'], request_hash, response_data, idempotency_key)
+    return jsonify(response_data), 200
+
+
+@api.route('/offline/<device_id>', methods=['GET'])
+def get_offline_receipts_status(device_id):
+    """Get a device's pending and uploaded offline receipts and its recent SubmitFile uploads"""
+    device = get_cached_device(device_id)
+    if not device:
+        return jsonify({"error": "Device not found"}), 404
+    return jsonify(get_offline_status(device_id)), 200
+
+
+@api.route('/offline/<device_id>/upload', methods=['POST'])
+def upload_offline_receipts_route(device_id):
+    """
+    Upload a device's pending offline receipts to ZIMRA in SubmitFile batches.
+    
+    Query parameters:
+        batch_size (int, optional): Receipts per file (default ZIMRA_OFFLINE_BATCH_SIZE)
+        max_files (int, optional): Stop after this many files
         
-        # 11. Add signature to receipt data
-        updated_data['receiptDeviceSignature'] = receipt_device_signature_obj_data
+    Returns:
+        JSON response with the upload summary; 502 if ZIMRA stopped the upload
+    """
+    try:
+        batch_size = request.args.get('batch_size', type=int)
+        max_files = request.args.get('max_files', type=int)
+        result = upload_offline_receipts(device_id, batch_size=batch_size, max_files=max_files)
+        return jsonify(result), 200 if result['error'] is None else 502
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 404
+    except Exception as e:
+        db.session.rollback()
+        error_details = {
+            "error_type": type(e).__name__,
+            "error_message": str(e),
+            "traceback": format_exc()
+        }
+        current_app.logger.error(f"Offline upload error: {error_details}")
+        return jsonify(error_details), 500
+
+
+def _fleet_request_options() -> dict:
+    """Read the device list and concurrency of a fleet request from the JSON body or query string"""
+    data = request.get_json(silent=True) or {}
+    device_ids = data.get('device_ids')
+    if device_ids is None and request.args.get('device_id'):
+        device_ids = [d.strip() for d in request.args['device_id'].split(',') if d.strip()]
+    return {
+        'device_ids': [str(d) for d in device_ids] if device_ids else None,
+        'concurrency': data.get('concurrency', request.args.get('concurrency', type=int)),
+        'data': data
+    }
+
+
+@api.route('/fleet/openday', methods=['POST'])
+def fleet_open_day():
+    """
+    Open a fiscal day on many devices in parallel.
+    
+    Request body (optional):
+        device_ids (list): Devices to open (default: every registered device)
+        concurrency (int): Devices processed at once (default ZIMRA_FLEET_CONCURRENCY)
         
-        # 12. Prepare full payload
-        full_payload = {
-            "receipt": updated_data
+    Returns:
+        JSON fleet report; 200 when no device failed, 207 otherwise
+    """
+    try:
+        options = _fleet_request_options()
+        report = open_fleet_fiscal_days(options['device_ids'], concurrency=options['concurrency'])
+        return jsonify(report), 200 if report['failed'] == 0 else 207
+    except Exception as e:
+        db.session.rollback()
+        error_details = {
+            "error_type": type(e).__name__,
+            "error_message": str(e),
+            "traceback": format_exc()
         }
-        
-        # 13. Prepare secure session with ZIMRA
-        session = requests.Session()
-        session.cert = (cert_path, key_path)
+        current_app.logger.error(f"Fleet open day error: {error_details}")
+        return jsonify(error_details), 500
 
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "DeviceModelName": device.model_name,
-            "DeviceModelVersion": device.model_version
-        }
 
-        # 14. Send request to ZIMRA
-        url = zimra_config.get_api_url(device_id, "SubmitReceipt")
-        
-        # Debug: Log the calculated values before sending
-        current_app.logger.debug(f"Calculated receiptTotal: {updated_data.get('receiptTotal')}")
-        current_app.logger.debug(f"Calculated receiptTaxes: {updated_data.get('receiptTaxes')}")
-        current_app.logger.debug(f"Calculated receiptPayments: {updated_data.get('receiptPayments')}")
-        if is_credit_note:
-            current_app.logger.debug(f"Processing as Credit Note - all monetary values are negative")
-        elif is_debit_note:
-            current_app.logger.debug(f"Processing as Debit Note - all monetary values are positive")
-        
-        json_data = json.dumps(full_payload)
-        current_app.logger.debug(f"SubmitReceipt Payload: {json_data}")
-        #return jsonify(json_data), 200
-        response = session.post(url, data=json_data, headers=headers, verify=False)
-        #current_app.logger.debug(f"ZIMRA SubmitReceipt status: {json_data}")
+@api.route('/fleet/close_day', methods=['POST'])
+def fleet_close_day():
+    """
+    Generate counters, sign and submit CloseDay for many devices in parallel.
+    
+    Request body (optional):
+        device_ids (list): Devices to close (default: every registered device)
+        concurrency (int): Devices processed at once (default ZIMRA_FLEET_CONCURRENCY)
+        due_within_hours (float): Only close days whose taxPayerDayMaxHrs deadline falls within this many hours
+        dry_run (bool): Build and sign the payloads without submitting them
         
-        # 15. Process successful response
-        if response.status_code == 200:
-            zimra_response = response.json()
-            current_app.logger.debug(f"ZIMRA Response: {zimra_response}")
-            
-            try:
-                # Get device configuration from database
-                device_config = DeviceConfiguration.query.filter_by(device_id=str(device_id)).first()
-                config_data = get_device_config(str(device_id))
-                
-                # Create invoice data
-                invoice_data = {
-                    'invoice_id': updated_data['invoiceNo'],
-                    'device_id': str(device_id),
-                    'receipt_currency': updated_data.get('receiptCurrency', 'USD'),
-                    'money_type': 'Cash',
-                    'receipt_type': updated_data['receiptType'],
-                    'receipt_total': receipt_total,
-                    'line_items': updated_data.get('receiptLines', [])
-                }
-                
-                # Create invoice in database
-                created_invoice = create_invoice(invoice_data)
-                
-                # Generate QR code using stored QR URL from device config
-                qr_url = device_config.qr_url if device_config and device_config.qr_url else zimra_config.qr_url
-                qr_string = qr_string_generator(
-                    device_id=str(device_id),
-                    qr_url=qr_url,
-                    receipt_date=qr_date(),
-                    reciept_global_no=global_number,
-                    reciept_signature=receipt_device_signature_obj.sign_data()
-                )
-                
-                # Generate verification code
-                verification_string = base64_to_hex_md5(receipt_device_signature_obj.sign_data())
-
-                current_app.logger.debug(f"#################################################")
-                current_app.logger.debug(f"ZIMRA Response: {verification_string}")
-                current_app.logger.debug(f"#################################################")
-                
-                # Handle credit/debit note logic
-                debit_credit_note_invoice_ref = None
-                debit_credit_note_invoice_ref_date = None
-                
-                if updated_data.get('creditDebitNote') is not None:
-                    debited_credited_invoice = get_credit_debit_note_invoice(
-                        device_id=str(device_id),
-                        receipt_id=str(updated_data['creditDebitNote']['receiptID'])
-                    )
-                    
-                    if debited_credited_invoice:
-                        debit_credit_note_invoice_ref = debited_credited_invoice.invoice_id
-                        debit_credit_note_invoice_ref_date = debited_credited_invoice.timestamp
-                    else:
-                        debit_credit_note_invoice_ref = str(updated_data['creditDebitNote']['receiptID'])
-                
-                # Prepare update data using stored device configuration
-                update_data = {
-                    'invoice_id': updated_data['invoiceNo'],
-                    'zimra_receipt_number': str(zimra_response.get('receiptID', '')),
-                    'operation_id': str(zimra_response.get('operationID', '')),
-                    'qr_code_string': qr_string,
-                    'verification_number': verification_string,
-                    'hash_string': receipt_device_signature_obj.get_hash(),
-                    'is_fiscalized': True,
-                    'receipt_counter': len(receipt_lines),
-                    'receipt_global_no': global_number,
-                    'fiscal_day_number': str(last_fiscal_day.fiscal_day_no),
-                    'receipt_notes': updated_data.get('receiptNotes', ''),
-                    'tax_payer_name': device_config.tax_payer_name if device_config else config_data.get('taxPayerName', ''),
-                    'tax_payer_tin': str(device_config.tax_payer_tin if device_config else config_data.get('taxPayerTIN', '')),
-                    'vat_number': str(device_config.vat_number if device_config else config_data.get('vatNumber', '')),
-                    'device_branch_name': str(device_config.device_branch_name if device_config else config_data.get('deviceBranchName', '')),
-                    'device_branch_address': {
-                        'province': device_config.device_branch_address_province if device_config else config_data.get('deviceBranchAddress', {}).get('province', ''),
-                        'city': device_config.device_branch_address_city if device_config else config_data.get('deviceBranchAddress', {}).get('city', ''),
-                        'street': device_config.device_branch_address_street if device_config else config_data.get('deviceBranchAddress', {}).get('street', ''),
-                        'houseNo': device_config.device_branch_address_house_no if device_config else config_data.get('deviceBranchAddress', {}).get('houseNo', '')
-                    },
-                    'device_branch_contact': {
-                        'phoneNo': device_config.device_branch_contacts_phone_no if device_config else config_data.get('deviceBranchContacts', {}).get('phoneNo', ''),
-                        'email': device_config.device_branch_contacts_email if device_config else config_data.get('deviceBranchContacts', {}).get('email', '')
-                    },
-                    'debit_credit_note_invoice_ref': debit_credit_note_invoice_ref,
-                    'debit_credit_note_invoice_ref_date': debit_credit_note_invoice_ref_date
-                }
-                
-                # Update invoice with fiscalization data
-                update_fiscalized_invoice(update_data)
-                
-                # Prepare response data using stored device configuration
-                response_data = {
-                    "taxPayerName": device_config.tax_payer_name if device_config else config_data.get('taxPayerName', ''),
-                    "taxPayerTIN": device_config.tax_payer_tin if device_config else config_data.get('taxPayerTIN', ''),
-                    "vatNumber": device_config.vat_number if device_config else config_data.get('vatNumber', ''),
-                    "deviceBranchName": device_config.device_branch_name if device_config else config_data.get('deviceBranchName', ''),
-                    "deviceBranchAddress": {
-                        "province": device_config.device_branch_address_province if device_config else config_data.get('deviceBranchAddress', {}).get('province', ''),
-                        "city": device_config.device_branch_address_city if device_config else config_data.get('deviceBranchAddress', {}).get('city', ''),
-                        "street": device_config.device_branch_address_street if device_config else config_data.get('deviceBranchAddress', {}).get('street', ''),
-                        "houseNo": device_config.device_branch_address_house_no if device_config else config_data.get('deviceBranchAddress', {}).get('houseNo', '')
-                    },
-                    "deviceBranchContacts": {
-                        "phoneNo": device_config.device_branch_contacts_phone_no if device_config else config_data.get('deviceBranchContacts', {}).get('phoneNo', ''),
-                        "email": device_config.device_branch_contacts_email if device_config else config_data.get('deviceBranchContacts', {}).get('email', '')
-                    },
-                    "taxCode": "A",
-                    "qrUrl": device_config.qr_url if device_config and device_config.qr_url else config_data.get('qrUrl', zimra_config.qr_url),
-                    "deviceSerialNo": device_config.device_serial_no if device_config else config_data.get('deviceSerialNo', ''),
-                    "receiptCounter": len(receipt_lines),
-                    "receiptGlobalNo": global_number,
-                    "fiscalDayNumber": str(last_fiscal_day.fiscal_day_no),
-                    "receiptID": zimra_response.get('receiptID', ''),
-                    "invoiceNumber": updated_data['invoiceNo'],
-                    "deviceID": str(device_id),
-                    "date": receipt_date_print(),
-                    "taxPercentage": "15",
-                    "qrString": qr_string,
-                    "verificationCode": verification_string,
-                    # Include the calculated receipt data
-                    "receiptTaxes": updated_data.get('receiptTaxes', []),
-                    "receiptPayments": updated_data.get('receiptPayments', []),
-                    "receiptTotal": updated_data.get('receiptTotal', 0),
-                    "receiptLines": updated_data.get('receiptLines', [])
-                }
-                
-                return jsonify(response_data), 200
-                
-            except Exception as e:
-                current_app.logger.error(f"Error processing successful response: {str(e)}")
-                return jsonify({"error": "Database operation failed", "details": str(e)}), 500
-        else:
-            try:
-                error_data = response.json()
-                current_app.logger.debug(f"ZIMRA Error Response: {error_data}")
-                return jsonify({"error": "ZIMRA request failed", "status_code": response.status_code, "details": error_data}), response.status_code
-            except:
-                current_app.logger.debug(f"ZIMRA Error Response (raw): {response.content}")
-                return jsonify({"error": "ZIMRA request failed", "status_code": response.status_code}), response.status_code
-
+    Returns:
+        JSON fleet report; 200 when no device failed, 207 otherwise
+    """
+    try:
+        options = _fleet_request_options()
+        report = close_fleet_fiscal_days(
+            options['device_ids'],
+            concurrency=options['concurrency'],
+            due_within_hours=options['data'].get('due_within_hours'),
+            dry_run=bool(options['data'].get('dry_run', False))
+        )
+        return jsonify(report), 200 if report['failed'] == 0 else 207
     except Exception as e:
+        db.session.rollback()
         error_details = {
             "error_type": type(e).__name__,
             "error_message": str(e),
             "traceback": format_exc()
         }
+        current_app.logger.error(f"Fleet close day error: {error_details}")
         return jsonify(error_details), 500
 
 
+def deliver_outbox_receipt(entry) -> dict:
+    """
+    Send a queued receipt to ZIMRA and store the fiscalized invoice.
+    
+    Called by the outbox dispatcher inside an app context. A receipt that ZIMRA already
+    accepted on an earlier attempt is not sent again; only its invoice is stored.
+    
+    Parameters:
+        entry (FiscalizationOutbox): Claimed outbox entry
+        
+    Returns:
+        dict: Outcome with status 'fiscalized', 'retry' or 'rejected'
+    """
+    device = get_cached_device(entry.device_id)
+    if not device:
+        return {"status": "rejected", "error": "Device not found"}
+    
+    updated_data = json.loads(entry.payload)
+    
+    if entry.zimra_receipt_id is None:
+        session = get_fdms_session(entry.device_id, device.certificate_path, device.key_path)
+        url = zimra_config.get_api_url(entry.device_id, "SubmitReceipt")
+        try:
+            response = session.post(url, data=json.dumps({"receipt": updated_data}),
+                                    headers=zimra_receipt_headers(device), verify=False)
+        except requests.RequestException as e:
+            return {"status": "retry", "error": str(e)}
+        
+        if response.status_code != 200:
+            try:
+                details = response.json()
+            except ValueError:
+                details = response.text
+            error = {"status_code": response.status_code, "error": json.dumps(details)}
+            if response.status_code in (408, 429) or response.status_code >= 500:
+                return {"status": "retry", **error}
+            return {"status": "rejected", **error}
+        
+        # Record the acceptance before touching the invoice tables
+        zimra_response = response.json()
+        entry.zimra_receipt_id = str(zimra_response.get('receiptID', ''))
+        entry.zimra_response = json.dumps(zimra_response)
+        db.session.commit()
+    else:
+        zimra_response = json.loads(entry.zimra_response or '{}')
+    
+    device_config = get_cached_device_configuration(entry.device_id)
+    config_data = get_device_config(str(entry.device_id))
+    invoice_data, update_data, response_data = build_fiscalized_receipt(
+        entry.device_id, updated_data, entry.fiscal_day_no, zimra_response, device_config, config_data,
+        request_hash=entry.request_hash, idempotency_key=entry.idempotency_key
+    )
+    save_fiscalized_invoices([(invoice_data, update_data)], advance_chain=False)
+    
+    return {"status": "fiscalized", "status_code": 200, "response": response_data}
+
+
+@api.route('/fiscalization/<tracking_id>', methods=['GET'])
+def get_fiscalization_status(tracking_id):
+    """
+    Get the delivery status of a receipt queued with submit_receipt?async=true.
+    
+    Parameters:
+        tracking_id (str): Tracking ID returned with the 202 response
+        
+    Returns:
+        JSON response with the queue status; includes the receipt once fiscalized
+    """
+    entry = FiscalizationOutbox.query.filter_by(tracking_id=tracking_id).first()
+    if not entry:
+        return jsonify({"error": f"Unknown tracking ID: {tracking_id}"}), 404
+    
+    return jsonify(outbox_entry_to_dict(entry)), 200
+
+
+@api.route('/fiscalization/stats', methods=['GET'])
+def get_fiscalization_stats():
+    """Get outbox totals per status and the dispatcher state"""
+    return jsonify(outbox_dispatcher.stats()), 200
+
+
 def generate_receipt_string(device_id: str, receipt_number: str, receipt_date_time: str, 
                            receipt_amount: str, receipt_tax_amount: str, receipt_total_amount: str) -> str:
     """
@@ -1110,12 +1778,10 @@ def add_leading_zeros_zfill(number, target_length) -> str:
 def get_config(device_id):
     try:
         # Retrieve device configuration
-        device = DeviceInfo.query.filter_by(device_id=str(device_id)).first()
-
         device_config = get_device_config(device_id)
         cert_path = device_config["certificate"]
         key_path = device_config["key"]
-        device = DeviceInfo.query.filter_by(device_id=device_id).first()
+        device = get_cached_device(device_id)
         
         print("CloseDay Data ##########")
         print(certifi.where())
@@ -1125,9 +1791,8 @@ def get_config(device_id):
         # Debug: View private key if needed
         # current_app.logger.debug(read_pem_file(device.key_path))
 
-        # Set up session with client certificate and key
-        session = requests.Session()
-        session.cert = (cert_path, key_path)
+        # Get pooled session with client certificate and key
+        session = get_fdms_session(device_id, cert_path, key_path)
 
         # Define request headers
         headers = {
@@ -1214,10 +1879,24 @@ def get_config(device_id):
                     device_config_record.device_branch_contacts_phone_no = contacts.get('phoneNo')
                     device_config_record.device_branch_contacts_email = contacts.get('email')
             
+            # Point the configuration at a branch profile snapshot; a new version is
+            # only created when the address or contact changed
+            device_config_record.branch_profile_id = get_or_create_branch_profile(device_id, {
+                'province': device_config_record.device_branch_address_province,
+                'city': device_config_record.device_branch_address_city,
+                'street': device_config_record.device_branch_address_street,
+                'house_no': device_config_record.device_branch_address_house_no,
+                'email': device_config_record.device_branch_contacts_email,
+                'phone_number': device_config_record.device_branch_contacts_phone_no
+            }).id
+            
             # Save to database
             db.session.add(device_config_record)
             db.session.commit()
             
+            # Handlers read the configuration through the device cache
+            invalidate_device(device_id)
+            
             current_app.logger.info(f"Device configuration saved/updated for device_id: {device_id}")
             
             return jsonify(config_data), 200
@@ -1233,7 +1912,7 @@ def get_config(device_id):
 def get_stored_device_config(device_id):
     """Get stored device configuration from database"""
     try:
-        device_config = DeviceConfiguration.query.filter_by(device_id=str(device_id)).first()
+        device_config = get_cached_device_configuration(device_id)
         
         if not device_config:
             return jsonify({"error": "Device configuration not found"}), 404
@@ -1268,88 +1947,88 @@ def get_stored_device_config(device_id):
         return jsonify({"error": str(e)}), 500
 
 
+def apply_invoice_filters(query, args):
+    """
+    Apply the invoice listing filters (device_id, status, date_from, date_to) to a query.
+    
+    Shared by the paginated listing and the export, so both select the same invoices.
+    """
+    device_id = args.get('device_id')
+    status = args.get('status')  # fiscalized, pending
+    date_from = args.get('date_from')
+    date_to = args.get('date_to')
+    
+    if device_id:
+        query = query.filter(Invoice.device_id == device_id)
+    
+    if status:
+        if status == 'fiscalized':
+            query = query.filter(Invoice.is_fiscalized.is_(True))
+        elif status == 'pending':
+            query = query.filter(Invoice.is_fiscalized.is_(False))
+    
+    if date_from:
+        query = query.filter(Invoice.created_at >= date_from)
+    
+    if date_to:
+        query = query.filter(Invoice.created_at <= date_to)
+    
+    return query
+
+
 @api.route('/invoices', methods=['GET'])
 def list_invoices():
-    """List all invoices with optional filtering"""
+    """
+    List invoices with optional filtering, newest first.
+    
+    Pages are cursor-based: pass the next_cursor of one response as cursor to get the
+    next page. The total is counted unless include_total=false. Requests with a page
+    parameter keep the older offset pagination.
+    """
     try:
         # Get query parameters
-        device_id = request.args.get('device_id')
-        page = int(request.args.get('page', 1))
-        per_page = int(request.args.get('per_page', 10))
-        status = request.args.get('status')  # fiscalized, pending
-        date_from = request.args.get('date_from')
-        date_to = request.args.get('date_to')
-        
-        # Build query
-        query = Invoice.query
-        
-        # Apply filters
-        if device_id:
-            query = query.filter_by(device_id=device_id)
-        
-        if status:
-            if status == 'fiscalized':
-                query = query.filter_by(is_fiscalized=True)
-            elif status == 'pending':
-                query = query.filter_by(is_fiscalized=False)
-        
-        if date_from:
-            query = query.filter(Invoice.created_at >= date_from)
-        
-        if date_to:
-            query = query.filter(Invoice.created_at <= date_to)
-        
-        # Order by creation date (newest first)
-        query = query.order_by(Invoice.created_at.desc())
-        
-        # Paginate results
-        pagination = query.paginate(
-            page=page, 
-            per_page=per_page, 
-            error_out=False
-        )
-        
-        invoices = pagination.items
-        
-        # Format response
-        invoice_list = []
-        for invoice in invoices:
-            invoice_data = {
-                'id': invoice.id,
-                'invoice_id': invoice.invoice_id,
-                'device_id': invoice.device_id,
-                'receipt_currency': invoice.receipt_currency,
-                'money_type': invoice.money_type,
-                'receipt_type': invoice.receipt_type,
-                'receipt_total': float(invoice.receipt_total),
-                'zimra_receipt_number': invoice.zimra_receipt_number,
-                'operation_id': invoice.operation_id,
-                'qr_code_string': invoice.qr_code_string,
-                'verification_number': invoice.verification_number,
-                'is_fiscalized': invoice.is_fiscalized,
-                'receipt_counter': invoice.receipt_counter,
-                'receipt_global_no': invoice.receipt_global_no,
-                'fiscal_day_number': invoice.fiscal_day_number,
-                'receipt_notes': invoice.receipt_notes,
-                'tax_payer_name': invoice.tax_payer_name,
-                'tax_payer_tin': invoice.tax_payer_tin,
-                'vat_number': invoice.vat_number,
-                'device_branch_name': invoice.device_branch_name,
-                'created_at': invoice.created_at.isoformat() if invoice.created_at else None,
-                'updated_at': invoice.updated_at.isoformat() if invoice.updated_at else None
-            }
-            invoice_list.append(invoice_data)
-        
-        response_data = {
-            'invoices': invoice_list,
-            'pagination': {
+        per_page = max(1, int(request.args.get('per_page', 10)))
+        cursor = request.args.get('cursor')
+        include_total = request.args.get('include_total', 'true').lower() not in ('false', '0', 'no')
+        
+        # Build query with the listing filters
+        query = apply_invoice_filters(Invoice.query, request.args)
+        
+        if 'page' in request.args and not cursor:
+            # Offset pagination, kept for existing clients
+            page = int(request.args.get('page', 1))
+            pagination = query.order_by(*LISTING_ORDER).paginate(
+                page=page, 
+                per_page=per_page, 
+                error_out=False,
+                count=include_total
+            )
+            invoices = pagination.items
+            pagination_data = {
                 'page': page,
                 'per_page': per_page,
                 'total': pagination.total,
-                'pages': pagination.pages,
+                'pages': pagination.pages if include_total else None,
                 'has_prev': pagination.has_prev,
-                'has_next': pagination.has_next
+                'has_next': pagination.has_next if include_total else len(invoices) == per_page
+            }
+        else:
+            try:
+                invoices, next_cursor = paginate_invoices_keyset(query, cursor, per_page)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            pagination_data = {
+                'per_page': per_page,
+                'cursor': cursor,
+                'next_cursor': next_cursor,
+                'has_prev': bool(cursor),
+                'has_next': next_cursor is not None,
+                'total': query.order_by(None).count() if include_total else None
             }
+        
+        response_data = {
+            'invoices': [serialize_invoice(invoice) for invoice in invoices],
+            'pagination': pagination_data
         }
         
         return jsonify(response_data), 200
@@ -1359,21 +2038,54 @@ def list_invoices():
         return jsonify({"error": "Failed to fetch invoices", "details": str(e)}), 500
 
 
+@api.route('/invoices/export', methods=['GET'])
+def export_invoices():
+    """
+    Stream invoices and their line items as CSV or JSONL.
+    
+    Takes the same filters as /invoices plus format=csv|jsonl (default csv). Rows are
+    read through a server-side cursor and written as they arrive, so memory use does
+    not grow with the size of the range. Invoices are exported oldest first.
+    """
+    try:
+        export_format = request.args.get('format', 'csv').lower()
+        if export_format not in ('csv', 'jsonl'):
+            return jsonify({"error": "format must be csv or jsonl"}), 400
+        
+        query = apply_invoice_filters(invoice_export_query(), request.args)
+        
+        if export_format == 'jsonl':
+            generator = stream_invoices_jsonl(query)
+            mimetype = 'application/x-ndjson'
+        else:
+            generator = stream_invoices_csv(query)
+            mimetype = 'text/csv'
+        
+        filename = f"invoices_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{export_format}"
+        return Response(
+            stream_with_context(generator),
+            mimetype=mimetype,
+            headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+        )
+        
+    except Exception as e:
+        current_app.logger.error(f"Error in export_invoices: {str(e)}")
+        return jsonify({"error": "Failed to export invoices", "details": str(e)}), 500
+
+
 @api.route('/invoices/<invoice_id>', methods=['GET'])
 def get_invoice(invoice_id):
     """Get a specific invoice with line items"""
     try:
-        invoice = Invoice.query.filter_by(invoice_id=invoice_id).first()
+        detail = assemble_invoice(invoice_id)
         
-        if not invoice:
+        if not detail:
             return jsonify({"error": "Invoice not found"}), 404
         
-        # Get line items
-        line_items = InvoiceLineItem.query.filter_by(invoice_id=invoice.id).all()
-        
-        # Get branch address and contact
-        branch_address = DeviceBranchAddress.query.filter_by(invoice_id=invoice.id).first()
-        branch_contact = DeviceBranchContact.query.filter_by(invoice_id=invoice.id).first()
+        invoice = detail.invoice
+        line_items = detail.line_items
+        branch_address = detail.branch_address
+        branch_contact = detail.branch_contact
         
         # Format line items
         line_items_data = []
@@ -1451,88 +2163,129 @@ def get_invoice(invoice_id):
 
 @api.route('/invoices/<invoice_id>/pdf', methods=['GET'])
 def download_invoice_pdf(invoice_id):
-    """Download invoice as PDF using A4 template format"""
+    """
+    Download invoice as PDF using A4 template format.
+    
+    Fiscalized invoices are served from the rendered PDF cache with an ETag, and a
+    matching If-None-Match is answered with 304 without reading the PDF.
+    """
     try:
-        invoice = Invoice.query.filter_by(invoice_id=invoice_id).first()
+        detail = assemble_invoice(invoice_id)
         
-        if not invoice:
+        if not detail:
             return jsonify({"error": "Invoice not found"}), 404
         
-        # Get line items
-        line_items = InvoiceLineItem.query.filter_by(invoice_id=invoice.id).all()
-        
-        # Get branch address and contact
-        branch_address = DeviceBranchAddress.query.filter_by(invoice_id=invoice.id).first()
-        branch_contact = DeviceBranchContact.query.filter_by(invoice_id=invoice.id).first()
-        
-        # Prepare invoice data for template
-        invoice_data = {
-            'invoice_id': invoice.invoice_id,
-            'zimra_receipt_number': invoice.zimra_receipt_number,
-            'device_id': invoice.device_id,
-            'created_at': invoice.created_at.strftime('%Y-%m-%d %H:%M:%S') if invoice.created_at else 'N/A',
-            'is_fiscalized': invoice.is_fiscalized,
-            'receipt_type': invoice.receipt_type,
-            'money_type': invoice.money_type,
-            'receipt_counter': invoice.receipt_counter,
-            'receipt_global_no': invoice.receipt_global_no,
-            'fiscal_day_number': invoice.fiscal_day_number,
-            'operation_id': invoice.operation_id,
-            'verification_number': invoice.verification_number,
-            'hash_string': invoice.hash_string,
-            'tax_payer_name': invoice.tax_payer_name,
-            'tax_payer_tin': invoice.tax_payer_tin,
-            'vat_number': invoice.vat_number,
-            'device_branch_name': invoice.device_branch_name,
-            'debit_credit_note_invoice_ref_date': invoice.debit_credit_note_invoice_ref_date.strftime('%Y-%m-%d %H:%M:%S') if invoice.debit_credit_note_invoice_ref_date else None,
-            'receipt_total': invoice.receipt_total,
-            'notes': invoice.receipt_notes,
-            'qr_code_url': invoice.qr_code_string,
-            'branch_address': f"{branch_address.street}, {branch_address.house_no}, {branch_address.city}, {branch_address.province}" if branch_address else None,
-            'branch_contact': f"Email: {branch_contact.email}, Phone: {branch_contact.phone_number}" if branch_contact else None,
-            'line_items': []
-        }
-        
-        # Add line items
-        for item in line_items:
-            invoice_data['line_items'].append({
-                'receipt_line_name': item.receipt_line_name,
-                'receipt_line_quantity': item.receipt_line_quantity,
-                'receipt_line_price': item.receipt_line_price,
-                'receipt_line_total': item.receipt_line_total,
-                'tax_code': item.tax_code,
-                'tax_percent': item.tax_percent,
-                'receipt_line_hs_code': item.receipt_line_hs_code,
-                'tax_id': item.tax_id
-            })
-        
-        # Import and use the A4 template
-        from invoice_template import generate_invoice_pdf_a4_format
+        invoice = detail.invoice
+        etag = invoice_pdf_etag(invoice)
+        if etag and etag in request.if_none_match:
+            return Response(status=304, headers={'ETag': f'"{etag}"'})
         
-        # Generate PDF using A4 template
-        buffer = generate_invoice_pdf_a4_format(invoice_data)
+        # Rendered with the A4 template, or read from the cache for fiscalized invoices
+        pdf_bytes = get_invoice_pdf(detail)
         
         # Return PDF file
         filename = f"invoice_{invoice.invoice_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
         return send_file(
-            buffer,
+            BytesIO(pdf_bytes),
             as_attachment=True,
             download_name=filename,
-            mimetype='application/pdf'
+            mimetype='application/pdf',
+            etag=etag or False
         )
         
+    except PdfRenderQueueFull as e:
+        return jsonify({"error": "PDF renderer is busy, retry shortly", "details": str(e)}), 503, {'Retry-After': '5'}
+    except PdfRenderTimeout as e:
+        return jsonify({"error": "PDF rendering timed out", "details": str(e)}), 504
     except Exception as e:
         current_app.logger.error(f"Error generating PDF for invoice {invoice_id}: {str(e)}")
         return jsonify({"error": "Failed to generate PDF", "details": str(e)}), 500
 
 
+@api.route('/fiscal_day/<device_id>/<fiscal_day_no>/pdfs', methods=['GET'])
+def download_fiscal_day_pdfs(device_id, fiscal_day_no):
+    """
+    Download every invoice of a fiscal day as PDFs, in a ZIP (format=zip, default) or
+    merged into one document (format=pdf).
+    
+    PDFs come from the rendered PDF cache or the PDF worker pool, never from the
+    request thread, so a month-end bulk download does not stall other requests.
+    """
+    try:
+        bundle_format = request.args.get('format', 'zip').lower()
+        if bundle_format not in ('zip', 'pdf'):
+            return jsonify({"error": "format must be zip or pdf"}), 400
+        
+        details = load_fiscal_day_invoice_details(device_id, fiscal_day_no)
+        if not details:
+            return jsonify({"error": f"No invoices found for device {device_id} and fiscal day {fiscal_day_no}"}), 404
+        
+        filename = f"invoices_{device_id}_day_{fiscal_day_no}.{bundle_format}"
+        if bundle_format == 'pdf':
+            buffer = BytesIO(merge_pdfs(pdf_bytes for _, pdf_bytes in iter_invoice_pdfs(details)))
+            mimetype = 'application/pdf'
+        else:
+            # Spills to disk past 32 MB; PDFs are already compressed, so they are stored as-is
+            buffer = tempfile.SpooledTemporaryFile(max_size=32 * 1024 * 1024)
+            with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+                for detail, pdf_bytes in iter_invoice_pdfs(details):
+                    archive.writestr(f"invoice_{detail.invoice.invoice_id}.pdf", pdf_bytes)
+            buffer.seek(0)
+            mimetype = 'application/zip'
+        
+        return send_file(buffer, as_attachment=True, download_name=filename, mimetype=mimetype)
+        
+    except PdfRenderQueueFull as e:
+        return jsonify({"error": "PDF renderer is busy, retry shortly", "details": str(e)}), 503, {'Retry-After': '5'}
+    except PdfRenderTimeout as e:
+        return jsonify({"error": "PDF rendering timed out", "details": str(e)}), 504
+    except Exception as e:
+        current_app.logger.error(f"Error generating PDFs for device {device_id} fiscal day {fiscal_day_no}: {str(e)}")
+        return jsonify({"error": "Failed to generate PDFs", "details": str(e)}), 500
+
+
+@api.route('/invoices/<invoice_id>/qr.png', methods=['GET'])
+def get_invoice_qr_png(invoice_id):
+    """
+    Get an invoice's QR code as a PNG.
+    
+    Invoice numbers are only unique per device, so the device is required
+    (?device_id=...); it is part of the URL that HTTP caches key on. The image is
+    served from the QR image cache, keyed by the QR string (which carries the
+    deviceID). A receipt's QR string never changes, so the response is cacheable
+    for a day and revalidated with its ETag.
+    """
+    try:
+        device_id = request.args.get('device_id')
+        if not device_id:
+            return jsonify({"error": "device_id is required"}), 400
+        
+        row = db.session.query(Invoice.qr_code_string).filter(
+            Invoice.device_id == str(device_id),
+            Invoice.invoice_id == invoice_id
+        ).first()
+        if not row:
+            return jsonify({"error": "Invoice not found"}), 404
+        if not row.qr_code_string:
+            return jsonify({"error": "Invoice has no QR code"}), 404
+        
+        etag = qr_image_cache.digest(row.qr_code_string)
+        headers = {'ETag': f'"{etag}"', 'Cache-Control': 'public, max-age=86400'}
+        if etag in request.if_none_match:
+            return Response(status=304, headers=headers)
+        
+        return Response(get_qr_png(row.qr_code_string), mimetype='image/png', headers=headers)
+        
+    except Exception as e:
+        current_app.logger.error(f"Error generating QR code for invoice {invoice_id}: {str(e)}")
+        return jsonify({"error": "Failed to generate QR code", "details": str(e)}), 500
+
+
 @api.route('/invoices-ui', methods=['GET'])
 def invoices_ui():
     """Serve the invoice listing UI"""
     try:
-        with open('static/invoices.html', 'r', encoding='utf-8') as f:
-            html_content = f.read()
-        return html_content, 200, {'Content-Type': 'text/html'}
+        return template_registry.page_response('invoices.html', request)
     except FileNotFoundError:
         return jsonify({"error": "Invoice UI file not found"}), 404
     except Exception as e:
@@ -1553,64 +2306,21 @@ def invoices_ui():
 def view_invoice(invoice_id):
     """View invoice details in HTML format using InvoiceA4 template"""
     try:
-        invoice = Invoice.query.filter_by(invoice_id=invoice_id).first()
+        detail = assemble_invoice(invoice_id)
         
-        if not invoice:
+        if not detail:
             return jsonify({"error": "Invoice not found"}), 404
         
-        # Get line items
-        line_items = InvoiceLineItem.query.filter_by(invoice_id=invoice.id).all()
-        
-        # Get branch address and contact
-        branch_address = DeviceBranchAddress.query.filter_by(invoice_id=invoice.id).first()
-        branch_contact = DeviceBranchContact.query.filter_by(invoice_id=invoice.id).first()
+        invoice = detail.invoice
+        line_items = detail.line_items
+        branch_address = detail.branch_address
+        branch_contact = detail.branch_contact
         
-        # Calculate tax summaries
-        tax_summaries = []
-        tax_groups = {}
-        
-        for item in line_items:
-            tax_percent = item.tax_percent or 0
-            if tax_percent not in tax_groups:
-                tax_groups[tax_percent] = {
-                    'amount': 0,
-                    'vat_amount': 0,
-                    'tax_code': item.tax_code
-                }
-            
-            amount = item.receipt_line_total or 0
-            vat_amount = amount * (tax_percent / 100)
-            
-            tax_groups[tax_percent]['amount'] += amount
-            tax_groups[tax_percent]['vat_amount'] += vat_amount
-        
-        # Convert to list format for template
-        for tax_percent, data in sorted(tax_groups.items(), reverse=True):
-            if tax_percent > 0:
-                tax_summaries.append({
-                    'label': f"Total {tax_percent}%",
-                    'amount': data['amount'],
-                    'vat_amount': data['vat_amount']
-                })
-        
-        # Generate QR code image for HTML display
-        qr_code_image = None
+        # QR code as inline SVG for HTML display (cached, no PIL)
+        qr_code_svg = None
         if invoice.qr_code_string:
             try:
-                import qrcode
-                import base64
-                from io import BytesIO
-                
-                qr = qrcode.QRCode(version=1, box_size=10, border=5)
-                qr.add_data(invoice.qr_code_string)
-                qr.make(fit=True)
-                img = qr.make_image(fill_color="black", back_color="white")
-                
-                # Convert to base64 for HTML display
-                buffer = BytesIO()
-                img.save(buffer, format='PNG')
-                buffer.seek(0)
-                qr_code_image = base64.b64encode(buffer.getvalue()).decode()
+                qr_code_svg = get_qr_svg(invoice.qr_code_string)
             except Exception as e:
                 current_app.logger.warning(f"Could not generate QR code: {e}")
         
@@ -1620,68 +2330,14 @@ def view_invoice(invoice_id):
             'line_items': line_items,
             'branch_address': branch_address,
             'branch_contact': branch_contact,
-            'tax_summaries': tax_summaries,
-            'qr_code_image': qr_code_image
+            'tax_summaries': detail.tax_summaries,
+            'qr_code_svg': qr_code_svg
         }
         
-        # Use Jinja2 for template rendering
-        try:
-            from jinja2 import Environment, FileSystemLoader
-            
-            # Set up Jinja2 environment
-            env = Environment(loader=FileSystemLoader('static'))
-            template = env.get_template('invoice_a4_template.html')
-            
-            # Render the template
-            rendered_html = template.render(**template_data)
-            
-            return rendered_html, 200, {'Content-Type': 'text/html'}
-            
-        except ImportError:
-            # Fallback to simple template rendering if Jinja2 is not available
-            try:
-                with open('static/invoice_a4_template.html', 'r', encoding='utf-8') as f:
-                    template_content = f.read()
-                
-                # Simple template rendering
-                from string import Template
-                template = Template(template_content)
-                
-                # Convert template data to string format
-                rendered_html = template.safe_substitute(
-                    invoice_id=invoice.invoice_id,
-                    device_id=invoice.device_id,
-                    verification_number=invoice.verification_number or '-',
-                    qr_code_string=invoice.qr_code_string or '-',
-                    qr_code_image=qr_code_image or '',
-                    receipt_type=invoice.receipt_type or 'SALE',
-                    tax_payer_name=invoice.tax_payer_name or '-',
-                    tax_payer_tin=invoice.tax_payer_tin or '-',
-                    vat_number=invoice.vat_number or '',
-                    device_branch_name=invoice.device_branch_name or '-',
-                    receipt_counter=invoice.receipt_counter or '-',
-                    receipt_global_no=invoice.receipt_global_no or '-',
-                    zimra_receipt_number=invoice.zimra_receipt_number or '-',
-                    fiscal_day_number=invoice.fiscal_day_number or '-',
-                    created_at=invoice.created_at.strftime('%d/%m/%Y %H:%M') if invoice.created_at else '-',
-                    debit_credit_note_invoice_ref_date=invoice.debit_credit_note_invoice_ref_date.strftime('%d/%m/%Y %H:%M') if invoice.debit_credit_note_invoice_ref_date else '',
-                    receipt_total=f"{invoice.receipt_total:.2f}" if invoice.receipt_total else '0.00',
-                    notes=invoice.receipt_notes or '',
-                    branch_address_street=branch_address.street if branch_address else '',
-                    branch_address_house_no=branch_address.house_no if branch_address else '',
-                    branch_address_city=branch_address.city if branch_address else '',
-                    branch_address_province=branch_address.province if branch_address else '',
-                    branch_contact_email=branch_contact.email if branch_contact else '-',
-                    branch_contact_phone=branch_contact.phone_number if branch_contact else '-'
-                )
-                
-                return rendered_html, 200, {'Content-Type': 'text/html'}
-                
-            except FileNotFoundError:
-                return jsonify({"error": "Invoice template file not found"}), 404
-            except Exception as e:
-                current_app.logger.error(f"Error rendering invoice template: {str(e)}")
-                return jsonify({"error": "Failed to render invoice template", "details": str(e)}), 500
+        # Render the compiled InvoiceA4 template
+        rendered_html = template_registry.render('invoice_a4_template.html', **template_data)
+        
+        return rendered_html, 200, {'Content-Type': 'text/html'}
         
     except Exception as e:
         current_app.logger.error(f"Error viewing invoice {invoice_id}: {str(e)}")
@@ -1707,7 +2363,7 @@ def get_fiscal_counters(device_id):
         fiscal_day_no = request.args.get('fiscal_day_no')
         
         # Load device config
-        device = DeviceInfo.query.filter_by(device_id=str(device_id)).first()
+        device = get_cached_device(device_id)
         if not device:
             return jsonify({"error": "Device not found"}), 404
 
@@ -1731,13 +2387,10 @@ def get_fiscal_counters(device_id):
         if not fiscal_day:
             return jsonify({"error": f"Fiscal day {target_fiscal_day_no} not found for device {device_id}"}), 404
 
-        # Get all invoices for this device and fiscal day
-        invoices = Invoice.query.filter_by(
-            device_id=str(device_id),
-            fiscal_day_number=str(target_fiscal_day_no)
-        ).all()
+        # Receipt totals per currency from the running fiscal day counters
+        receipt_totals = get_fiscal_day_receipt_totals(device_id, target_fiscal_day_no)
 
-        if not invoices:
+        if not receipt_totals:
             return jsonify({
                 "error": f"No invoices found for device {device_id} and fiscal day {target_fiscal_day_no}",
                 "fiscal_day_no": target_fiscal_day_no,
@@ -1749,9 +2402,8 @@ def get_fiscal_counters(device_id):
         # Generate fiscal counters using existing utility
         from utils.generate_counters import generate_counters
         
-        # Read private key for signature generation
-        with open(device.key_path, 'rb') as key_file:
-            private_key_data = key_file.read()
+        # Get cached private key for signature generation
+        private_key_data = get_device_private_key(device_id, device.key_path)
         
         # Generate counters
         counters_data = generate_counters(
@@ -1766,8 +2418,8 @@ def get_fiscal_counters(device_id):
         updated_counters = update_fiscal_counter_data(counters_data['fiscalDayCounters'])
         
         # Calculate summary statistics
-        total_receipts = len(invoices)
-        total_amount = sum(float(invoice.receipt_total or 0) for invoice in invoices)
+        total_receipts = sum(entry['count'] for entry in receipt_totals.values())
+        total_amount = sum(entry['amount'] for entry in receipt_totals.values())
         
         # Group counters by type for better organization
         counters_by_type = {}
@@ -1821,7 +2473,7 @@ def get_detailed_fiscal_counters(device_id):
         fiscal_day_no = request.args.get('fiscal_day_no')
         
         # Load device config
-        device = DeviceInfo.query.filter_by(device_id=str(device_id)).first()
+        device = get_cached_device(device_id)
         if not device:
             return jsonify({"error": "Device not found"}), 404
 
@@ -1844,7 +2496,7 @@ def get_detailed_fiscal_counters(device_id):
             return jsonify({"error": f"Fiscal day {target_fiscal_day_no} not found for device {device_id}"}), 404
 
         # Get all invoices with line items
-        invoices = Invoice.query.filter_by(
+        invoices = Invoice.query.options(selectinload(Invoice.line_items)).filter_by(
             device_id=str(device_id),
             fiscal_day_number=str(target_fiscal_day_no)
         ).all()
@@ -1869,7 +2521,7 @@ def get_detailed_fiscal_counters(device_id):
 
         # Process each invoice
         for invoice in invoices:
-            line_items = InvoiceLineItem.query.filter_by(invoice_id=invoice.id).all()
+            line_items = invoice.line_items
             
             # Currency breakdown
             currency = invoice.receipt_currency or 'ZWL'
@@ -1998,7 +2650,7 @@ def get_fiscal_counters_by_day(device_id, fiscal_day_no):
             return jsonify({"error": "Invalid fiscal day number. Must be an integer."}), 400
         
         # Load device config
-        device = DeviceInfo.query.filter_by(device_id=str(device_id)).first()
+        device = get_cached_device(device_id)
         if not device:
             return jsonify({"error": "Device not found"}), 404
 
@@ -2015,18 +2667,14 @@ def get_fiscal_counters_by_day(device_id, fiscal_day_no):
                 "fiscal_day_no": target_fiscal_day_no
             }), 404
 
-        # Get all invoices for this device and fiscal day
-        invoices = Invoice.query.filter_by(
-            device_id=str(device_id),
-            fiscal_day_number=str(target_fiscal_day_no)
-        ).all()
+        # Receipt totals per currency from the running fiscal day counters
+        receipt_totals = get_fiscal_day_receipt_totals(device_id, target_fiscal_day_no)
 
         # Generate fiscal counters using existing utility
         from utils.generate_counters import generate_counters
         
-        # Read private key for signature generation
-        with open(device.key_path, 'rb') as key_file:
-            private_key_data = key_file.read()
+        # Get cached private key for signature generation
+        private_key_data = get_device_private_key(device_id, device.key_path)
         
         # Generate counters
         counters_data = generate_counters(
@@ -2041,8 +2689,8 @@ def get_fiscal_counters_by_day(device_id, fiscal_day_no):
         updated_counters = update_fiscal_counter_data(counters_data['fiscalDayCounters'])
         
         # Calculate summary statistics
-        total_receipts = len(invoices)
-        total_amount = sum(float(invoice.receipt_total or 0) for invoice in invoices)
+        total_receipts = sum(entry['count'] for entry in receipt_totals.values())
+        total_amount = sum(entry['amount'] for entry in receipt_totals.values())
         
         # Group counters by type for better organization
         counters_by_type = {}
@@ -2114,7 +2762,7 @@ def get_fiscal_counters_latest(device_id):
     """
     try:
         # Load device config
-        device = DeviceInfo.query.filter_by(device_id=str(device_id)).first()
+        device = get_cached_device(device_id)
         if not device:
             return jsonify({"error": "Device not found"}), 404
 
@@ -2137,18 +2785,14 @@ def get_fiscal_counters_latest(device_id):
                 "fiscal_day_no": target_fiscal_day_no
             }), 404
 
-        # Get all invoices for this device and fiscal day
-        invoices = Invoice.query.filter_by(
-            device_id=str(device_id),
-            fiscal_day_number=str(target_fiscal_day_no)
-        ).all()
+        # Receipt totals per currency from the running fiscal day counters
+        receipt_totals = get_fiscal_day_receipt_totals(device_id, target_fiscal_day_no)
 
         # Generate fiscal counters using existing utility
         from utils.generate_counters import generate_counters
         
-        # Read private key for signature generation
-        with open(device.key_path, 'rb') as key_file:
-            private_key_data = key_file.read()
+        # Get cached private key for signature generation
+        private_key_data = get_device_private_key(device_id, device.key_path)
         
         # Generate counters
         counters_data = generate_counters(
@@ -2163,8 +2807,8 @@ def get_fiscal_counters_latest(device_id):
         updated_counters = update_fiscal_counter_data(counters_data['fiscalDayCounters'])
         
         # Calculate summary statistics
-        total_receipts = len(invoices)
-        total_amount = sum(float(invoice.receipt_total or 0) for invoice in invoices)
+        total_receipts = sum(entry['count'] for entry in receipt_totals.values())
+        total_amount = sum(entry['amount'] for entry in receipt_totals.values())
         
         # Group counters by type for better organization
         counters_by_type = {}
@@ -2246,7 +2890,7 @@ def analyze_fiscal_counters_data(device_id, fiscal_day_no):
             return jsonify({"error": "Invalid fiscal day number. Must be an integer."}), 400
         
         # Load device config
-        device = DeviceInfo.query.filter_by(device_id=str(device_id)).first()
+        device = get_cached_device(device_id)
         if not device:
             return jsonify({"error": "Device not found"}), 404
 
@@ -2299,7 +2943,7 @@ def analyze_fiscal_counters_data_latest(device_id):
     """
     try:
         # Load device config
-        device = DeviceInfo.query.filter_by(device_id=str(device_id)).first()
+        device = get_cached_device(device_id)
         if not device:
             return jsonify({"error": "Device not found"}), 404
 
@@ -2345,6 +2989,61 @@ def analyze_fiscal_counters_data_latest(device_id):
         return jsonify(error_details), 500
 
 
+@api.route('/fdms_sessions/stats', methods=['GET'])
+def fdms_session_stats():
+    """
+    Get hit/miss statistics for the pooled FDMS mTLS sessions.
+    
+    Returns:
+        JSON response with pool totals and per-device session usage
+    """
+    return jsonify(fdms_sessions.stats()), 200
+
+
+@api.route('/device_cache/stats', methods=['GET'])
+def device_cache_stats():
+    """
+    Get hit/miss statistics for the device context cache.
+    
+    Returns:
+        JSON response with cache totals and the cached devices
+    """
+    return jsonify(device_cache.stats()), 200
+
+
+@api.route('/pdf_cache/stats', methods=['GET'])
+def pdf_cache_stats():
+    """
+    Get hit/miss statistics for the rendered invoice PDF cache and the PDF worker pool.
+    
+    Returns:
+        JSON response with cache counters, directory, template version and renderer counters
+    """
+    return jsonify({**invoice_pdf_cache.stats(), 'renderer': pdf_render_service.stats()}), 200
+
+
+@api.route('/qr_cache/stats', methods=['GET'])
+def qr_cache_stats():
+    """
+    Get hit/miss statistics for the QR image cache.
+    
+    Returns:
+        JSON response with memory and disk tier counters
+    """
+    return jsonify(qr_image_cache.stats()), 200
+
+
+@api.route('/timing/stats', methods=['GET'])
+def timing_stats():
+    """
+    Get rolling request and phase latencies per endpoint.
+    
+    Returns:
+        JSON response with count, mean, p50, p95, p99 and max (ms) per endpoint and phase
+    """
+    return jsonify(request_timings.stats()), 200
+
+
 @api.route('/health', methods=['GET'])
 def health_check():
     """
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Invoice PDF benchmark
+This script times generate_invoice_pdf_a4_format for invoices with 1, 10 and 100
+line items and prints the mean and median time per PDF. Run it before and after
+changing invoice_template.py to compare.
+"""
+
+import argparse
+import statistics
+import time
+from invoice_template import generate_invoice_pdf_a4_format
+
+
+def build_invoice_data(line_count: int) -> dict:
+    """Build an invoice dict shaped like utils.invoice_detail.invoice_pdf_data output"""
+    line_items = [
+        {
+            'receipt_line_name': f'Product {line_no}',
+            'receipt_line_quantity': 2,
+            'receipt_line_price': 12.50,
+            'receipt_line_total': 25.00,
+            'tax_code': 'A' if line_no % 3 else 'C',
+            'tax_percent': 15.0 if line_no % 3 else 0.0,
+            'receipt_line_hs_code': f'HS{line_no:04d}',
+            'tax_id': 1 if line_no % 3 else 3
+        }
+        for line_no in range(1, line_count + 1)
+    ]
+    return {
+        'invoice_id': f'INV-{line_count}',
+        'zimra_receipt_number': '1001',
+        'device_id': '26428',
+        'created_at': '2025-09-10 14:30:00',
+        'is_fiscalized': True,
+        'receipt_type': 'FiscalInvoice',
+        'money_type': 'Cash',
+        'receipt_counter': 1,
+        'receipt_global_no': 1001,
+        'fiscal_day_number': '12',
+        'operation_id': '0HMPH9AF0QKKE:00000001',
+        'verification_number': '4C8B-E6C1-0E3A-4DD1',
+        'hash_string': 'ABC123DEF456',
+        'tax_payer_name': 'Sample Company Ltd',
+        'tax_payer_tin': '2000123456',
+        'vat_number': '220123456',
+        'device_branch_name': 'Main Branch',
+        'debit_credit_note_invoice_ref_date': None,
+        'receipt_total': 25.00 * line_count,
+        'notes': 'Benchmark invoice',
+        'qr_code_url': 'https://fdmstest.zimra.co.zw/000002642812092025000000100145AB1C2D3E4F5A6B7',
+        'branch_address': 'Samora Machel Ave, 1, Harare, Harare',
+        'branch_contact': 'Email: branch@example.com, Phone: +263 4 123456',
+        'line_items': line_items
+    }
+
+
+def benchmark(line_count: int, iterations: int) -> dict:
+    """Render the same invoice repeatedly and collect per-PDF times in milliseconds"""
+    invoice_data = build_invoice_data(line_count)
+    generate_invoice_pdf_a4_format(invoice_data)  # warm-up (imports, QR cache, font metrics)
+
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        generate_invoice_pdf_a4_format(invoice_data)
+        timings.append((time.perf_counter() - start) * 1000)
+    return {
+        'lines': line_count,
+        'mean_ms': statistics.mean(timings),
+        'median_ms': statistics.median(timings)
+    }
+
+
+def main():
+    """Main benchmark function"""
+    parser = argparse.ArgumentParser(description="Time invoice PDF rendering")
+    parser.add_argument('--iterations', type=int, default=50, help="PDFs rendered per invoice size")
+    args = parser.parse_args()
+
+    print("=== Invoice PDF Benchmark ===")
+    for line_count in (1, 10, 100):
+        result = benchmark(line_count, args.iterations)
+        print(f"  {result['lines']:>3} lines: mean {result['mean_ms']:.2f} ms, median {result['median_ms']:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
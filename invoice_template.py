@@ -9,22 +9,152 @@ from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import inch, mm
 from reportlab.lib import colors
 from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT
+from reportlab import rl_config
 import io
-import qrcode
 from datetime import datetime
+from utils.qr_images import get_qr_png
+
+# Bump whenever the PDF layout changes, so cached invoice PDFs are rendered again
+PDF_TEMPLATE_VERSION = '2'
+
+# ===== PRECOMPUTED LAYOUT OBJECTS =====
+# Styles, table styles and fixed text are built once per process; each render only
+# lays out the invoice's own values. Helvetica is a standard PDF font, so there is
+# nothing to register or embed.
+
+# Keep image streams binary: ASCII85-encoding the QR image in pure Python was about
+# a fifth of each render (ReportLab's optional rl_accel extension is not installed)
+rl_config.useA85 = 0
+
+PAGE_MARGIN = 15*mm
+
+_SAMPLE_STYLES = getSampleStyleSheet()
+
+# Title style for "FISCAL TAX INVOICE"
+TITLE_STYLE = ParagraphStyle(
+    'TitleStyle',
+    parent=_SAMPLE_STYLES['Heading1'],
+    fontSize=18,
+    fontName='Helvetica-Bold',
+    alignment=TA_CENTER,
+    spaceAfter=20
+)
+
+# Section header style
+SECTION_STYLE = ParagraphStyle(
+    'SectionStyle',
+    parent=_SAMPLE_STYLES['Heading2'],
+    fontSize=12,
+    fontName='Helvetica-Bold',
+    spaceAfter=6
+)
+
+# Normal text style
+NORMAL_STYLE = ParagraphStyle(
+    'NormalStyle',
+    parent=_SAMPLE_STYLES['Normal'],
+    fontSize=10,
+    fontName='Helvetica',
+    spaceAfter=3
+)
+
+# Small text style
+SMALL_STYLE = ParagraphStyle(
+    'SmallStyle',
+    parent=_SAMPLE_STYLES['Normal'],
+    fontSize=8,
+    fontName='Helvetica',
+    spaceAfter=2
+)
+
+# Centered verification section style
+VERIFICATION_STYLE = ParagraphStyle(
+    'VerificationStyle',
+    parent=_SAMPLE_STYLES['Normal'],
+    fontSize=10,
+    fontName='Helvetica',
+    alignment=TA_CENTER,
+    spaceAfter=6
+)
+
+SELLER_BUYER_COL_WIDTHS = [3*inch, 3*inch]
+SELLER_BUYER_TABLE_STYLE = TableStyle([
+    ('ALIGN', (0, 0), (0, -1), 'LEFT'),
+    ('ALIGN', (1, 0), (1, -1), 'LEFT'),
+    ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+    ('FONTSIZE', (0, 0), (-1, -1), 10),
+    ('BOTTOMPADDING', (0, 0), (-1, -1), 4),
+    ('TOPPADDING', (0, 0), (-1, -1), 2),
+])
+
+RECEIPT_INFO_COL_WIDTHS = [1.5*inch, 2*inch, 1.5*inch, 1.5*inch]
+RECEIPT_INFO_TABLE_STYLE = TableStyle([
+    ('ALIGN', (0, 0), (0, -1), 'LEFT'),
+    ('ALIGN', (1, 0), (1, -1), 'LEFT'),
+    ('ALIGN', (2, 0), (2, -1), 'LEFT'),
+    ('ALIGN', (3, 0), (3, -1), 'LEFT'),
+    ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+    ('FONTNAME', (2, 0), (2, -1), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, -1), 9),
+    ('BOTTOMPADDING', (0, 0), (-1, -1), 3),
+    ('TOPPADDING', (0, 0), (-1, -1), 2),
+])
+
+# Table headers matching the format from the API documentation
+LINE_ITEM_HEADERS = ['Code', 'Description', 'Qty', 'Price', 'VAT', 'Amount (excl. tax)']
+LINE_ITEM_COL_WIDTHS = [0.8*inch, 2.2*inch, 0.6*inch, 0.8*inch, 0.8*inch, 1.2*inch]
+LINE_ITEM_TABLE_STYLE = TableStyle([
+    ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+    ('ALIGN', (2, 1), (2, -2), 'CENTER'),  # Center quantities
+    ('ALIGN', (3, 1), (5, -1), 'RIGHT'),  # Right align prices and amounts
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),  # Bold headers
+    ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),  # Bold totals
+    ('FONTSIZE', (0, 0), (-1, -1), 8),
+    ('BOTTOMPADDING', (0, 0), (-1, -1), 3),
+    ('TOPPADDING', (0, 0), (-1, -1), 2),
+    ('GRID', (0, 0), (-1, -1), 0.5, colors.black),
+    ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+    ('BACKGROUND', (0, -1), (-1, -1), colors.lightgrey),
+])
+
+TAX_SUMMARY_COL_WIDTHS = [2*inch, 1.5*inch, 1.5*inch]
+TAX_SUMMARY_TABLE_STYLE = TableStyle([
+    ('ALIGN', (0, 0), (0, -1), 'LEFT'),
+    ('ALIGN', (1, 0), (2, -1), 'RIGHT'),
+    ('FONTNAME', (0, 0), (-1, -1), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, -1), 10),
+    ('BOTTOMPADDING', (0, 0), (-1, -1), 3),
+    ('TOPPADDING', (0, 0), (-1, -1), 2),
+])
+
+# Placeholder buyer block until buyer data is carried on invoices
+BUYER_LINES = (
+    "Company ABC, Ltd.",
+    "Food Market ABC",
+    "TIN: 19870123",
+    "12 Southgate Hwange",
+    "john.smith@email.com",
+    "(081) 20875",
+)
+
+# Parsed markup of the template's fixed text, keyed by (text, style name)
+_static_frags = {}
+
+
+def static_paragraph(text, style):
+    """Paragraph of fixed template text; its markup is parsed once per process"""
+    key = (text, style.name)
+    frags = _static_frags.get(key)
+    if frags is None:
+        frags = Paragraph(text, style).frags
+        _static_frags[key] = frags
+    # A new Paragraph per render (flowables keep layout state), sharing the parsed fragments
+    return Paragraph(text, style, frags=frags)
+
 
 def create_qr_code(data, size=100):
-    """Create QR code image"""
-    qr = qrcode.QRCode(version=1, box_size=10, border=5)
-    qr.add_data(data)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-    
-    # Convert PIL image to bytes
-    img_buffer = io.BytesIO()
-    img.save(img_buffer, format='PNG')
-    img_buffer.seek(0)
-    return img_buffer
+    """Create QR code image (PNG served from the shared QR image cache)"""
+    return io.BytesIO(get_qr_png(data))
 
 def generate_invoice_pdf_a4_format(invoice_data):
     """Generate invoice PDF using A4 template format matching ZIMRA InvoiceA4 view specification"""
@@ -34,50 +164,10 @@ def generate_invoice_pdf_a4_format(invoice_data):
     doc = SimpleDocTemplate(
         buffer, 
         pagesize=A4, 
-        rightMargin=15*mm, 
-        leftMargin=15*mm, 
-        topMargin=15*mm, 
-        bottomMargin=15*mm
-    )
-    
-    # Create custom styles
-    styles = getSampleStyleSheet()
-    
-    # Title style for "FISCAL TAX INVOICE"
-    title_style = ParagraphStyle(
-        'TitleStyle',
-        parent=styles['Heading1'],
-        fontSize=18,
-        fontName='Helvetica-Bold',
-        alignment=TA_CENTER,
-        spaceAfter=20
-    )
-    
-    # Section header style
-    section_style = ParagraphStyle(
-        'SectionStyle',
-        parent=styles['Heading2'],
-        fontSize=12,
-        fontName='Helvetica-Bold',
-        spaceAfter=6
-    )
-    
-    # Normal text style
-    normal_style = ParagraphStyle(
-        'NormalStyle',
-        parent=styles['Normal'],
-        fontSize=10,
-        fontName='Helvetica',
-        spaceAfter=3
-    )
-    
-    # Small text style
-    small_style = ParagraphStyle(
-        'SmallStyle',
-        parent=styles['Normal'],
-        fontSize=8,
-        fontName='Helvetica',
-        spaceAfter=2
+        rightMargin=PAGE_MARGIN, 
+        leftMargin=PAGE_MARGIN, 
+        topMargin=PAGE_MARGIN, 
+        bottomMargin=PAGE_MARGIN
     )
     
     # Story elements
@@ -85,70 +175,41 @@ def generate_invoice_pdf_a4_format(invoice_data):
     
     # ===== HEADER SECTION =====
     # FISCAL TAX INVOICE title
-    story.append(Paragraph("FISCAL TAX INVOICE", title_style))
+    story.append(static_paragraph("FISCAL TAX INVOICE", TITLE_STYLE))
     story.append(Spacer(1, 10))
     
     # ===== VERIFICATION SECTION =====
     if invoice_data.get('verification_number'):
-        verification_style = ParagraphStyle(
-            'VerificationStyle',
-            parent=styles['Normal'],
-            fontSize=10,
-            fontName='Helvetica',
-            alignment=TA_CENTER,
-            spaceAfter=6
-        )
-        story.append(Paragraph(f"Verification code", verification_style))
-        story.append(Paragraph(f"{invoice_data.get('verification_number')}", verification_style))
-        story.append(Paragraph("You can verify this receipt manually at", verification_style))
-        story.append(Paragraph("https://receipt.zimra.org/", verification_style))
+        story.append(static_paragraph("Verification code", VERIFICATION_STYLE))
+        story.append(Paragraph(f"{invoice_data.get('verification_number')}", VERIFICATION_STYLE))
+        story.append(static_paragraph("You can verify this receipt manually at", VERIFICATION_STYLE))
+        story.append(static_paragraph("https://receipt.zimra.org/", VERIFICATION_STYLE))
         story.append(Spacer(1, 15))
     
     # ===== SELLER/BUYER SECTION =====
-    # Create a table with SELLER and BUYER columns
-    seller_buyer_data = []
-    
     # Seller information
     seller_info = []
-    seller_info.append(Paragraph("SELLER", section_style))
-    seller_info.append(Paragraph(f"Company legal name: {invoice_data.get('tax_payer_name', 'N/A')}", normal_style))
-    seller_info.append(Paragraph(f"TIN: {invoice_data.get('tax_payer_tin', 'N/A')}", normal_style))
+    seller_info.append(static_paragraph("SELLER", SECTION_STYLE))
+    seller_info.append(Paragraph(f"Company legal name: {invoice_data.get('tax_payer_name', 'N/A')}", NORMAL_STYLE))
+    seller_info.append(Paragraph(f"TIN: {invoice_data.get('tax_payer_tin', 'N/A')}", NORMAL_STYLE))
     if invoice_data.get('vat_number'):
-        seller_info.append(Paragraph(f"VAT No: {invoice_data.get('vat_number')}", normal_style))
+        seller_info.append(Paragraph(f"VAT No: {invoice_data.get('vat_number')}", NORMAL_STYLE))
     if invoice_data.get('device_branch_name'):
-        seller_info.append(Paragraph(f"{invoice_data.get('device_branch_name')}", normal_style))
+        seller_info.append(Paragraph(f"{invoice_data.get('device_branch_name')}", NORMAL_STYLE))
     if invoice_data.get('branch_address'):
-        seller_info.append(Paragraph(f"{invoice_data.get('branch_address')}", normal_style))
+        seller_info.append(Paragraph(f"{invoice_data.get('branch_address')}", NORMAL_STYLE))
     if invoice_data.get('branch_contact'):
         contact_parts = invoice_data.get('branch_contact', '').split(', ')
         for contact in contact_parts:
             if contact.strip():
-                seller_info.append(Paragraph(contact.strip(), normal_style))
+                seller_info.append(Paragraph(contact.strip(), NORMAL_STYLE))
     
-    # Buyer information (if available)
-    buyer_info = []
-    buyer_info.append(Paragraph("BUYER", section_style))
-    # Note: Buyer information would come from invoice_data if available
-    # For now, we'll use placeholder or leave empty
-    buyer_info.append(Paragraph("Company ABC, Ltd.", normal_style))
-    buyer_info.append(Paragraph("Food Market ABC", normal_style))
-    buyer_info.append(Paragraph("TIN: 19870123", normal_style))
-    buyer_info.append(Paragraph("12 Southgate Hwange", normal_style))
-    buyer_info.append(Paragraph("john.smith@email.com", normal_style))
-    buyer_info.append(Paragraph("(081) 20875", normal_style))
+    # Buyer information (placeholder until invoices carry buyer data)
+    buyer_info = [static_paragraph("BUYER", SECTION_STYLE)]
+    buyer_info.extend(static_paragraph(line, NORMAL_STYLE) for line in BUYER_LINES)
     
-    # Add seller and buyer to table
-    seller_buyer_data.append([seller_info, buyer_info])
-    
-    seller_buyer_table = Table(seller_buyer_data, colWidths=[3*inch, 3*inch])
-    seller_buyer_table.setStyle(TableStyle([
-        ('ALIGN', (0, 0), (0, -1), 'LEFT'),
-        ('ALIGN', (1, 0), (1, -1), 'LEFT'),
-        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-        ('FONTSIZE', (0, 0), (-1, -1), 10),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 4),
-        ('TOPPADDING', (0, 0), (-1, -1), 2),
-    ]))
+    seller_buyer_table = Table([[seller_info, buyer_info]], colWidths=SELLER_BUYER_COL_WIDTHS)
+    seller_buyer_table.setStyle(SELLER_BUYER_TABLE_STYLE)
     story.append(seller_buyer_table)
     story.append(Spacer(1, 15))
     
@@ -157,67 +218,55 @@ def generate_invoice_pdf_a4_format(invoice_data):
     
     # Receipt details
     receipt_info_data.append([
-        Paragraph("Receipt No:", normal_style),
-        Paragraph(f"{invoice_data.get('receipt_counter', 'N/A')}/{invoice_data.get('receipt_global_no', 'N/A')}", normal_style),
-        Paragraph("Fiscal day No:", normal_style),
-        Paragraph(f"{invoice_data.get('fiscal_day_number', 'N/A')}", normal_style)
+        static_paragraph("Receipt No:", NORMAL_STYLE),
+        Paragraph(f"{invoice_data.get('receipt_counter', 'N/A')}/{invoice_data.get('receipt_global_no', 'N/A')}", NORMAL_STYLE),
+        static_paragraph("Fiscal day No:", NORMAL_STYLE),
+        Paragraph(f"{invoice_data.get('fiscal_day_number', 'N/A')}", NORMAL_STYLE)
     ])
     
     receipt_info_data.append([
-        Paragraph("Invoice No:", normal_style),
-        Paragraph(f"{invoice_data.get('zimra_receipt_number', 'N/A')}", normal_style),
-        Paragraph("Date:", normal_style),
-        Paragraph(f"{invoice_data.get('created_at', 'N/A')}", normal_style)
+        static_paragraph("Invoice No:", NORMAL_STYLE),
+        Paragraph(f"{invoice_data.get('zimra_receipt_number', 'N/A')}", NORMAL_STYLE),
+        static_paragraph("Date:", NORMAL_STYLE),
+        Paragraph(f"{invoice_data.get('created_at', 'N/A')}", NORMAL_STYLE)
     ])
     
     receipt_info_data.append([
-        Paragraph("Device Serial No:", normal_style),
-        Paragraph(f"{invoice_data.get('device_id', 'N/A')}", normal_style),
-        Paragraph("Fiscal device ID:", normal_style),
-        Paragraph(f"{invoice_data.get('device_id', 'N/A')}", normal_style)
+        static_paragraph("Device Serial No:", NORMAL_STYLE),
+        Paragraph(f"{invoice_data.get('device_id', 'N/A')}", NORMAL_STYLE),
+        static_paragraph("Fiscal device ID:", NORMAL_STYLE),
+        Paragraph(f"{invoice_data.get('device_id', 'N/A')}", NORMAL_STYLE)
     ])
     
     # Add credit/debit note information if available
     if invoice_data.get('debit_credit_note_invoice_ref_date'):
         receipt_info_data.append([
-            Paragraph("Receipt No:", normal_style),
-            Paragraph(f"{invoice_data.get('receipt_counter', 'N/A')}", normal_style),
-            Paragraph("Date:", normal_style),
-            Paragraph(f"{invoice_data.get('debit_credit_note_invoice_ref_date')}", normal_style)
+            static_paragraph("Receipt No:", NORMAL_STYLE),
+            Paragraph(f"{invoice_data.get('receipt_counter', 'N/A')}", NORMAL_STYLE),
+            static_paragraph("Date:", NORMAL_STYLE),
+            Paragraph(f"{invoice_data.get('debit_credit_note_invoice_ref_date')}", NORMAL_STYLE)
         ])
         receipt_info_data.append([
-            Paragraph("Invoice No:", normal_style),
-            Paragraph(f"{invoice_data.get('zimra_receipt_number', 'N/A')}", normal_style),
-            Paragraph("", normal_style),
-            Paragraph("", normal_style)
+            static_paragraph("Invoice No:", NORMAL_STYLE),
+            Paragraph(f"{invoice_data.get('zimra_receipt_number', 'N/A')}", NORMAL_STYLE),
+            static_paragraph("", NORMAL_STYLE),
+            static_paragraph("", NORMAL_STYLE)
         ])
         receipt_info_data.append([
-            Paragraph("Device Serial No:", normal_style),
-            Paragraph(f"{invoice_data.get('device_id', 'N/A')}", normal_style),
-            Paragraph("", normal_style),
-            Paragraph("", normal_style)
+            static_paragraph("Device Serial No:", NORMAL_STYLE),
+            Paragraph(f"{invoice_data.get('device_id', 'N/A')}", NORMAL_STYLE),
+            static_paragraph("", NORMAL_STYLE),
+            static_paragraph("", NORMAL_STYLE)
         ])
     
-    receipt_info_table = Table(receipt_info_data, colWidths=[1.5*inch, 2*inch, 1.5*inch, 1.5*inch])
-    receipt_info_table.setStyle(TableStyle([
-        ('ALIGN', (0, 0), (0, -1), 'LEFT'),
-        ('ALIGN', (1, 0), (1, -1), 'LEFT'),
-        ('ALIGN', (2, 0), (2, -1), 'LEFT'),
-        ('ALIGN', (3, 0), (3, -1), 'LEFT'),
-        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-        ('FONTNAME', (2, 0), (2, -1), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, -1), 9),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 3),
-        ('TOPPADDING', (0, 0), (-1, -1), 2),
-    ]))
+    receipt_info_table = Table(receipt_info_data, colWidths=RECEIPT_INFO_COL_WIDTHS)
+    receipt_info_table.setStyle(RECEIPT_INFO_TABLE_STYLE)
     story.append(receipt_info_table)
     story.append(Spacer(1, 15))
     
     # ===== LINE ITEMS SECTION =====
     if invoice_data.get('line_items'):
-        # Table headers matching the format from the API documentation
-        headers = ['Code', 'Description', 'Qty', 'Price', 'VAT', 'Amount (excl. tax)']
-        table_data = [headers]
+        table_data = [LINE_ITEM_HEADERS]
         
         # Add line items
         for item in invoice_data['line_items']:
@@ -241,23 +290,8 @@ def generate_invoice_pdf_a4_format(invoice_data):
             f"{invoice_data.get('receipt_total', 0):.2f}"
         ])
         
-        # Calculate column widths
-        col_widths = [0.8*inch, 2.2*inch, 0.6*inch, 0.8*inch, 0.8*inch, 1.2*inch]
-        
-        items_table = Table(table_data, colWidths=col_widths)
-        items_table.setStyle(TableStyle([
-            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-            ('ALIGN', (2, 1), (2, -2), 'CENTER'),  # Center quantities
-            ('ALIGN', (3, 1), (5, -1), 'RIGHT'),  # Right align prices and amounts
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),  # Bold headers
-            ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),  # Bold totals
-            ('FONTSIZE', (0, 0), (-1, -1), 8),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 3),
-            ('TOPPADDING', (0, 0), (-1, -1), 2),
-            ('GRID', (0, 0), (-1, -1), 0.5, colors.black),
-            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-            ('BACKGROUND', (0, -1), (-1, -1), colors.lightgrey),
-        ]))
+        items_table = Table(table_data, colWidths=LINE_ITEM_COL_WIDTHS)
+        items_table.setStyle(LINE_ITEM_TABLE_STYLE)
         story.append(items_table)
         story.append(Spacer(1, 15))
     
@@ -301,15 +335,8 @@ def generate_invoice_pdf_a4_format(invoice_data):
                     ""
                 ])
                 
-                tax_table = Table(tax_data, colWidths=[2*inch, 1.5*inch, 1.5*inch])
-                tax_table.setStyle(TableStyle([
-                    ('ALIGN', (0, 0), (0, -1), 'LEFT'),
-                    ('ALIGN', (1, 0), (2, -1), 'RIGHT'),
-                    ('FONTNAME', (0, 0), (-1, -1), 'Helvetica-Bold'),
-                    ('FONTSIZE', (0, 0), (-1, -1), 10),
-                    ('BOTTOMPADDING', (0, 0), (-1, -1), 3),
-                    ('TOPPADDING', (0, 0), (-1, -1), 2),
-                ]))
+                tax_table = Table(tax_data, colWidths=TAX_SUMMARY_COL_WIDTHS)
+                tax_table.setStyle(TAX_SUMMARY_TABLE_STYLE)
                 story.append(tax_table)
                 story.append(Spacer(1, 15))
     
@@ -320,12 +347,12 @@ def generate_invoice_pdf_a4_format(invoice_data):
             qr_image = Image(qr_buffer, width=1*inch, height=1*inch)
             story.append(qr_image)
         except Exception as e:
-            story.append(Paragraph(f"QR Code: {invoice_data.get('qr_code_url')}", normal_style))
+            story.append(Paragraph(f"QR Code: {invoice_data.get('qr_code_url')}", NORMAL_STYLE))
     
     # ===== FOOTER SECTION =====
     story.append(Spacer(1, 20))
-    story.append(Paragraph("Thank you for your business!", normal_style))
-    story.append(Paragraph("This is a fiscal receipt generated by ZIMRA compliant system", small_style))
+    story.append(static_paragraph("Thank you for your business!", NORMAL_STYLE))
+    story.append(static_paragraph("This is a fiscal receipt generated by ZIMRA compliant system", SMALL_STYLE))
     
     # Build PDF
     doc.build(story)
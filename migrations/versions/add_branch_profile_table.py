@@ -0,0 +1,160 @@
+"""add branch profile table and backfill invoice references
+
+Revision ID: branch_profiles_001
+Revises: offline_receipts_001
+Create Date: 2025-09-08 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import hashlib
+import json
+
+
+# revision identifiers, used by Alembic.
+revision = 'branch_profiles_001'
+down_revision = 'offline_receipts_001'
+branch_labels = None
+depends_on = None
+
+
+# Same canonical form as utils.branch_profiles.branch_profile_hash
+PROFILE_FIELDS = ('province', 'city', 'street', 'house_no', 'email', 'phone_number')
+
+
+def profile_hash(fields: dict) -> str:
+    canonical = json.dumps(
+        [str(fields.get(field) or '') for field in PROFILE_FIELDS],
+        separators=(',', ':'),
+        ensure_ascii=False
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def upgrade():
+    op.create_table('branch_profile',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('device_id', sa.String(length=50), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('content_hash', sa.String(length=64), nullable=False),
+    sa.Column('province', sa.String(length=100), nullable=True),
+    sa.Column('city', sa.String(length=100), nullable=True),
+    sa.Column('street', sa.String(length=255), nullable=True),
+    sa.Column('house_no', sa.String(length=50), nullable=True),
+    sa.Column('email', sa.String(length=255), nullable=True),
+    sa.Column('phone_number', sa.String(length=50), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('device_id', 'content_hash', name='uq_branch_profile_device_hash'),
+    sa.UniqueConstraint('device_id', 'version', name='uq_branch_profile_device_version')
+    )
+    op.add_column('invoice', sa.Column('branch_profile_id', sa.Integer(), nullable=True))
+    op.create_foreign_key('fk_invoice_branch_profile', 'invoice', 'branch_profile', ['branch_profile_id'], ['id'])
+    op.add_column('device_configuration', sa.Column('branch_profile_id', sa.Integer(), nullable=True))
+    op.create_foreign_key('fk_device_configuration_branch_profile', 'device_configuration', 'branch_profile',
+                          ['branch_profile_id'], ['id'])
+
+    bind = op.get_bind()
+    branch_profile = sa.table('branch_profile',
+        sa.column('id', sa.Integer), sa.column('device_id', sa.String), sa.column('version', sa.Integer),
+        sa.column('content_hash', sa.String), sa.column('province', sa.String), sa.column('city', sa.String),
+        sa.column('street', sa.String), sa.column('house_no', sa.String), sa.column('email', sa.String),
+        sa.column('phone_number', sa.String), sa.column('created_at', sa.DateTime)
+    )
+
+    # Distinct address/contact combinations per device, oldest first, become versions 1, 2, ...
+    combinations = bind.execute(sa.text("""
+        SELECT i.device_id, a.province, a.city, a.street, a.house_no, c.email, c.phone_number,
+               MIN(i.created_at) AS first_seen
+        FROM invoice i
+        LEFT JOIN device_branch_address a ON a.invoice_id = i.id
+        LEFT JOIN device_branch_contact c ON c.invoice_id = i.id
+        WHERE a.id IS NOT NULL OR c.id IS NOT NULL
+        GROUP BY i.device_id, a.province, a.city, a.street, a.house_no, c.email, c.phone_number
+        ORDER BY i.device_id, first_seen
+    """)).fetchall()
+
+    versions = {}
+    seen = set()
+    profiles = []
+    for row in combinations:
+        fields = dict(zip(PROFILE_FIELDS, row[1:7]))
+        key = (row.device_id, profile_hash(fields))
+        if key in seen:
+            continue  # Differs only in empty vs missing values
+        seen.add(key)
+        versions[row.device_id] = versions.get(row.device_id, 0) + 1
+        profiles.append(dict(fields, device_id=row.device_id, version=versions[row.device_id],
+                             content_hash=key[1], created_at=row.first_seen))
+
+    # Current device configurations that no invoice has used yet
+    configurations = bind.execute(sa.text("""
+        SELECT device_id, device_branch_address_province, device_branch_address_city,
+               device_branch_address_street, device_branch_address_house_no,
+               device_branch_contacts_email, device_branch_contacts_phone_no, updated_at
+        FROM device_configuration
+    """)).fetchall()
+    for row in configurations:
+        fields = dict(zip(PROFILE_FIELDS, row[1:7]))
+        key = (row.device_id, profile_hash(fields))
+        if key in seen:
+            continue
+        seen.add(key)
+        versions[row.device_id] = versions.get(row.device_id, 0) + 1
+        profiles.append(dict(fields, device_id=row.device_id, version=versions[row.device_id],
+                             content_hash=key[1], created_at=row.updated_at))
+
+    if profiles:
+        op.bulk_insert(branch_profile, profiles)
+
+    # Point invoices at the profile matching their legacy rows (empty and missing values match)
+    op.execute("""
+        UPDATE invoice i
+        SET branch_profile_id = p.id
+        FROM branch_profile p, device_branch_address a
+        FULL OUTER JOIN device_branch_contact c ON c.invoice_id = a.invoice_id
+        WHERE COALESCE(a.invoice_id, c.invoice_id) = i.id
+          AND p.device_id = i.device_id
+          AND COALESCE(p.province, '') = COALESCE(a.province, '')
+          AND COALESCE(p.city, '') = COALESCE(a.city, '')
+          AND COALESCE(p.street, '') = COALESCE(a.street, '')
+          AND COALESCE(p.house_no, '') = COALESCE(a.house_no, '')
+          AND COALESCE(p.email, '') = COALESCE(c.email, '')
+          AND COALESCE(p.phone_number, '') = COALESCE(c.phone_number, '')
+    """)
+    op.execute("""
+        UPDATE device_configuration d
+        SET branch_profile_id = p.id
+        FROM branch_profile p
+        WHERE p.device_id = d.device_id
+          AND COALESCE(p.province, '') = COALESCE(d.device_branch_address_province, '')
+          AND COALESCE(p.city, '') = COALESCE(d.device_branch_address_city, '')
+          AND COALESCE(p.street, '') = COALESCE(d.device_branch_address_street, '')
+          AND COALESCE(p.house_no, '') = COALESCE(d.device_branch_address_house_no, '')
+          AND COALESCE(p.email, '') = COALESCE(d.device_branch_contacts_email, '')
+          AND COALESCE(p.phone_number, '') = COALESCE(d.device_branch_contacts_phone_no, '')
+    """)
+
+
+def downgrade():
+    # Invoices saved since the upgrade only reference their profile; give them legacy rows again
+    op.execute("""
+        INSERT INTO device_branch_address (invoice_id, province, city, street, house_no, created_at, updated_at)
+        SELECT i.id, p.province, p.city, p.street, p.house_no, i.created_at, i.created_at
+        FROM invoice i
+        JOIN branch_profile p ON p.id = i.branch_profile_id
+        WHERE NOT EXISTS (SELECT 1 FROM device_branch_address a WHERE a.invoice_id = i.id)
+    """)
+    op.execute("""
+        INSERT INTO device_branch_contact (invoice_id, email, phone_number, created_at, updated_at)
+        SELECT i.id, p.email, p.phone_number, i.created_at, i.created_at
+        FROM invoice i
+        JOIN branch_profile p ON p.id = i.branch_profile_id
+        WHERE NOT EXISTS (SELECT 1 FROM device_branch_contact c WHERE c.invoice_id = i.id)
+    """)
+
+    op.drop_constraint('fk_device_configuration_branch_profile', 'device_configuration', type_='foreignkey')
+    op.drop_column('device_configuration', 'branch_profile_id')
+    op.drop_constraint('fk_invoice_branch_profile', 'invoice', type_='foreignkey')
+    op.drop_column('invoice', 'branch_profile_id')
+    op.drop_table('branch_profile')
@@ -0,0 +1,44 @@
+"""add fiscal day counter table
+
+Revision ID: fiscal_day_counter_001
+Revises: invoice_indexes_001
+Create Date: 2025-09-03 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'fiscal_day_counter_001'
+down_revision = 'invoice_indexes_001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('fiscal_day_counter',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('device_id', sa.String(length=50), nullable=False),
+    sa.Column('fiscal_day_no', sa.Integer(), nullable=False),
+    sa.Column('counter_type', sa.String(length=30), nullable=False),
+    sa.Column('currency', sa.String(length=10), nullable=False),
+    sa.Column('counter_key', sa.String(length=50), nullable=False),
+    sa.Column('tax_id', sa.Integer(), nullable=True),
+    sa.Column('tax_percent', sa.Float(), nullable=True),
+    sa.Column('money_type', sa.String(length=20), nullable=True),
+    sa.Column('value', sa.Numeric(precision=18, scale=4), nullable=False),
+    sa.Column('receipt_count', sa.Integer(), nullable=False),
+    sa.Column('line_count', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['device_id'], ['device_info.device_id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('device_id', 'fiscal_day_no', 'counter_type', 'currency', 'counter_key',
+                        name='uq_fiscal_day_counter')
+    )
+    # Existing fiscal days are seeded with their first new receipt, or with: flask fiscal-counters rebuild
+
+
+def downgrade():
+    op.drop_table('fiscal_day_counter')
@@ -0,0 +1,52 @@
+"""add fiscalization outbox table
+
+Revision ID: fiscalization_outbox_001
+Revises: fiscal_day_counter_001
+Create Date: 2025-09-04 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'fiscalization_outbox_001'
+down_revision = 'fiscal_day_counter_001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('fiscalization_outbox',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('tracking_id', sa.String(length=36), nullable=False),
+    sa.Column('device_id', sa.String(length=50), nullable=False),
+    sa.Column('invoice_id', sa.String(length=100), nullable=False),
+    sa.Column('fiscal_day_no', sa.Integer(), nullable=False),
+    sa.Column('receipt_global_no', sa.Integer(), nullable=False),
+    sa.Column('payload', sa.Text(), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('next_attempt_at', sa.DateTime(), nullable=True),
+    sa.Column('last_status_code', sa.Integer(), nullable=True),
+    sa.Column('last_error', sa.Text(), nullable=True),
+    sa.Column('claimed_by', sa.String(length=100), nullable=True),
+    sa.Column('claimed_at', sa.DateTime(), nullable=True),
+    sa.Column('zimra_receipt_id', sa.String(length=50), nullable=True),
+    sa.Column('zimra_response', sa.Text(), nullable=True),
+    sa.Column('response', sa.Text(), nullable=True),
+    sa.Column('fiscalized_at', sa.DateTime(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['device_id'], ['device_info.device_id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('tracking_id')
+    )
+    op.create_index('ix_outbox_device_status', 'fiscalization_outbox', ['device_id', 'status', 'id'], unique=False)
+    op.create_index('ix_outbox_device_invoice', 'fiscalization_outbox', ['device_id', 'invoice_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_outbox_device_invoice', table_name='fiscalization_outbox')
+    op.drop_index('ix_outbox_device_status', table_name='fiscalization_outbox')
+    op.drop_table('fiscalization_outbox')
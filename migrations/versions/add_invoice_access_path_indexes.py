@@ -0,0 +1,70 @@
+"""add indexes for invoice, line item and fiscal day access paths
+
+Revision ID: invoice_indexes_001
+Revises: receipt_chain_head_001
+Create Date: 2025-09-02 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'invoice_indexes_001'
+down_revision = 'receipt_chain_head_001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # CREATE/DROP INDEX CONCURRENTLY does not lock writes, but cannot run in a transaction
+    with op.get_context().autocommit_block():
+        # Invoice access paths
+        op.create_index('ix_invoice_device_fiscal_day', 'invoice', ['device_id', 'fiscal_day_number', 'receipt_global_no'], postgresql_concurrently=True)
+        op.create_index('ix_invoice_device_global_no', 'invoice', ['device_id', 'receipt_global_no'], postgresql_concurrently=True)
+        op.create_index('ix_invoice_device_zimra_receipt', 'invoice', ['device_id', 'zimra_receipt_number'], postgresql_concurrently=True)
+        op.create_index('ix_invoice_invoice_id', 'invoice', ['invoice_id'], postgresql_concurrently=True)
+        op.create_index('ix_invoice_created_at', 'invoice', ['created_at'], postgresql_concurrently=True)
+        op.create_index('ix_invoice_device_created_at', 'invoice', ['device_id', 'created_at'], postgresql_concurrently=True)
+    
+        # Line item lookups by invoice, covering the columns read by counter aggregation
+        op.create_index(
+            'ix_invoice_line_item_invoice_id', 'invoice_line_item', ['invoice_id'],
+            postgresql_include=['tax_code', 'tax_percent', 'tax_id', 'receipt_line_total'],
+            postgresql_concurrently=True
+        )
+    
+        # Branch address/contact lookups by invoice
+        op.create_index('ix_device_branch_address_invoice_id', 'device_branch_address', ['invoice_id'], postgresql_concurrently=True)
+        op.create_index('ix_device_branch_contact_invoice_id', 'device_branch_contact', ['invoice_id'], postgresql_concurrently=True)
+    
+        # Fiscal day lookups; the partial index serves the "current open day" queries
+        op.create_index('ix_fiscal_day_device_day_no', 'fiscal_day', ['device_id', 'fiscal_day_no'], postgresql_concurrently=True)
+        op.create_index('ix_fiscal_day_device_id', 'fiscal_day', ['device_id', 'id'], postgresql_concurrently=True)
+        op.create_index(
+            'ix_fiscal_day_device_open', 'fiscal_day', ['device_id', 'fiscal_day_no'],
+            postgresql_where=sa.text('is_open'),
+            postgresql_concurrently=True
+        )
+    
+        # Per-request configuration lookups
+        op.create_index('ix_device_configuration_device_id', 'device_configuration', ['device_id'], postgresql_concurrently=True)
+        op.create_index('ix_device_config_device_id', 'device_config', ['device_id'], postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_device_config_device_id', table_name='device_config', postgresql_concurrently=True)
+        op.drop_index('ix_device_configuration_device_id', table_name='device_configuration', postgresql_concurrently=True)
+        op.drop_index('ix_fiscal_day_device_open', table_name='fiscal_day', postgresql_concurrently=True)
+        op.drop_index('ix_fiscal_day_device_id', table_name='fiscal_day', postgresql_concurrently=True)
+        op.drop_index('ix_fiscal_day_device_day_no', table_name='fiscal_day', postgresql_concurrently=True)
+        op.drop_index('ix_device_branch_contact_invoice_id', table_name='device_branch_contact', postgresql_concurrently=True)
+        op.drop_index('ix_device_branch_address_invoice_id', table_name='device_branch_address', postgresql_concurrently=True)
+        op.drop_index('ix_invoice_line_item_invoice_id', table_name='invoice_line_item', postgresql_concurrently=True)
+        op.drop_index('ix_invoice_device_created_at', table_name='invoice', postgresql_concurrently=True)
+        op.drop_index('ix_invoice_created_at', table_name='invoice', postgresql_concurrently=True)
+        op.drop_index('ix_invoice_invoice_id', table_name='invoice', postgresql_concurrently=True)
+        op.drop_index('ix_invoice_device_zimra_receipt', table_name='invoice', postgresql_concurrently=True)
+        op.drop_index('ix_invoice_device_global_no', table_name='invoice', postgresql_concurrently=True)
+        op.drop_index('ix_invoice_device_fiscal_day', table_name='invoice', postgresql_concurrently=True)
@@ -0,0 +1,42 @@
+"""add invoice idempotency columns
+
+Revision ID: invoice_idempotency_001
+Revises: branch_profiles_001
+Create Date: 2025-09-09 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'invoice_idempotency_001'
+down_revision = 'branch_profiles_001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('invoice', sa.Column('idempotency_key', sa.String(length=100), nullable=True))
+    op.add_column('invoice', sa.Column('request_hash', sa.String(length=64), nullable=True))
+    op.add_column('invoice', sa.Column('fiscal_response', sa.Text(), nullable=True))
+    op.add_column('fiscalization_outbox', sa.Column('request_hash', sa.String(length=64), nullable=True))
+    op.add_column('fiscalization_outbox', sa.Column('idempotency_key', sa.String(length=100), nullable=True))
+    op.create_index('ix_outbox_device_idempotency_key', 'fiscalization_outbox',
+                    ['device_id', 'idempotency_key'], unique=False)
+
+    # CREATE INDEX CONCURRENTLY does not lock writes to invoice, but cannot run in a transaction
+    with op.get_context().autocommit_block():
+        op.create_index('ix_invoice_device_idempotency_key', 'invoice', ['device_id', 'idempotency_key'],
+                        unique=True, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_invoice_device_idempotency_key', table_name='invoice', postgresql_concurrently=True)
+    op.drop_index('ix_outbox_device_idempotency_key', table_name='fiscalization_outbox')
+    op.drop_column('fiscalization_outbox', 'idempotency_key')
+    op.drop_column('fiscalization_outbox', 'request_hash')
+    op.drop_column('invoice', 'fiscal_response')
+    op.drop_column('invoice', 'request_hash')
+    op.drop_column('invoice', 'idempotency_key')
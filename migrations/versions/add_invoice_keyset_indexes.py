@@ -0,0 +1,35 @@
+"""extend invoice listing indexes with id for keyset pagination
+
+Revision ID: invoice_keyset_001
+Revises: invoice_idempotency_001
+Create Date: 2025-09-10 09:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'invoice_keyset_001'
+down_revision = 'invoice_idempotency_001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # CREATE/DROP INDEX CONCURRENTLY does not lock writes, but cannot run in a transaction
+    with op.get_context().autocommit_block():
+        # (created_at, id) gives the listing a total order that a cursor can seek into
+        op.create_index('ix_invoice_created_at_id', 'invoice', ['created_at', 'id'], postgresql_concurrently=True)
+        op.create_index('ix_invoice_device_created_at_id', 'invoice', ['device_id', 'created_at', 'id'],
+                        postgresql_concurrently=True)
+        op.drop_index('ix_invoice_device_created_at', table_name='invoice', postgresql_concurrently=True)
+        op.drop_index('ix_invoice_created_at', table_name='invoice', postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.create_index('ix_invoice_created_at', 'invoice', ['created_at'], postgresql_concurrently=True)
+        op.create_index('ix_invoice_device_created_at', 'invoice', ['device_id', 'created_at'],
+                        postgresql_concurrently=True)
+        op.drop_index('ix_invoice_device_created_at_id', table_name='invoice', postgresql_concurrently=True)
+        op.drop_index('ix_invoice_created_at_id', table_name='invoice', postgresql_concurrently=True)
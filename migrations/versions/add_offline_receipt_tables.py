@@ -0,0 +1,60 @@
+"""add offline receipt and file tables
+
+Revision ID: offline_receipts_001
+Revises: fiscalization_outbox_001
+Create Date: 2025-09-05 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'offline_receipts_001'
+down_revision = 'fiscalization_outbox_001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('offline_file',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('device_id', sa.String(length=50), nullable=False),
+    sa.Column('fiscal_day_no', sa.Integer(), nullable=False),
+    sa.Column('file_sequence', sa.Integer(), nullable=False),
+    sa.Column('receipt_count', sa.Integer(), nullable=False),
+    sa.Column('first_global_no', sa.Integer(), nullable=True),
+    sa.Column('last_global_no', sa.Integer(), nullable=True),
+    sa.Column('file_size', sa.Integer(), nullable=True),
+    sa.Column('operation_id', sa.String(length=100), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['device_id'], ['device_info.device_id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('device_id', 'fiscal_day_no', 'file_sequence', name='uq_offline_file_sequence')
+    )
+    op.create_table('offline_receipt',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('device_id', sa.String(length=50), nullable=False),
+    sa.Column('invoice_id', sa.Integer(), nullable=False),
+    sa.Column('fiscal_day_no', sa.Integer(), nullable=False),
+    sa.Column('receipt_global_no', sa.Integer(), nullable=False),
+    sa.Column('payload', sa.LargeBinary(), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('offline_file_id', sa.Integer(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('uploaded_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['device_id'], ['device_info.device_id'], ),
+    sa.ForeignKeyConstraint(['invoice_id'], ['invoice.id'], ),
+    sa.ForeignKeyConstraint(['offline_file_id'], ['offline_file.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_offline_receipt_device_status', 'offline_receipt',
+                    ['device_id', 'status', 'receipt_global_no'], unique=False)
+    op.add_column('fiscal_day', sa.Column('close_payload', sa.Text(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('fiscal_day', 'close_payload')
+    op.drop_index('ix_offline_receipt_device_status', table_name='offline_receipt')
+    op.drop_table('offline_receipt')
+    op.drop_table('offline_file')
@@ -0,0 +1,36 @@
+"""add receipt chain head table
+
+Revision ID: receipt_chain_head_001
+Revises: allow_null_tax_percent, composite_unique_device_invoice_001
+Create Date: 2025-09-01 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'receipt_chain_head_001'
+down_revision = ('allow_null_tax_percent', 'composite_unique_device_invoice_001')
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('receipt_chain_head',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('device_id', sa.String(length=50), nullable=False),
+    sa.Column('fiscal_day_no', sa.Integer(), nullable=False),
+    sa.Column('last_hash', sa.String(length=255), nullable=True),
+    sa.Column('receipt_counter', sa.Integer(), nullable=False),
+    sa.Column('last_global_no', sa.Integer(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['device_id'], ['device_info.device_id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('device_id', 'fiscal_day_no', name='uq_chain_head_device_day')
+    )
+
+
+def downgrade():
+    op.drop_table('receipt_chain_head')
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Test script for the pure helpers
+This script checks the idempotency, pagination, counter, PDF cache and request timing
+helpers. None of them need a database, so it runs anywhere the app's packages are installed.
+"""
+
+import tempfile
+from datetime import datetime
+import pytest
+
+
+def test_receipt_request_hash():
+    """The fingerprint ignores key order but not values"""
+    from utils.idempotency import receipt_request_hash
+
+    receipt = {'invoiceNo': 'INV-1', 'receiptTotal': 11.5, 'receiptLines': [{'taxCode': 'C'}]}
+    reordered = {'receiptLines': [{'taxCode': 'C'}], 'receiptTotal': 11.5, 'invoiceNo': 'INV-1'}
+    changed = dict(receipt, receiptTotal=12.0)
+
+    assert receipt_request_hash(receipt) == receipt_request_hash(reordered)
+    assert receipt_request_hash(receipt) != receipt_request_hash(changed)
+    assert len(receipt_request_hash(receipt)) == 64
+    print("  ✓ receipt_request_hash")
+
+
+def test_receipt_replay_cache():
+    """Lookups by invoice number and Idempotency-Key, per device, with LRU eviction"""
+    from utils.idempotency import ReceiptReplayCache
+
+    cache = ReceiptReplayCache(max_entries=2)
+    cache.put('1', 'INV-1', 'h1', {'receiptID': 1}, idempotency_key='key-1')
+    cache.put('1', 'INV-2', 'h2', {'receiptID': 2})
+
+    assert cache.get('1', 'INV-1')['response'] == {'receiptID': 1}
+    assert cache.get(1, idempotency_key='key-1')['invoice_id'] == 'INV-1'
+    assert cache.get('2', 'INV-1') is None
+
+    # INV-1 was used last, so INV-2 is evicted first
+    cache.put('1', 'INV-3', 'h3', {'receiptID': 3})
+    assert cache.get('1', 'INV-2') is None
+
+    # Evicting an entry forgets its Idempotency-Key too
+    cache.put('1', 'INV-4', 'h4', {'receiptID': 4})
+    assert cache.get('1', idempotency_key='key-1') is None
+    assert cache.get('1', 'INV-3') is not None
+
+    stats = cache.stats()
+    assert stats['entries'] == 2
+    assert stats['hits'] == 3 and stats['misses'] == 3
+    print("  ✓ ReceiptReplayCache")
+
+
+def test_pagination_cursor():
+    """Cursors round-trip, including invoices without created_at, and reject garbage"""
+    from utils.invoice_pagination import decode_cursor, encode_cursor
+
+    created_at = datetime(2026, 10, 16, 9, 30, 15, 123456)
+    assert decode_cursor(encode_cursor(created_at, 42)) == (created_at, 42)
+    assert decode_cursor(encode_cursor(None, 7)) == (None, 7)
+    assert '=' not in encode_cursor(created_at, 42)
+
+    for cursor in ('', 'not-a-cursor', encode_cursor(created_at, 42)[:-3]):
+        with pytest.raises(ValueError):
+            decode_cursor(cursor)
+    print("  ✓ encode_cursor / decode_cursor")
+
+
+def test_summarize_line_groups():
+    """Grouped lines add up to per-currency tax and money type totals"""
+    from utils.generate_counters import summarize_line_groups
+
+    groups = [
+        {'currency': 'USD', 'money_type': 'Cash', 'tax_code': 'C', 'tax_percent': 15.0, 'tax_id': 3,
+         'line_total': 10.0, 'line_count': 2},
+        {'currency': 'USD', 'money_type': None, 'tax_code': 'A', 'tax_percent': None, 'tax_id': 1,
+         'line_total': 4.0, 'line_count': 1},
+        {'currency': 'ZWG', 'money_type': 'Card', 'tax_code': 'C', 'tax_percent': 15.0, 'tax_id': 3,
+         'line_total': 100.0, 'line_count': 1},
+    ]
+    summaries = summarize_line_groups(groups)
+
+    assert set(summaries) == {'USD', 'ZWG'}
+    usd = summaries['USD']
+    assert usd['tax_summary']['3_15.0']['salesAmountWithTax'] == pytest.approx(23.0)
+    assert usd['tax_summary']['3_15.0']['taxAmount'] == pytest.approx(3.0)
+    exempt = [tax for tax in usd['tax_summary'].values() if tax['taxID'] == 1]
+    assert len(exempt) == 1 and exempt[0]['taxAmount'] == 0.0
+    assert usd['balance_by_money_type'] == {'Cash': pytest.approx(27.0)}
+    assert summaries['ZWG']['balance_by_money_type'] == {'Card': pytest.approx(115.0)}
+    assert summarize_line_groups([]) == {}
+    print("  ✓ summarize_line_groups")
+
+
+def test_invoice_pdf_cache():
+    """PDFs are stored under a key that changes with the template version"""
+    from utils.pdf_cache import InvoicePdfCache
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = InvoicePdfCache(directory, template_version='1')
+        key = cache.key('1', 'INV-1')
+
+        assert key == cache.key('1', 'INV-1')
+        assert key != cache.key('2', 'INV-1')
+        assert key != InvoicePdfCache(directory, template_version='2').key('1', 'INV-1')
+
+        assert not cache.contains(key)
+        assert cache.get(key) is None
+        cache.put(key, b'%PDF-1.4 test')
+        assert cache.contains(key)
+        assert cache.get(key) == b'%PDF-1.4 test'
+
+        stats = cache.stats()
+        assert (stats['hits'], stats['misses'], stats['writes']) == (1, 1, 1)
+    print("  ✓ InvoicePdfCache")
+
+
+def test_request_timings():
+    """Percentiles are taken over the rolling window; counts cover every request"""
+    from utils.request_timing import RequestTimings, TOTAL_PHASE
+
+    timings = RequestTimings(window=100)
+    for duration in range(1, 201):
+        timings.record('api.submit_receipt', {TOTAL_PHASE: float(duration), 'fdms': duration / 2})
+
+    total = timings.stats()['endpoints']['api.submit_receipt'][TOTAL_PHASE]
+    assert total['count'] == 200 and total['window'] == 100
+    assert total['p50_ms'] == 150.0
+    assert total['p95_ms'] == 195.0
+    assert total['p99_ms'] == 199.0
+    assert total['max_ms'] == 200.0
+    assert total['mean_ms'] == 150.5
+
+    timings.clear()
+    assert timings.stats()['endpoints'] == {}
+    print("  ✓ RequestTimings")
+
+
+def main():
+    """Run all helper tests"""
+    print("=== ZIMRA API Service - Helper Tests ===")
+    tests = [
+        test_receipt_request_hash,
+        test_receipt_replay_cache,
+        test_pagination_cursor,
+        test_summarize_line_groups,
+        test_invoice_pdf_cache,
+        test_request_timings,
+    ]
+
+    failed = 0
+    for test in tests:
+        try:
+            test()
+        except Exception as e:
+            failed += 1
+            print(f"  ✗ {test.__name__}: {e!r}")
+
+    print()
+    if failed:
+        print(f"✗ {failed} of {len(tests)} tests failed")
+        return 1
+    print(f"✓ All {len(tests)} tests passed")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
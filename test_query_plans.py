@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Query plan regression test
+This script checks that the hot queries in app/routes.py and utils/invoice_utils.py
+are served by an index on PostgreSQL. Sequential scans are disabled for the check so
+that small development tables still show which index the planner would pick.
+"""
+
+from datetime import datetime
+import pytest
+from sqlalchemy import func, tuple_
+
+
+def collect_index_names(plan: dict) -> set:
+    """Collect every index used anywhere in an EXPLAIN (FORMAT JSON) plan tree"""
+    names = set()
+    if 'Index Name' in plan:
+        names.add(plan['Index Name'])
+    for child in plan.get('Plans', []):
+        names |= collect_index_names(child)
+    return names
+
+
+def get_hot_queries():
+    """Build the hot queries used by the request handlers and invoice utilities"""
+    from app.models import (
+        DeviceInfo, FiscalDay, Invoice, InvoiceLineItem, BranchProfile,
+        DeviceConfiguration, ReceiptChainHead, FiscalDayCounter,
+        FiscalizationOutbox, OfflineReceipt
+    )
+    from utils.invoice_pagination import LISTING_ORDER
+
+    device_id = '26428'
+    return [
+        # app/routes.py
+        ("device lookup", DeviceInfo.query.filter_by(device_id=device_id).limit(1),
+         'device_info_device_id_key'),
+        ("open fiscal day", FiscalDay.query.filter_by(device_id=device_id, is_open=True)
+         .order_by(FiscalDay.fiscal_day_no.desc()).limit(1), 'ix_fiscal_day_device_open'),
+        ("fiscal day by number", FiscalDay.query.filter_by(device_id=device_id, fiscal_day_no=1).limit(1),
+         'ix_fiscal_day_device_day_no'),
+        ("last fiscal day", FiscalDay.query.filter_by(device_id=device_id).order_by(FiscalDay.id.desc()).limit(1),
+         'ix_fiscal_day_device_id'),
+        ("device configuration", DeviceConfiguration.query.filter_by(device_id=device_id).limit(1),
+         'ix_device_configuration_device_id'),
+        ("fiscal day invoices", Invoice.query.filter_by(device_id=device_id, fiscal_day_number='1'),
+         'ix_invoice_device_fiscal_day'),
+        ("invoice by invoice_id", Invoice.query.filter_by(invoice_id='INV-1').limit(1),
+         'ix_invoice_invoice_id'),
+        ("invoice line items", InvoiceLineItem.query.filter_by(invoice_id=1),
+         'ix_invoice_line_item_invoice_id'),
+        ("branch profile by content", BranchProfile.query.filter_by(device_id=device_id, content_hash='0' * 64)
+         .limit(1), 'uq_branch_profile_device_hash'),
+        ("invoice listing", Invoice.query.order_by(*LISTING_ORDER).limit(11),
+         'ix_invoice_created_at_id'),
+        ("invoice listing after cursor", Invoice.query
+         .filter(tuple_(Invoice.created_at, Invoice.id) < tuple_(datetime(2025, 1, 1), 1000))
+         .order_by(*LISTING_ORDER).limit(11), 'ix_invoice_created_at_id'),
+        ("device invoice listing", Invoice.query.filter_by(device_id=device_id)
+         .order_by(*LISTING_ORDER).limit(11), 'ix_invoice_device_created_at_id'),
+        # utils/invoice_utils.py
+        ("duplicate check", Invoice.query.filter_by(device_id=device_id, invoice_id='INV-1').limit(1),
+         'uq_device_invoice'),
+        ("idempotency key", Invoice.query.filter_by(device_id=device_id, idempotency_key='key-1').limit(1),
+         'ix_invoice_device_idempotency_key'),
+        ("highest global number", Invoice.query.with_entities(func.max(Invoice.receipt_global_no))
+         .filter_by(device_id=device_id), 'ix_invoice_device_global_no'),
+        ("credit/debit note reference", Invoice.query.filter_by(device_id=device_id, zimra_receipt_number='1')
+         .limit(1), 'ix_invoice_device_zimra_receipt'),
+        ("chain head", ReceiptChainHead.query.filter_by(device_id=device_id, fiscal_day_no=1).limit(1),
+         'uq_chain_head_device_day'),
+        # utils/fiscal_day_counters.py
+        ("fiscal day counters", FiscalDayCounter.query.filter_by(device_id=device_id, fiscal_day_no=1),
+         'uq_fiscal_day_counter'),
+        # utils/fiscalization_outbox.py
+        ("outbox queue head", FiscalizationOutbox.query.filter_by(device_id=device_id, status='pending')
+         .order_by(FiscalizationOutbox.id).limit(1), 'ix_outbox_device_status'),
+        ("outbox duplicate check", FiscalizationOutbox.query.filter_by(device_id=device_id, invoice_id='INV-1')
+         .limit(1), 'ix_outbox_device_invoice'),
+        # utils/offline_receipts.py
+        ("offline upload batch", OfflineReceipt.query.filter_by(device_id=device_id, status='pending')
+         .order_by(OfflineReceipt.receipt_global_no).limit(100), 'ix_offline_receipt_device_status'),
+    ]
+
+
+def test_hot_queries_use_indexes():
+    """Assert that every hot query is planned with its expected index"""
+    print("=== Testing Query Plans ===")
+
+    try:
+        from app import create_app, db
+        app = create_app()
+    except Exception as e:
+        pytest.skip(f"Could not connect to the database: {e}")
+
+    with app.app_context():
+        failures = []
+        connection = db.session.connection()
+        connection.exec_driver_sql("SET LOCAL enable_seqscan = off")
+
+        for name, query, expected_index in get_hot_queries():
+            sql = str(query.statement.compile(
+                dialect=db.engine.dialect,
+                compile_kwargs={"literal_binds": True}
+            ))
+            plan = connection.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {sql}").scalar()
+            used_indexes = collect_index_names(plan[0]['Plan'])
+
+            if expected_index in used_indexes:
+                print(f"  ✓ {name}: {expected_index}")
+            else:
+                print(f"  ✗ {name}: expected {expected_index}, got {sorted(used_indexes) or 'no index'}")
+                failures.append(name)
+
+        db.session.rollback()
+
+    assert not failures, f"Queries not using their index: {', '.join(failures)}"
+
+
+def main():
+    """Main test function"""
+    try:
+        test_hot_queries_use_indexes()
+        print("\n✓ All hot queries use an index")
+    except AssertionError as e:
+        print(f"\n✗ {e}")
+    except pytest.skip.Exception as e:
+        print(f"\n- Skipped: {e}")
+
+
+if __name__ == "__main__":
+    main()
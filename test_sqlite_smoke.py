@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+SQLite smoke test
+This script runs the global number allocator, the hash-chain head, the fiscal day
+counters, the idempotent replay lookup and keyset pagination against an in-memory
+SQLite database. Production runs on PostgreSQL (see test_database.py and
+test_query_plans.py); this only checks the logic, not locking or query plans.
+"""
+
+import json
+from datetime import datetime, timedelta
+import pytest
+from flask import Flask
+from app import db
+
+
+def create_test_app():
+    """Create a bare Flask app with the models on a fresh in-memory SQLite database"""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    db.init_app(app)
+    with app.app_context():
+        from app import models  # noqa: F401  (registers the tables)
+        db.create_all()
+    return app
+
+
+@pytest.fixture
+def app_context():
+    """Run a test inside the app context of a fresh database"""
+    app = create_test_app()
+    with app.app_context():
+        yield
+        db.session.remove()
+
+
+def add_invoice(global_no: int, device_id: str = '1', fiscal_day_no: int = 1, lines: tuple = ((10.0, 'C'),),
+                is_fiscalized: bool = True, created_at: datetime = None, **fields):
+    """Add a USD cash invoice with one line item per (line_total, tax_code) and flush it"""
+    from app.models import Invoice, InvoiceLineItem
+
+    invoice = Invoice(
+        invoice_id=f'INV-{global_no}', device_id=device_id, fiscal_day_number=str(fiscal_day_no),
+        receipt_type='FiscalInvoice', receipt_currency='USD', money_type='Cash',
+        receipt_counter=len(lines), receipt_global_no=global_no, is_fiscalized=is_fiscalized,
+        receipt_total=sum(total * (1.15 if code == 'C' else 1) for total, code in lines),
+        hash_string=f'hash-{global_no}', created_at=created_at, **fields
+    )
+    db.session.add(invoice)
+    db.session.flush()
+
+    line_items = []
+    for line_no, (line_total, tax_code) in enumerate(lines, 1):
+        line_item = InvoiceLineItem(
+            invoice_id=invoice.id, receipt_line_type='Sale', receipt_line_no=line_no,
+            receipt_line_name='Item', receipt_line_price=line_total, receipt_line_quantity=1,
+            receipt_line_total=line_total, tax_code=tax_code,
+            tax_percent=15.0 if tax_code == 'C' else None, tax_id=3 if tax_code == 'C' else 1
+        )
+        db.session.add(line_item)
+        line_items.append(line_item)
+    db.session.flush()
+    return invoice, line_items
+
+
+def test_global_number_allocator(app_context):
+    """Ranges continue from the highest stored number and release() gives back the unused tail"""
+    from app.models import DeviceGlobalNumber
+    from utils.global_number_allocator import global_number_allocator
+
+    add_invoice(41)
+    assert global_number_allocator.next_number('1') == 42
+    assert global_number_allocator.reserve('1', count=5) == 43
+
+    # Only two of 43..47 were used
+    global_number_allocator.release('1', last_used=44)
+    assert global_number_allocator.next_number('1') == 45
+
+    # Releasing past the counter never moves it forward
+    global_number_allocator.release('1', last_used=99)
+    assert DeviceGlobalNumber.query.filter_by(device_id='1').one().current_global_number == 45
+
+    # Devices have separate sequences
+    assert global_number_allocator.next_number('2') == 1
+    print("  ✓ global number allocator")
+
+
+def test_chain_head_rewind(app_context):
+    """Rewinding drops receipts chained ahead of ZIMRA and chains off the last accepted one"""
+    from utils.invoice_utils import advance_chain_head, get_chain_head, rewind_chain_head
+
+    add_invoice(1)
+    add_invoice(2)
+    head = get_chain_head('1', 1)
+    assert (head.last_hash, head.receipt_counter, head.last_global_no) == ('hash-2', 2, 2)
+
+    # Receipt 3 is chained before ZIMRA has accepted it
+    add_invoice(3, is_fiscalized=False)
+    head = advance_chain_head('1', 1, 'hash-3', 3)
+    assert (head.last_hash, head.receipt_counter, head.last_global_no) == ('hash-3', 3, 3)
+
+    head = rewind_chain_head('1', 1)
+    assert (head.last_hash, head.receipt_counter, head.last_global_no) == ('hash-2', 2, 2)
+    assert rewind_chain_head('1', 2) is None
+    print("  ✓ chain head rewind")
+
+
+def test_fiscal_day_counters(app_context):
+    """Running counter upserts agree with a full rebuild of the day"""
+    from utils.fiscal_day_counters import (
+        add_invoice_to_fiscal_counters, add_invoices_to_fiscal_counters,
+        load_fiscal_day_counters, rebuild_fiscal_day_counters
+    )
+
+    # The first receipt seeds the day's counters, later ones are upserted
+    add_invoice_to_fiscal_counters(*add_invoice(1, lines=((10.0, 'C'),)))
+    add_invoices_to_fiscal_counters([
+        add_invoice(2, lines=((20.0, 'C'), (5.0, 'A'))),
+        add_invoice(3, lines=((4.0, 'A'),)),
+    ])
+    running = load_fiscal_day_counters('1', 1)
+
+    invoice_totals, summaries = running
+    assert invoice_totals['USD']['invoice_count'] == 3
+    assert invoice_totals['USD']['total_amount'] == pytest.approx(43.5)
+    assert summaries['USD']['balance_by_money_type']['Cash'] == pytest.approx(43.5)
+    assert summaries['USD']['tax_summary']['3_15.0']['taxAmount'] == pytest.approx(4.5)
+
+    rebuild_fiscal_day_counters('1', 1)
+    assert load_fiscal_day_counters('1', 1) == running
+    assert load_fiscal_day_counters('1', 2) is None
+    print("  ✓ fiscal day counters")
+
+
+def test_fiscalized_receipt_replay(app_context):
+    """A retry is found by invoice number or Idempotency-Key, the key's owner winning"""
+    from utils.idempotency import find_fiscalized_receipt, receipt_replay_cache
+
+    receipt_replay_cache.clear()
+    response = {'receiptID': 1001}
+    add_invoice(1, idempotency_key='key-1', request_hash='h1', fiscal_response=json.dumps(response))
+    add_invoice(2, request_hash='h2', fiscal_response=json.dumps({'receiptID': 1002}))
+
+    found = find_fiscalized_receipt('1', 'INV-1')
+    assert (found['request_hash'], found['response']) == ('h1', response)
+
+    # Another invoice number with INV-1's key replays INV-1
+    assert find_fiscalized_receipt('1', 'INV-2', idempotency_key='key-1')['invoice_id'] == 'INV-1'
+    assert find_fiscalized_receipt('1', 'INV-3') is None
+    assert find_fiscalized_receipt('2', 'INV-1') is None
+
+    # The hits above were cached, so the cache answers without the database
+    assert receipt_replay_cache.get('1', idempotency_key='key-1')['response'] == response
+    receipt_replay_cache.clear()
+    print("  ✓ fiscalized receipt replay")
+
+
+def test_keyset_pagination(app_context):
+    """Keyset pages list the same invoices in the same order as offset paging"""
+    from app.models import Invoice
+    from utils.invoice_pagination import LISTING_ORDER, paginate_invoices_keyset
+
+    start = datetime(2026, 10, 16, 8, 0)
+    created = [start, start + timedelta(minutes=1), None, start + timedelta(minutes=1), start, None, start]
+    for global_no, created_at in enumerate(created, 1):
+        invoice, _ = add_invoice(global_no, created_at=created_at)
+        if created_at is None:
+            # Legacy rows: the column default would otherwise fill in created_at
+            Invoice.query.filter_by(id=invoice.id).update({'created_at': None}, synchronize_session=False)
+    db.session.expire_all()
+    assert Invoice.query.filter(Invoice.created_at.is_(None)).count() == 2
+    expected = [invoice.id for invoice in Invoice.query.order_by(*LISTING_ORDER).all()]
+
+    paged = []
+    cursor = None
+    while True:
+        invoices, cursor = paginate_invoices_keyset(Invoice.query, cursor=cursor, per_page=2)
+        paged.extend(invoice.id for invoice in invoices)
+        if cursor is None:
+            break
+
+    assert paged == expected
+    assert len(set(paged)) == len(created)
+    print("  ✓ keyset pagination")
+
+
+def main():
+    """Run all SQLite smoke tests"""
+    print("=== ZIMRA API Service - SQLite Smoke Test ===")
+    tests = [
+        test_global_number_allocator,
+        test_chain_head_rewind,
+        test_fiscal_day_counters,
+        test_fiscalized_receipt_replay,
+        test_keyset_pagination,
+    ]
+
+    failed = 0
+    for test in tests:
+        app = create_test_app()
+        with app.app_context():
+            try:
+                test(None)
+            except Exception as e:
+                failed += 1
+                print(f"  ✗ {test.__name__}: {e!r}")
+            finally:
+                db.session.remove()
+
+    print()
+    if failed:
+        print(f"✗ {failed} of {len(tests)} tests failed")
+        return 1
+    print(f"✓ All {len(tests)} tests passed")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
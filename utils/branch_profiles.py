@@ -0,0 +1,122 @@
+import hashlib
+import json
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.models import BranchProfile
+
+
+# Profile fields in canonical (hashing) order
+PROFILE_FIELDS = ('province', 'city', 'street', 'house_no', 'email', 'phone_number')
+
+# Tries at the next version number when concurrent transactions add profiles for a device
+VERSION_ATTEMPTS = 5
+
+
+def branch_profile_fields(address: dict = None, contact: dict = None) -> dict:
+    """
+    Map a ZIMRA deviceBranchAddress / deviceBranchContacts pair to profile columns.
+
+    Parameters:
+        address (dict): province, city, street and houseNo
+        contact (dict): email and phoneNo
+
+    Returns:
+        dict: Profile column values
+    """
+    address = address or {}
+    contact = contact or {}
+    return {
+        'province': address.get('province'),
+        'city': address.get('city'),
+        'street': address.get('street'),
+        'house_no': address.get('houseNo', address.get('house_no')),
+        'email': contact.get('email'),
+        'phone_number': contact.get('phoneNo', contact.get('phone_number'))
+    }
+
+
+def branch_profile_hash(fields: dict) -> str:
+    """SHA-256 of the profile fields, treating missing and empty values alike"""
+    canonical = json.dumps(
+        [str(fields.get(field) or '') for field in PROFILE_FIELDS],
+        separators=(',', ':'),
+        ensure_ascii=False
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def get_or_create_branch_profile(device_id: str, fields: dict) -> BranchProfile:
+    """
+    Get a device's branch profile with these fields, adding a new version if it has none.
+
+    Runs in the caller's transaction (the new row is flushed, not committed). When a
+    concurrent transaction takes the next version number for another snapshot, the
+    version is allocated again.
+
+    Parameters:
+        device_id (str): Device identifier
+        fields (dict): Profile column values, see branch_profile_fields
+
+    Returns:
+        BranchProfile: Existing or new snapshot
+    """
+    device_id = str(device_id)
+    content_hash = branch_profile_hash(fields)
+
+    profile = BranchProfile.query.filter_by(device_id=device_id, content_hash=content_hash).first()
+    if profile is not None:
+        return profile
+
+    for attempt in range(1, VERSION_ATTEMPTS + 1):
+        latest_version = db.session.query(func.max(BranchProfile.version)).filter(
+            BranchProfile.device_id == device_id
+        ).scalar() or 0
+        profile = BranchProfile(
+            device_id=device_id,
+            version=latest_version + 1,
+            content_hash=content_hash,
+            **{field: fields.get(field) for field in PROFILE_FIELDS}
+        )
+        try:
+            # Savepoint, so a concurrent insert does not undo the caller's work
+            with db.session.begin_nested():
+                db.session.add(profile)
+            return profile
+        except IntegrityError:
+            # Either the same snapshot was added (uq_branch_profile_device_hash)
+            # or another one took this version (uq_branch_profile_device_version)
+            profile = BranchProfile.query.filter_by(device_id=device_id, content_hash=content_hash).first()
+            if profile is not None:
+                return profile
+            if attempt == VERSION_ATTEMPTS:
+                raise
+
+
+def resolve_branch_profile_ids(records: list) -> list:
+    """
+    Get the branch profile ID of each (invoice_data, update_data) record to be saved.
+
+    A record carries the ID of its device's current profile (branch_profile_id, taken
+    from DeviceConfiguration); records without one are matched by content, once per
+    distinct device and profile.
+
+    Returns:
+        list: Profile IDs (or None when a record has no branch data), in record order
+    """
+    resolved = {}
+    profile_ids = []
+    for invoice_data, update_data in records:
+        if update_data.get('branch_profile_id'):
+            profile_ids.append(update_data['branch_profile_id'])
+            continue
+        if 'device_branch_address' not in update_data and 'device_branch_contact' not in update_data:
+            profile_ids.append(None)
+            continue
+
+        fields = branch_profile_fields(update_data.get('device_branch_address'), update_data.get('device_branch_contact'))
+        key = (str(invoice_data['device_id']), branch_profile_hash(fields))
+        if key not in resolved:
+            resolved[key] = get_or_create_branch_profile(invoice_data['device_id'], fields).id
+        profile_ids.append(resolved[key])
+    return profile_ids
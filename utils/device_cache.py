@@ -0,0 +1,155 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+
+
+def snapshot_row(row):
+    """
+    Copy the column values of a model row into a detached, read-only-by-convention object.
+
+    Snapshots keep attribute access (device.key_path, device_config.qr_url) but are not
+    bound to a database session, so they can be shared across requests and threads.
+    Use the ORM query when a row has to be modified.
+    """
+    if row is None:
+        return None
+    return SimpleNamespace(**{column.key: getattr(row, column.key) for column in row.__table__.columns})
+
+
+class DeviceContextCache:
+    """
+    Process-local cache of everything the handlers read about a device.
+
+    One entry holds a snapshot of the DeviceInfo row, a snapshot of the
+    DeviceConfiguration row and the parsed DeviceConfig JSON, loaded together on a
+    miss. Entries expire after `ttl` seconds and the least recently used entry is
+    evicted once `max_entries` devices are cached. Code that writes one of the three
+    tables calls invalidate() so the next request reloads the device.
+    """
+
+    def __init__(self, ttl: float = 300.0, max_entries: int = 1024):
+        """
+        Initialize the cache.
+
+        Args:
+            ttl (float): Seconds an entry stays valid (0 disables caching)
+            max_entries (int): Devices kept before the least recently used one is evicted
+        """
+        self.ttl = ttl
+        self.max_entries = max(1, int(max_entries))
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._expired = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def _load(self, device_id: str) -> dict:
+        """Read a device's rows from the database (needs an app context)"""
+        from app.models import DeviceConfig, DeviceConfiguration, DeviceInfo
+
+        device = DeviceInfo.query.filter_by(device_id=device_id).first()
+        if device is None:
+            return None
+        configuration = DeviceConfiguration.query.filter_by(device_id=device_id).first()
+        config_row = DeviceConfig.query.filter_by(device_id=device_id).first()
+        return {
+            'device': snapshot_row(device),
+            'configuration': snapshot_row(configuration),
+            'config': json.loads(config_row.config) if config_row else {}
+        }
+
+    def get(self, device_id: str) -> dict:
+        """
+        Get the cached context of a device, loading it on a miss.
+
+        Unknown devices are not cached, so a device registered later is found at once.
+
+        Args:
+            device_id (str): Device identifier
+
+        Returns:
+            dict: device, configuration (snapshots, configuration may be None) and config
+            (parsed DeviceConfig JSON), or None if the device is not registered
+        """
+        device_id = str(device_id)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(device_id)
+            if entry is not None:
+                if entry['expires_at'] > now:
+                    self._hits += 1
+                    self._entries.move_to_end(device_id)
+                    return entry['context']
+                self._expired += 1
+                del self._entries[device_id]
+            self._misses += 1
+            generation = self._invalidations
+
+        context = self._load(device_id)
+        if context is None or self.ttl <= 0:
+            return context
+
+        with self._lock:
+            # Skip storing a load that raced with an invalidation
+            if generation == self._invalidations:
+                self._entries[device_id] = {'context': context, 'expires_at': now + self.ttl}
+                self._entries.move_to_end(device_id)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self._evictions += 1
+        return context
+
+    def invalidate(self, device_id: str = None):
+        """Forget the cached context of a device, or of every device when no device is given"""
+        with self._lock:
+            self._invalidations += 1
+            if device_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(str(device_id), None)
+
+    def stats(self) -> dict:
+        """Get cache hit/miss counters"""
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_ratio': round(self._hits / total, 4) if total else 0.0,
+                'expired': self._expired,
+                'evictions': self._evictions,
+                'invalidations': self._invalidations,
+                'ttl': self.ttl,
+                'max_entries': self.max_entries,
+                'devices': list(self._entries.keys())
+            }
+
+
+# Global device context cache shared by all request threads
+device_cache = DeviceContextCache(
+    ttl=float(os.environ.get('ZIMRA_DEVICE_CACHE_TTL', '300')),
+    max_entries=int(os.environ.get('ZIMRA_DEVICE_CACHE_SIZE', '1024'))
+)
+
+
+def get_cached_device(device_id: str):
+    """Get the DeviceInfo snapshot of a device, or None if it is not registered"""
+    context = device_cache.get(device_id)
+    return context['device'] if context else None
+
+
+def get_cached_device_configuration(device_id: str):
+    """Get the DeviceConfiguration snapshot of a device, or None if it has none"""
+    context = device_cache.get(device_id)
+    return context['configuration'] if context else None
+
+
+def invalidate_device(device_id: str = None):
+    """Drop a device from the cache after its DeviceInfo, DeviceConfiguration or DeviceConfig changed"""
+    device_cache.invalidate(device_id)
@@ -0,0 +1,189 @@
+import asyncio
+import json
+import os
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from app.config import zimra_config
+from utils.fdms_session import get_fdms_session
+
+
+def load_fdms_devices(device_ids: list = None) -> list:
+    """
+    Load the FDMS credentials of devices for the async client.
+
+    Must be called inside an app context; the returned dicts are plain data so they
+    can be used from worker threads without a database session.
+
+    Parameters:
+        device_ids (list): Devices to load (None loads every DeviceInfo row)
+
+    Returns:
+        list: Dicts with device_id, cert_path, key_path, model_name and model_version
+    """
+    from app.models import DeviceInfo
+
+    query = DeviceInfo.query
+    if device_ids:
+        query = query.filter(DeviceInfo.device_id.in_([str(device_id) for device_id in device_ids]))
+    return [
+        {
+            'device_id': device.device_id,
+            'cert_path': device.certificate_path,
+            'key_path': device.key_path,
+            'model_name': device.model_name,
+            'model_version': device.model_version
+        }
+        for device in query.order_by(DeviceInfo.device_id).all()
+    ]
+
+
+class AsyncFdmsClient:
+    """
+    asyncio client for FDMS calls across many devices.
+
+    Calls run on the pooled per-device requests sessions in a dedicated thread pool,
+    whose size is the global cap on concurrent FDMS requests for the whole process.
+    Calls for the same device are serialized (the hash chain and the fiscal day state
+    require it), while different devices proceed in parallel. Within one run() they
+    are also made in the order they were issued; across runs, and against the
+    synchronous handlers, the pooled session's process-wide device lock (see
+    utils.fdms_session) keeps one call per device in flight, in lock order.
+
+    Every call returns a result dict instead of raising, so one unreachable device
+    does not abort a fleet-wide run.
+    """
+
+    def __init__(self, max_concurrency: int = 20, timeout: float = 60.0):
+        """
+        Initialize the client.
+
+        Args:
+            max_concurrency (int): FDMS requests in flight at once, across all devices
+            timeout (float): Connect/read timeout of each request, in seconds
+        """
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.timeout = timeout
+        self._executor = None
+        self._device_locks = weakref.WeakKeyDictionary()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """Create the worker pool on first use"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='fdms-async')
+        return self._executor
+
+    def _device_lock(self, device_id: str) -> asyncio.Lock:
+        """Get the lock keeping a device's calls in issue order on the running event loop"""
+        loop = asyncio.get_running_loop()
+        locks = self._device_locks.setdefault(loop, {})
+        if device_id not in locks:
+            locks[device_id] = asyncio.Lock()
+        return locks[device_id]
+
+    def _send(self, device: dict, method: str, endpoint: str, payload) -> dict:
+        """Make one blocking FDMS call (runs in the worker pool)"""
+        session = get_fdms_session(device['device_id'], device['cert_path'], device['key_path'])
+        headers = {
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "DeviceModelName": device['model_name'],
+            "DeviceModelVersion": device['model_version']
+        }
+        url = zimra_config.get_api_url(device['device_id'], endpoint)
+        data = json.dumps(payload) if payload is not None else None
+
+        started = time.perf_counter()
+        result = {
+            'device_id': device['device_id'],
+            'endpoint': endpoint,
+            'ok': False,
+            'status_code': None,
+            'data': None,
+            'error': None
+        }
+        try:
+            response = session.request(method, url, data=data, headers=headers, verify=False, timeout=self.timeout)
+            result['status_code'] = response.status_code
+            try:
+                result['data'] = response.json()
+            except ValueError:
+                result['data'] = response.text
+            result['ok'] = response.status_code == 200
+            if not result['ok']:
+                result['error'] = f"FDMS returned {response.status_code}"
+        except requests.RequestException as e:
+            result['error'] = str(e)
+        result['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        return result
+
+    async def request(self, device: dict, method: str, endpoint: str, payload=None) -> dict:
+        """
+        Call an FDMS endpoint for a device.
+
+        Args:
+            device (dict): Device credentials from load_fdms_devices
+            method (str): HTTP method
+            endpoint (str): FDMS endpoint name (e.g. 'GetStatus')
+            payload: JSON body, or None
+
+        Returns:
+            dict: device_id, endpoint, ok, status_code, data, error and elapsed_ms
+        """
+        async with self._device_lock(device['device_id']):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), self._send, device, method, endpoint, payload)
+
+    async def get_status(self, device: dict) -> dict:
+        """GetStatus for a device"""
+        return await self.request(device, 'GET', 'GetStatus')
+
+    async def get_config(self, device: dict) -> dict:
+        """GetConfig for a device"""
+        return await self.request(device, 'GET', 'GetConfig')
+
+    async def open_day(self, device: dict, fiscal_day_opened: str, fiscal_day_no: int = None) -> dict:
+        """OpenDay for a device"""
+        payload = {"fiscalDayOpened": fiscal_day_opened}
+        if fiscal_day_no is not None:
+            payload["fiscalDayNo"] = fiscal_day_no
+        return await self.request(device, 'POST', 'OpenDay', payload)
+
+    async def submit_receipt(self, device: dict, receipt: dict) -> dict:
+        """SubmitReceipt for a signed receipt"""
+        return await self.request(device, 'POST', 'SubmitReceipt', {"receipt": receipt})
+
+    async def close_day(self, device: dict, close_day_payload: dict) -> dict:
+        """CloseDay with a signed close day request"""
+        return await self.request(device, 'POST', 'CloseDay', close_day_payload)
+
+    async def for_each_device(self, devices: list, operation) -> list:
+        """
+        Run an operation for every device concurrently.
+
+        Args:
+            devices (list): Device credentials from load_fdms_devices
+            operation (callable): Coroutine function taking (client, device)
+
+        Returns:
+            list: Operation results, in the order of devices
+        """
+        return await asyncio.gather(*(operation(self, device) for device in devices))
+
+    def run(self, coroutine):
+        """Run a coroutine to completion from synchronous code (Flask handlers, CLI commands)"""
+        return asyncio.run(coroutine)
+
+    def close(self):
+        """Shut the worker pool down"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+# Global async client shared by the application
+fdms_async_client = AsyncFdmsClient(
+    max_concurrency=int(os.environ.get('ZIMRA_FDMS_MAX_CONCURRENCY', '20')),
+    timeout=float(os.environ.get('ZIMRA_FDMS_TIMEOUT', '60'))
+)
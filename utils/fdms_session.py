@@ -0,0 +1,170 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def _file_mtime(path: str) -> float:
+    """Return the modification time of a file, or 0.0 if it cannot be read"""
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0.0
+
+
+class DeviceSession(requests.Session):
+    """requests.Session whose calls are serialized by its device's process-wide lock"""
+
+    def __init__(self, device_lock: threading.Lock):
+        super().__init__()
+        self.device_lock = device_lock
+
+    def request(self, *args, **kwargs):
+        """Make the call while holding the device lock"""
+        with self.device_lock:
+            return super().request(*args, **kwargs)
+
+
+class FdmsSessionPool:
+    """
+    Registry of persistent mTLS sessions to FDMS, one per device.
+
+    Each device gets a requests.Session with its client certificate attached and
+    a keep-alive HTTPS adapter mounted, so consecutive calls reuse the same TCP +
+    TLS connection instead of paying a full client-certificate handshake per call.
+    Sessions are rebuilt when the device's certificate/key paths change or the
+    files on disk are replaced.
+
+    All calls for one device go through a process-wide lock (see device_lock), so the
+    Flask handlers, the outbox dispatcher and the asyncio client never have two FDMS
+    requests in flight for the same device; different devices are not serialized.
+    """
+
+    def __init__(self, pool_connections: int = 1, pool_maxsize: int = 10):
+        """
+        Initialize the session registry.
+
+        Args:
+            pool_connections (int): Number of host pools cached per adapter (FDMS is a single host)
+            pool_maxsize (int): Maximum number of keep-alive connections per device
+        """
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._device_locks = {}
+        self._hits = 0
+        self._misses = 0
+        self._reloads = 0
+
+    def device_lock(self, device_id: str) -> threading.Lock:
+        """Get the process-wide lock serializing a device's FDMS calls"""
+        device_id = str(device_id)
+        with self._lock:
+            return self._device_locks.setdefault(device_id, threading.Lock())
+
+    def _build_session(self, device_lock: threading.Lock, cert_path: str, key_path: str) -> requests.Session:
+        """Create a session with the client certificate and a keep-alive adapter"""
+        session = DeviceSession(device_lock)
+        session.cert = (cert_path, key_path)
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize
+        )
+        session.mount('https://', adapter)
+        return session
+
+    def get_session(self, device_id: str, cert_path: str, key_path: str) -> requests.Session:
+        """
+        Get the pooled session for a device, creating or reloading it if needed.
+
+        Args:
+            device_id (str): Device identifier
+            cert_path (str): Path to the device certificate (PEM)
+            key_path (str): Path to the device private key (PEM)
+
+        Returns:
+            requests.Session: Session with the device's client certificate attached
+        """
+        device_id = str(device_id)
+        fingerprint = (cert_path, key_path, _file_mtime(cert_path), _file_mtime(key_path))
+
+        with self._lock:
+            entry = self._sessions.get(device_id)
+            if entry is not None and entry['fingerprint'] == fingerprint:
+                self._hits += 1
+                entry['hits'] += 1
+                return entry['session']
+
+            self._misses += 1
+            if entry is not None:
+                # Certificate or key changed - drop the old connections
+                self._reloads += 1
+                entry['session'].close()
+
+            device_lock = self._device_locks.setdefault(device_id, threading.Lock())
+            session = self._build_session(device_lock, cert_path, key_path)
+            self._sessions[device_id] = {
+                'session': session,
+                'fingerprint': fingerprint,
+                'hits': 0
+            }
+            return session
+
+    def invalidate(self, device_id: str) -> bool:
+        """
+        Close and forget the session for a device.
+
+        Returns:
+            bool: True if a session was removed
+        """
+        with self._lock:
+            entry = self._sessions.pop(str(device_id), None)
+        if entry is None:
+            return False
+        entry['session'].close()
+        return True
+
+    def close_all(self):
+        """Close every pooled session"""
+        with self._lock:
+            entries = list(self._sessions.values())
+            self._sessions.clear()
+        for entry in entries:
+            entry['session'].close()
+
+    def stats(self) -> dict:
+        """
+        Get pool hit/miss statistics.
+
+        Returns:
+            dict: Totals plus per-device hit counts and certificate paths
+        """
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'reloads': self._reloads,
+                'hit_ratio': round(self._hits / total, 4) if total else 0.0,
+                'pool_maxsize': self.pool_maxsize,
+                'devices': {
+                    device_id: {
+                        'hits': entry['hits'],
+                        'certificate': entry['fingerprint'][0],
+                        'key': entry['fingerprint'][1]
+                    }
+                    for device_id, entry in self._sessions.items()
+                }
+            }
+
+
+# Global session registry shared by all request threads
+fdms_sessions = FdmsSessionPool(
+    pool_maxsize=int(os.environ.get('ZIMRA_FDMS_POOL_MAXSIZE', '10'))
+)
+
+
+def get_fdms_session(device_id: str, cert_path: str, key_path: str) -> requests.Session:
+    """Get the pooled FDMS session for a device"""
+    return fdms_sessions.get_session(device_id, cert_path, key_path)
@@ -0,0 +1,328 @@
+from datetime import datetime
+from decimal import Decimal
+from sqlalchemy import func
+from sqlalchemy.dialects import postgresql, sqlite
+from app import db
+from app.models import FiscalDayCounter, Invoice, InvoiceLineItem
+from utils.generate_counters import (
+    line_counter_amounts, get_fiscal_day_line_groups, generate_counters
+)
+
+
+# Internal counter type holding receipt count, receipt total and line count per raw currency
+RECEIPT_TOTAL = 'ReceiptTotal'
+
+COUNTER_KEY_COLUMNS = ['device_id', 'fiscal_day_no', 'counter_type', 'currency', 'counter_key']
+
+# Counter values are NUMERIC(18, 4); deltas are summed as Decimals at that scale
+COUNTER_VALUE_QUANTUM = Decimal('0.0001')
+
+
+def _to_decimal(value) -> Decimal:
+    """Convert an amount to a Decimal at the counter column's scale"""
+    return Decimal(str(value or 0)).quantize(COUNTER_VALUE_QUANTUM)
+
+
+def _add_delta(deltas: dict, counter_type: str, currency: str, counter_key: str, value: float,
+               receipt_count: int = 0, line_count: int = 0, **fields):
+    """Accumulate a change to one counter row, keeping the order counters were first seen"""
+    key = (counter_type, currency, counter_key)
+    entry = deltas.get(key)
+    if entry is None:
+        entry = {
+            'counter_type': counter_type,
+            'currency': currency,
+            'counter_key': counter_key,
+            'tax_id': None,
+            'tax_percent': None,
+            'money_type': None,
+            'value': Decimal('0'),
+            'receipt_count': 0,
+            'line_count': 0
+        }
+        entry.update(fields)
+        deltas[key] = entry
+    entry['value'] += _to_decimal(value)
+    entry['receipt_count'] += receipt_count
+    entry['line_count'] += line_count
+
+
+def _add_line_deltas(deltas: dict, currency: str, money_type: str, tax_code: str, tax_percent,
+                     tax_id, line_total, line_count: int = 1):
+    """Accumulate the SaleByTax, SaleTaxByTax and BalanceByMoneyType changes of line items"""
+    tax_percent, tax_id, tax_amount, sales_amount_with_tax = line_counter_amounts(
+        tax_code, tax_percent, tax_id, line_total
+    )
+    tax_key = f"{tax_id}_{tax_percent}"
+    money_type = money_type or 'Cash'
+
+    _add_delta(deltas, 'SaleByTax', currency, tax_key, sales_amount_with_tax * line_count,
+               line_count=line_count, tax_id=tax_id, tax_percent=tax_percent)
+    _add_delta(deltas, 'SaleTaxByTax', currency, tax_key, tax_amount * line_count,
+               line_count=line_count, tax_id=tax_id, tax_percent=tax_percent)
+    _add_delta(deltas, 'BalanceByMoneyType', currency, money_type, sales_amount_with_tax * line_count,
+               line_count=line_count, money_type=money_type)
+
+
+def _upsert_counter(device_id: str, fiscal_day_no: int, delta: dict):
+    """
+    Add a delta to a counter row, creating the row on first use.
+
+    On PostgreSQL and SQLite this is a single INSERT ... ON CONFLICT DO UPDATE, so
+    concurrent receipts for the same fiscal day add to the row atomically.
+    """
+    table = FiscalDayCounter.__table__
+    now = datetime.utcnow()
+    values = dict(delta, device_id=device_id, fiscal_day_no=fiscal_day_no, created_at=now, updated_at=now)
+    dialect = db.session.get_bind().dialect.name
+
+    if dialect in ('postgresql', 'sqlite'):
+        insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        statement = insert(table).values(**values)
+        statement = statement.on_conflict_do_update(
+            index_elements=COUNTER_KEY_COLUMNS,
+            set_={
+                'value': table.c.value + statement.excluded.value,
+                'receipt_count': table.c.receipt_count + statement.excluded.receipt_count,
+                'line_count': table.c.line_count + statement.excluded.line_count,
+                'updated_at': now
+            }
+        )
+        db.session.execute(statement)
+        return
+
+    # Other dialects: lock the row, then update or insert it
+    counter = FiscalDayCounter.query.filter_by(
+        **{column: values[column] for column in COUNTER_KEY_COLUMNS}
+    ).with_for_update().first()
+    if counter is None:
+        db.session.add(FiscalDayCounter(**values))
+    else:
+        counter.value += delta['value']
+        counter.receipt_count += delta['receipt_count']
+        counter.line_count += delta['line_count']
+
+
+def _add_invoice_deltas(deltas: dict, invoice: Invoice, line_items: list):
+    """Accumulate the counter changes of one fiscalized invoice"""
+    currency = invoice.receipt_currency or 'ZWG'
+    _add_delta(deltas, RECEIPT_TOTAL, currency, '', float(invoice.receipt_total or 0),
+               receipt_count=1, line_count=invoice.receipt_counter or 0)
+
+    for item in line_items:
+        _add_line_deltas(deltas, str(currency).upper(), invoice.money_type, item.tax_code,
+                         item.tax_percent, item.tax_id, item.receipt_line_total)
+
+
+def _has_fiscal_counters(device_id: str, fiscal_day_no: int) -> bool:
+    """Check whether a fiscal day has any running counter rows yet"""
+    return db.session.query(
+        FiscalDayCounter.query.filter_by(device_id=device_id, fiscal_day_no=fiscal_day_no).exists()
+    ).scalar()
+
+
+def add_invoices_to_fiscal_counters(entries: list):
+    """
+    Add newly fiscalized invoices to their fiscal days' running counters.
+
+    Changes are summed per counter first, so a batch of receipts costs one upsert
+    per touched counter rather than one per receipt. Runs inside the caller's
+    transaction, so the counters commit or roll back together with the invoices.
+
+    The first counter rows of a fiscal day are seeded with rebuild_fiscal_day_counters
+    instead, so a day that was already open before the counters existed starts from
+    all of its invoices rather than from this batch (the same lazy bootstrap as the
+    chain head). The invoices and their line items must already be flushed; the
+    device's global number row lock keeps two receipts from seeding the same day.
+
+    Parameters:
+        entries (list): (invoice, line_items) pairs; line_items may be None to load them
+    """
+    deltas_by_day = {}
+    for invoice, line_items in entries:
+        if line_items is None:
+            line_items = InvoiceLineItem.query.filter_by(
+                invoice_id=invoice.id
+            ).order_by(InvoiceLineItem.id).all()
+        day = (str(invoice.device_id), int(invoice.fiscal_day_number))
+        _add_invoice_deltas(deltas_by_day.setdefault(day, {}), invoice, line_items)
+
+    for (device_id, fiscal_day_no), deltas in deltas_by_day.items():
+        if not _has_fiscal_counters(device_id, fiscal_day_no):
+            rebuild_fiscal_day_counters(device_id, fiscal_day_no)
+            continue
+        for delta in deltas.values():
+            _upsert_counter(device_id, fiscal_day_no, delta)
+
+
+def add_invoice_to_fiscal_counters(invoice: Invoice, line_items: list = None):
+    """
+    Add a newly fiscalized invoice to its fiscal day's running counters.
+
+    Parameters:
+        invoice (Invoice): Fiscalized invoice with its line items already added to the session
+        line_items (list): The invoice's line items, loaded from the database when omitted
+    """
+    add_invoices_to_fiscal_counters([(invoice, line_items)])
+
+
+def load_fiscal_day_counters(device_id: str, fiscal_day_no: int):
+    """
+    Load the running counters of a fiscal day in the shape used by generate_counters.
+
+    A day's counter rows are complete once they exist (see add_invoices_to_fiscal_counters).
+
+    Returns:
+        tuple: (invoice_totals, currency_summaries), or None when the day has no running counters
+    """
+    rows = FiscalDayCounter.query.filter_by(
+        device_id=str(device_id),
+        fiscal_day_no=int(fiscal_day_no)
+    ).order_by(FiscalDayCounter.id).all()
+
+    if not rows:
+        return None
+
+    invoice_totals = {}
+    currency_summaries = {}
+    for row in rows:
+        if row.counter_type == RECEIPT_TOTAL:
+            curr = str(row.currency).upper()
+            entry = invoice_totals.setdefault(curr, {'invoice_count': 0, 'total_amount': 0.0})
+            entry['invoice_count'] += row.receipt_count
+            entry['total_amount'] += float(row.value)
+            continue
+
+        summary = currency_summaries.setdefault(row.currency, {'tax_summary': {}, 'balance_by_money_type': {}})
+        if row.counter_type == 'BalanceByMoneyType':
+            summary['balance_by_money_type'][row.counter_key] = float(row.value)
+            continue
+
+        tax_data = summary['tax_summary'].setdefault(row.counter_key, {
+            'taxID': row.tax_id,
+            'taxPercent': row.tax_percent,
+            'salesAmountWithTax': 0.0,
+            'taxAmount': 0.0
+        })
+        if row.counter_type == 'SaleByTax':
+            tax_data['salesAmountWithTax'] = float(row.value)
+        else:
+            tax_data['taxAmount'] = float(row.value)
+
+    return invoice_totals, currency_summaries
+
+
+def get_fiscal_day_receipt_totals(device_id: str, fiscal_day_no: int) -> dict:
+    """
+    Get receipt count, amount and line count per currency for a fiscal day.
+
+    Reads the ReceiptTotal running counters, and falls back to a grouped query on the
+    invoices for fiscal days that have no counter rows yet.
+
+    Returns:
+        dict: Currency (as stored on the invoices) -> {'count': int, 'amount': float, 'receipt_counter': int}
+    """
+    rows = db.session.query(
+        FiscalDayCounter.currency,
+        FiscalDayCounter.receipt_count,
+        FiscalDayCounter.value,
+        FiscalDayCounter.line_count
+    ).filter(
+        FiscalDayCounter.device_id == str(device_id),
+        FiscalDayCounter.fiscal_day_no == int(fiscal_day_no),
+        FiscalDayCounter.counter_type == RECEIPT_TOTAL
+    ).order_by(FiscalDayCounter.id).all()
+
+    if not rows:
+        rows = db.session.query(
+            Invoice.receipt_currency,
+            func.count(Invoice.id),
+            func.sum(Invoice.receipt_total),
+            func.sum(Invoice.receipt_counter)
+        ).filter(
+            Invoice.device_id == str(device_id),
+            Invoice.fiscal_day_number == str(fiscal_day_no)
+        ).group_by(Invoice.receipt_currency).order_by(func.min(Invoice.id)).all()
+
+    totals = {}
+    for currency, count, amount, receipt_counter in rows:
+        entry = totals.setdefault(currency or 'ZWG', {'count': 0, 'amount': 0.0, 'receipt_counter': 0})
+        entry['count'] += count or 0
+        entry['amount'] += float(amount or 0)
+        entry['receipt_counter'] += receipt_counter or 0
+    return totals
+
+
+def rebuild_fiscal_day_counters(device_id: str, fiscal_day_no: int) -> int:
+    """
+    Recompute a fiscal day's running counters from its invoices and line items.
+
+    Used to backfill fiscal days recorded before the counters existed and to repair
+    a day whose counters drifted. The caller commits.
+
+    Returns:
+        int: Number of counter rows written
+    """
+    device_id = str(device_id)
+    fiscal_day_no = int(fiscal_day_no)
+
+    FiscalDayCounter.query.filter_by(device_id=device_id, fiscal_day_no=fiscal_day_no).delete()
+
+    deltas = {}
+    invoice_rows = db.session.query(
+        Invoice.receipt_currency,
+        func.count(Invoice.id),
+        func.sum(Invoice.receipt_total),
+        func.sum(Invoice.receipt_counter)
+    ).filter(
+        Invoice.device_id == device_id,
+        Invoice.fiscal_day_number == str(fiscal_day_no)
+    ).group_by(Invoice.receipt_currency).order_by(func.min(Invoice.id)).all()
+
+    for currency, count, amount, receipt_counter in invoice_rows:
+        _add_delta(deltas, RECEIPT_TOTAL, currency or 'ZWG', '', float(amount or 0),
+                   receipt_count=count, line_count=receipt_counter or 0)
+
+    for group in get_fiscal_day_line_groups(device_id, fiscal_day_no):
+        _add_line_deltas(deltas, group['currency'], group['money_type'], group['tax_code'],
+                         group['tax_percent'], group['tax_id'], group['line_total'], group['line_count'])
+
+    for delta in deltas.values():
+        _upsert_counter(device_id, fiscal_day_no, delta)
+    return len(deltas)
+
+
+def verify_fiscal_day_counters(device_id: str, fiscal_day_no: int) -> list:
+    """
+    Compare the counters built from the running table with a full recomputation.
+
+    Returns:
+        list: Human-readable differences; empty when both agree
+    """
+    def _counter_values(payload: dict) -> dict:
+        return {
+            (c['fiscalCounterType'], c['fiscalCounterCurrency'], c.get('fiscalCounterTaxID'),
+             c.get('fiscalCounterTaxPercent'), c.get('fiscalCounterMoneyType')): c['fiscalCounterValue']
+            for c in payload['fiscalDayCounters']
+        }
+
+    arguments = dict(private_key=None, device_id=str(device_id), date_string='', close_day_date='',
+                     fiscal_day_no=int(fiscal_day_no))
+    stored = generate_counters(use_stored_counters=True, **arguments)
+    recomputed = generate_counters(use_stored_counters=False, **arguments)
+
+    differences = []
+    if stored['receiptCounter'] != recomputed['receiptCounter']:
+        differences.append(
+            f"receiptCounter: stored {stored['receiptCounter']}, recomputed {recomputed['receiptCounter']}"
+        )
+
+    stored_values = _counter_values(stored)
+    recomputed_values = _counter_values(recomputed)
+    for key in sorted(set(stored_values) | set(recomputed_values), key=str):
+        if stored_values.get(key) != recomputed_values.get(key):
+            differences.append(
+                f"{'/'.join(str(part) for part in key if part is not None)}: "
+                f"stored {stored_values.get(key)}, recomputed {recomputed_values.get(key)}"
+            )
+    return differences
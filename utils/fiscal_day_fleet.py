@@ -0,0 +1,346 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from flask import current_app
+from app import db
+from app.models import DeviceConfiguration, FiscalDay
+from utils.close_day_string_utilts import generate_close_day_string
+from utils.date_utils import get_close_day_string_date
+from utils.fdms_async import fdms_async_client, load_fdms_devices
+from utils.fiscalization_outbox import has_open_entries
+from utils.generate_counters import generate_counters
+from utils.invoice_utils import ReceiptDeviceSignature
+from utils.key_store import get_device_private_key
+from utils.offline_receipts import has_pending_offline_receipts
+from utils.update_closeday import update_fiscal_counter_data
+
+
+# Devices processed at once by a fleet run
+DEFAULT_FLEET_CONCURRENCY = int(os.environ.get('ZIMRA_FLEET_CONCURRENCY', '10'))
+
+# Per-device outcomes in a fleet report
+SUCCEEDED = 'succeeded'
+PREPARED = 'prepared'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+
+def parse_fiscal_day_open(fiscal_day_open: str):
+    """Parse a stored fiscalDayOpened string (UTC), or return None if it is not ISO 8601"""
+    try:
+        return datetime.fromisoformat(str(fiscal_day_open).replace('Z', '+00:00')).replace(tzinfo=None)
+    except (TypeError, ValueError):
+        return None
+
+
+def load_fleet_state(device_ids: list = None) -> list:
+    """
+    Load devices with their open fiscal day and taxPayerDayMaxHrs in three queries.
+
+    Must be called inside an app context; the returned dicts are plain data.
+
+    Parameters:
+        device_ids (list): Devices to load (None loads every DeviceInfo row)
+
+    Returns:
+        list: Dicts with device (credentials for the async client), fiscal_day_no,
+        fiscal_day_open, max_hours, hours_open, deadline and overdue
+    """
+    devices = load_fdms_devices(device_ids)
+    ids = [device['device_id'] for device in devices]
+    if not ids:
+        return []
+
+    # Latest open fiscal day per device (the one close_day works on)
+    open_days = {}
+    for fiscal_day in FiscalDay.query.filter(
+        FiscalDay.device_id.in_(ids),
+        FiscalDay.is_open.is_(True)
+    ).order_by(FiscalDay.fiscal_day_no).all():
+        open_days[fiscal_day.device_id] = fiscal_day
+
+    max_hours = dict(
+        db.session.query(DeviceConfiguration.device_id, DeviceConfiguration.tax_payer_day_max_hrs).filter(
+            DeviceConfiguration.device_id.in_(ids)
+        ).all()
+    )
+
+    now = datetime.utcnow()
+    fleet = []
+    for device in devices:
+        fiscal_day = open_days.get(device['device_id'])
+        opened_at = parse_fiscal_day_open(fiscal_day.fiscal_day_open) if fiscal_day else None
+        day_max_hrs = max_hours.get(device['device_id'])
+        deadline = opened_at + timedelta(hours=day_max_hrs) if opened_at and day_max_hrs else None
+        fleet.append({
+            'device': device,
+            'fiscal_day_no': fiscal_day.fiscal_day_no if fiscal_day else None,
+            'fiscal_day_open': fiscal_day.fiscal_day_open if fiscal_day else None,
+            'max_hours': day_max_hrs,
+            'hours_open': round((now - opened_at).total_seconds() / 3600, 2) if opened_at else None,
+            'deadline': deadline,
+            'overdue': deadline is not None and deadline <= now
+        })
+    return fleet
+
+
+def build_close_day_payload(device_id: str, key_path: str, fiscal_day_no: int, fiscal_day_open: str,
+                            fiscal_close_date: str = None, offline: bool = False) -> dict:
+    """
+    Generate the counters and sign the CloseDay request for a device, as close_day does.
+
+    Parameters:
+        device_id (str): Device identifier
+        key_path (str): Path to the device private key
+        fiscal_day_no (int): Open fiscal day to close
+        fiscal_day_open (str): fiscalDayOpened of that day
+        fiscal_close_date (str): Close date to sign (defaults to now)
+        offline (bool): Closing offline, for a SubmitFile footer; pending offline receipts are allowed
+
+    Returns:
+        dict: Signed CloseDay payload
+
+    Raises:
+        ValueError: If the day cannot be closed yet or the counters cannot be generated
+    """
+    # Counters only include fiscalized receipts; queued and offline ones must be delivered first
+    if has_open_entries(device_id):
+        raise ValueError("Receipts are still queued for asynchronous fiscalization on this device")
+    if not offline and has_pending_offline_receipts(device_id):
+        raise ValueError("Offline receipts have not been uploaded for this device")
+
+    fiscal_close_date = fiscal_close_date or get_close_day_string_date()
+    private_key = get_device_private_key(device_id, key_path)
+    close_data = generate_counters(
+        private_key=private_key,
+        device_id=str(device_id),
+        date_string=fiscal_day_open,
+        close_day_date=fiscal_close_date,
+        fiscal_day_no=int(fiscal_day_no)
+    )
+    close_data['fiscalDayCounters'] = update_fiscal_counter_data(close_data['fiscalDayCounters'])
+
+    string_to_sign = generate_close_day_string(
+        device_id=str(device_id),
+        fiscal_day_no=str(fiscal_day_no),
+        date=fiscal_close_date,
+        receipt_close=close_data
+    )
+    signature = ReceiptDeviceSignature(string_to_sign=string_to_sign, private_key=private_key)
+
+    return {
+        "fiscalDayNo": close_data['fiscalDayNo'],
+        "fiscalDayCounters": close_data['fiscalDayCounters'],
+        "fiscalDayDeviceSignature": {
+            "hash": signature.get_hash(),
+            "signature": signature.sign_data()
+        },
+        "receiptCounter": close_data['receiptCounter']
+    }
+
+
+def _prepare_close_day(app, state: dict) -> dict:
+    """Build a device's CloseDay payload in a worker thread with its own app context"""
+    with app.app_context():
+        return build_close_day_payload(
+            state['device']['device_id'],
+            state['device']['key_path'],
+            state['fiscal_day_no'],
+            state['fiscal_day_open']
+        )
+
+
+def _mark_day_closed(app, device_id: str, fiscal_day_no: int):
+    """Record a fiscal day as closed as soon as ZIMRA accepts its CloseDay, in its own commit"""
+    with app.app_context():
+        FiscalDay.query.filter_by(
+            device_id=device_id,
+            fiscal_day_no=fiscal_day_no,
+            is_open=True
+        ).update({'is_open': False, 'fiscal_status': 'FISCAL_DAY_CLOSED'}, synchronize_session=False)
+        db.session.commit()
+
+
+def _report_entry(state: dict) -> dict:
+    """Start the report row of a device"""
+    return {
+        'device_id': state['device']['device_id'],
+        'fiscal_day_no': state['fiscal_day_no'],
+        'status': None,
+        'hours_open': state['hours_open'],
+        'max_hours': state['max_hours'],
+        'deadline': state['deadline'].strftime('%Y-%m-%dT%H:%M:%S') if state['deadline'] else None,
+        'overdue': state['overdue'],
+        'status_code': None,
+        'data': None,
+        'error': None
+    }
+
+
+async def _close_device(app, executor, semaphore, state: dict, dry_run: bool) -> dict:
+    """Prepare, sign and submit one device's CloseDay"""
+    entry = _report_entry(state)
+    if state['fiscal_day_no'] is None:
+        entry.update(status=SKIPPED, error="No open fiscal day")
+        return entry
+
+    async with semaphore:
+        started = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            payload = await loop.run_in_executor(executor, _prepare_close_day, app, state)
+        except Exception as e:
+            entry.update(status=FAILED, error=str(e))
+        else:
+            if dry_run:
+                entry.update(status=PREPARED, data=payload)
+            else:
+                result = await fdms_async_client.close_day(state['device'], payload)
+                entry.update(
+                    status=SUCCEEDED if result['ok'] else FAILED,
+                    status_code=result['status_code'],
+                    data=result['data'],
+                    error=result['error']
+                )
+                if result['ok']:
+                    # Closed at ZIMRA: record it now, so a crash later in the run cannot leave it open locally
+                    try:
+                        await loop.run_in_executor(executor, _mark_day_closed, app,
+                                                   entry['device_id'], state['fiscal_day_no'])
+                    except Exception as e:
+                        entry['error'] = f"Closed at ZIMRA but not recorded locally: {e}"
+        entry['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    return entry
+
+
+async def _open_device(semaphore, state: dict, fiscal_day_opened: str) -> dict:
+    """Submit one device's OpenDay"""
+    entry = _report_entry(state)
+    if state['fiscal_day_no'] is not None:
+        entry.update(status=SKIPPED, error=f"Fiscal day {state['fiscal_day_no']} is still open")
+        return entry
+
+    async with semaphore:
+        result = await fdms_async_client.open_day(state['device'], fiscal_day_opened)
+    data = result['data'] if isinstance(result['data'], dict) else {}
+    entry.update(
+        status=SUCCEEDED if result['ok'] else FAILED,
+        fiscal_day_no=data.get('fiscalDayNo'),
+        status_code=result['status_code'],
+        data=result['data'],
+        error=result['error'],
+        elapsed_ms=result['elapsed_ms']
+    )
+    return entry
+
+
+def _summarize(operation: str, results: list, started: float) -> dict:
+    """Wrap per-device results in a fleet report"""
+    return {
+        'operation': operation,
+        'devices': len(results),
+        'succeeded': sum(1 for entry in results if entry['status'] in (SUCCEEDED, PREPARED)),
+        'failed': sum(1 for entry in results if entry['status'] == FAILED),
+        'skipped': sum(1 for entry in results if entry['status'] == SKIPPED),
+        'elapsed_ms': round((time.perf_counter() - started) * 1000, 1),
+        'results': results
+    }
+
+
+def close_fleet_fiscal_days(device_ids: list = None, concurrency: int = None,
+                            due_within_hours: float = None, dry_run: bool = False) -> dict:
+    """
+    Close the open fiscal day of many devices in parallel.
+
+    Counter generation and signing run in a worker pool (each worker with its own app
+    context) and CloseDay goes out through the async FDMS client, with at most
+    `concurrency` devices in progress at once. Each device's fiscal day is marked
+    closed, and committed, as soon as ZIMRA accepts its CloseDay. Devices are started in order of their
+    taxPayerDayMaxHrs deadline, so overdue days are closed first. Must be called inside
+    an app context.
+
+    Parameters:
+        device_ids (list): Devices to close (None closes every DeviceInfo row)
+        concurrency (int): Devices processed at once (default ZIMRA_FLEET_CONCURRENCY)
+        due_within_hours (float): Only close days whose deadline falls within this many hours
+        dry_run (bool): Build and sign the payloads without submitting them
+
+    Returns:
+        dict: Fleet report with one result per device
+    """
+    started = time.perf_counter()
+    concurrency = max(1, int(concurrency or DEFAULT_FLEET_CONCURRENCY))
+    fleet = load_fleet_state(device_ids)
+
+    # Days without a known deadline sort last
+    fleet.sort(key=lambda state: (state['deadline'] is None, state['deadline'] or datetime.max))
+    cutoff = datetime.utcnow() + timedelta(hours=due_within_hours) if due_within_hours is not None else None
+
+    app = current_app._get_current_object()
+
+    async def run(states):
+        semaphore = asyncio.Semaphore(concurrency)
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='fleet-close') as executor:
+            return await asyncio.gather(*(_close_device(app, executor, semaphore, state, dry_run) for state in states))
+
+    due, not_due = [], []
+    for state in fleet:
+        if cutoff is not None and state['fiscal_day_no'] is not None and (state['deadline'] is None or state['deadline'] > cutoff):
+            not_due.append(state)
+        else:
+            due.append(state)
+
+    results = list(fdms_async_client.run(run(due))) if due else []
+    for state in not_due:
+        entry = _report_entry(state)
+        entry.update(status=SKIPPED, error=f"Not due within {due_within_hours} hours")
+        results.append(entry)
+
+    closed = [entry for entry in results if entry['status'] == SUCCEEDED]
+    current_app.logger.info(f"Fleet close day: {len(closed)} of {len(results)} devices closed")
+    return _summarize('close_day', results, started)
+
+
+def open_fleet_fiscal_days(device_ids: list = None, concurrency: int = None) -> dict:
+    """
+    Open a fiscal day on many devices in parallel.
+
+    Devices whose previous fiscal day is still open are skipped. Must be called inside
+    an app context.
+
+    Parameters:
+        device_ids (list): Devices to open (None opens every DeviceInfo row)
+        concurrency (int): Devices processed at once (default ZIMRA_FLEET_CONCURRENCY)
+
+    Returns:
+        dict: Fleet report with one result per device
+    """
+    started = time.perf_counter()
+    concurrency = max(1, int(concurrency or DEFAULT_FLEET_CONCURRENCY))
+    fleet = load_fleet_state(device_ids)
+
+    # Same UTC format open_day sends as fiscalDayOpened
+    fiscal_day_opened = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S')
+
+    async def run(states):
+        semaphore = asyncio.Semaphore(concurrency)
+        return await asyncio.gather(*(_open_device(semaphore, state, fiscal_day_opened) for state in states))
+
+    results = list(fdms_async_client.run(run(fleet))) if fleet else []
+
+    opened = [entry for entry in results if entry['status'] == SUCCEEDED]
+    for entry in opened:
+        db.session.add(FiscalDay(
+            device_id=entry['device_id'],
+            fiscal_day_open=fiscal_day_opened,
+            is_open=True,
+            fiscal_day_no=entry['fiscal_day_no'],
+            fiscal_status='FISCAL_DAY_OPENED'
+        ))
+    if opened:
+        db.session.commit()
+
+    current_app.logger.info(f"Fleet open day: {len(opened)} of {len(results)} devices opened")
+    return _summarize('open_day', results, started)
@@ -0,0 +1,484 @@
+import json
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy import func, or_, update
+from app import db
+from app.models import FiscalizationOutbox, Invoice
+
+
+# Outbox entry states
+PENDING = 'pending'
+SUBMITTING = 'submitting'
+FISCALIZED = 'fiscalized'
+FAILED = 'failed'
+OPEN_STATUSES = (PENDING, SUBMITTING)
+
+# Handler outcomes
+OUTCOME_FISCALIZED = 'fiscalized'
+OUTCOME_RETRY = 'retry'
+OUTCOME_REJECTED = 'rejected'
+
+
+def enqueue_receipt(device_id: str, fiscal_day_no: int, updated_data: dict, request_hash: str = None,
+                    idempotency_key: str = None) -> FiscalizationOutbox:
+    """
+    Add a signed receipt to the outbox in the caller's transaction.
+
+    Parameters:
+        device_id (str): Device identifier
+        fiscal_day_no (int): Fiscal day the receipt was signed in
+        updated_data (dict): Signed SubmitReceipt data, with receiptGlobalNo and receiptDeviceSignature
+        request_hash (str): Fingerprint of the receipt as posted, stored with the invoice for replay
+        idempotency_key (str): Idempotency-Key header of the submission
+
+    Returns:
+        FiscalizationOutbox: The new pending entry
+    """
+    entry = FiscalizationOutbox(
+        tracking_id=str(uuid.uuid4()),
+        device_id=str(device_id),
+        invoice_id=str(updated_data['invoiceNo']),
+        fiscal_day_no=int(fiscal_day_no),
+        receipt_global_no=updated_data['receiptGlobalNo'],
+        payload=json.dumps(updated_data),
+        request_hash=request_hash,
+        idempotency_key=idempotency_key,
+        status=PENDING,
+        attempts=0,
+        next_attempt_at=datetime.utcnow()
+    )
+    db.session.add(entry)
+    return entry
+
+
+def has_open_entries(device_id: str) -> bool:
+    """Check whether a device still has receipts waiting to be fiscalized"""
+    return db.session.query(FiscalizationOutbox.id).filter(
+        FiscalizationOutbox.device_id == str(device_id),
+        FiscalizationOutbox.status.in_(OPEN_STATUSES)
+    ).first() is not None
+
+
+def get_open_entry(device_id: str, invoice_id: str, idempotency_key: str = None):
+    """Get the queued or fiscalized outbox entry of an invoice number or Idempotency-Key, if any"""
+    conditions = [FiscalizationOutbox.invoice_id == str(invoice_id)]
+    if idempotency_key is not None:
+        conditions.append(FiscalizationOutbox.idempotency_key == idempotency_key)
+    return FiscalizationOutbox.query.filter(
+        FiscalizationOutbox.device_id == str(device_id),
+        or_(*conditions),
+        FiscalizationOutbox.status != FAILED
+    ).first()
+
+
+def outbox_entry_to_dict(entry: FiscalizationOutbox) -> dict:
+    """Serialize an outbox entry for the status endpoint"""
+    data = {
+        'tracking_id': entry.tracking_id,
+        'status': entry.status,
+        'device_id': entry.device_id,
+        'invoice_number': entry.invoice_id,
+        'fiscal_day_no': entry.fiscal_day_no,
+        'receipt_global_no': entry.receipt_global_no,
+        'attempts': entry.attempts,
+        'next_attempt_at': entry.next_attempt_at.isoformat() if entry.next_attempt_at and entry.status == PENDING else None,
+        'last_status_code': entry.last_status_code,
+        'last_error': entry.last_error,
+        'zimra_receipt_id': entry.zimra_receipt_id,
+        'created_at': entry.created_at.isoformat() if entry.created_at else None,
+        'fiscalized_at': entry.fiscalized_at.isoformat() if entry.fiscalized_at else None
+    }
+    if entry.status == FISCALIZED and entry.response:
+        data['receipt'] = json.loads(entry.response)
+    return data
+
+
+class OutboxDispatcher:
+    """
+    Background delivery of queued receipts to FDMS.
+
+    Receipts are signed and chained when they are accepted, so each device's queue
+    must reach FDMS strictly in order: a device is drained by one worker at a time,
+    oldest entry first, and a failing entry holds back the ones behind it. Different
+    devices are delivered in parallel on a small thread pool.
+
+    An entry being submitted is leased to the claiming process (claimed_by and
+    claimed_at). Entries whose lease expired - the process died mid-submission -
+    go back to the queue; entries still leased to a live process are left alone.
+
+    Transient failures (network errors, 408/429/5xx) are retried with exponential
+    backoff. When FDMS rejects an entry - or it runs out of attempts - the entries
+    chained behind it in the same fiscal day are failed too, the fiscal day's
+    hash-chain head is rewound to the last accepted receipt and their global
+    numbers are given back, so the next receipt continues the sequence.
+    A receipt FDMS already accepted is never failed: storing its invoice is
+    retried until it succeeds, however many attempts that takes.
+
+    The FDMS call itself is made by a handler registered with init_app, which returns
+    {'status': 'fiscalized' | 'retry' | 'rejected', ...}.
+
+    The same scheduler also drains receipts fiscalized offline: every
+    offline_upload_interval seconds, devices with pending offline receipts are
+    uploaded with SubmitFile (utils.offline_receipts), with the same backoff per
+    device while FDMS stays unreachable. A device is never uploaded and delivered
+    at the same time.
+    """
+
+    def __init__(self, workers: int = 2, poll_interval: float = 5.0, max_attempts: int = 10,
+                 base_delay: float = 2.0, max_delay: float = 300.0, offline_upload_interval: float = 60.0,
+                 lease_seconds: float = 300.0):
+        """
+        Initialize the dispatcher.
+
+        Args:
+            workers (int): Devices delivered in parallel
+            poll_interval (float): Seconds between scans for due entries when not woken up
+            max_attempts (int): Delivery attempts before an entry fails (0 retries forever)
+            base_delay (float): Backoff after the first failed attempt, in seconds
+            max_delay (float): Upper bound of the backoff, in seconds
+            offline_upload_interval (float): Seconds between scans for pending offline receipts (0 disables)
+            lease_seconds (float): Time a claimed entry stays leased to its process; must exceed the FDMS timeout
+        """
+        self.workers = max(1, int(workers))
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.offline_upload_interval = offline_upload_interval
+        self.lease_seconds = lease_seconds
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.app = None
+        self.handler = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._executor = None
+        self._active_devices = set()
+        self._next_offline_scan = 0.0
+        self._offline_failures = {}
+
+    def init_app(self, app, handler):
+        """
+        Bind the dispatcher to the Flask app and the FDMS delivery handler.
+
+        Args:
+            app (Flask): Application used for the workers' app context
+            handler (callable): Delivers one FiscalizationOutbox entry and returns its outcome
+        """
+        self.app = app
+        self.handler = handler
+        app.extensions['fiscalization_outbox'] = self
+
+    def start(self):
+        """Start the scheduler thread and worker pool if they are not running"""
+        if self.app is None:
+            raise RuntimeError("OutboxDispatcher.init_app() must be called before start()")
+
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='fdms-outbox')
+            self._thread = threading.Thread(target=self._run, name='fdms-outbox-scheduler', daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        """Start the dispatcher if needed and scan for due entries now"""
+        self.start()
+        self._wakeup.set()
+
+    def stop(self, wait: bool = True):
+        """Stop scheduling new deliveries and shut the worker pool down"""
+        self._stopping.set()
+        self._wakeup.set()
+        with self._lock:
+            thread, executor = self._thread, self._executor
+            self._thread = None
+            self._executor = None
+        if thread is not None and wait:
+            thread.join()
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def backoff_delay(self, attempts: int) -> float:
+        """Seconds to wait before the next attempt, with jitter so devices do not retry in lockstep"""
+        delay = min(self.max_delay, self.base_delay * (2 ** max(0, attempts - 1)))
+        return delay * random.uniform(0.5, 1.0)
+
+    def stats(self) -> dict:
+        """
+        Get outbox totals per status and the devices currently being delivered.
+
+        Must be called inside an app context.
+        """
+        counts = dict(db.session.query(
+            FiscalizationOutbox.status,
+            db.func.count(FiscalizationOutbox.id)
+        ).group_by(FiscalizationOutbox.status).all())
+        with self._lock:
+            running = self._thread is not None and self._thread.is_alive()
+            active = sorted(self._active_devices)
+        return {
+            'running': running,
+            'workers': self.workers,
+            'worker_id': self.worker_id,
+            'active_devices': active,
+            'offline_upload_interval': self.offline_upload_interval,
+            'offline_upload_failures': dict(self._offline_failures),
+            'entries': {status: counts.get(status, 0) for status in (PENDING, SUBMITTING, FISCALIZED, FAILED)}
+        }
+
+    def _run(self):
+        """Scheduler loop: hand each device with due entries to a worker"""
+        while not self._stopping.is_set():
+            try:
+                with self.app.app_context():
+                    self._recover_expired_leases()
+                    self._schedule_due_devices()
+                    self._schedule_offline_uploads()
+            except Exception as e:
+                self.app.logger.error(f"Outbox scheduler error: {e}")
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def _recover_expired_leases(self):
+        """Return entries whose submitting process died (expired lease) to the queue"""
+        table = FiscalizationOutbox.__table__
+        expired = datetime.utcnow() - timedelta(seconds=self.lease_seconds)
+        db.session.execute(
+            update(table)
+            .where(table.c.status == SUBMITTING)
+            .where(or_(table.c.claimed_at.is_(None), table.c.claimed_at < expired))
+            .values(status=PENDING, claimed_by=None, claimed_at=None)
+        )
+        db.session.commit()
+
+    def _schedule_due_devices(self):
+        """Submit a drain task for every idle device that has a due entry"""
+        devices = [device_id for (device_id,) in db.session.query(FiscalizationOutbox.device_id).filter(
+            FiscalizationOutbox.status == PENDING,
+            FiscalizationOutbox.next_attempt_at <= datetime.utcnow()
+        ).distinct().all()]
+        db.session.remove()
+
+        for device_id in devices:
+            with self._lock:
+                if device_id in self._active_devices or self._executor is None:
+                    continue
+                self._active_devices.add(device_id)
+                self._executor.submit(self._drain_device, device_id)
+
+    def _schedule_offline_uploads(self):
+        """Submit an offline upload task for every idle device with pending offline receipts"""
+        from utils.offline_receipts import get_devices_with_pending_offline_receipts, is_offline_mode_forced
+
+        now = time.monotonic()
+        if not self.offline_upload_interval or now < self._next_offline_scan or is_offline_mode_forced():
+            return
+        self._next_offline_scan = now + self.offline_upload_interval
+
+        devices = get_devices_with_pending_offline_receipts()
+        db.session.remove()
+
+        for device_id in devices:
+            with self._lock:
+                retry_at = self._offline_failures.get(device_id, (0, 0.0))[1]
+                if now < retry_at or device_id in self._active_devices or self._executor is None:
+                    continue
+                self._active_devices.add(device_id)
+                self._executor.submit(self._upload_offline, device_id)
+
+    def _upload_offline(self, device_id: str):
+        """Upload a device's offline receipts, backing off while FDMS does not accept them"""
+        from utils.offline_receipts import upload_offline_receipts
+
+        error = None
+        try:
+            with self.app.app_context():
+                try:
+                    result = upload_offline_receipts(device_id)
+                    error = result['error']
+                    if result['receipts_uploaded']:
+                        self.app.logger.info(
+                            f"Uploaded {result['receipts_uploaded']} offline receipt(s) for device {device_id}"
+                        )
+                finally:
+                    db.session.remove()
+        except Exception as e:
+            error = str(e)
+
+        with self._lock:
+            if error is None:
+                self._offline_failures.pop(device_id, None)
+            else:
+                failures = self._offline_failures.get(device_id, (0, 0.0))[0] + 1
+                self._offline_failures[device_id] = (failures, time.monotonic() + self.backoff_delay(failures))
+            self._active_devices.discard(device_id)
+        if error is not None:
+            self.app.logger.warning(f"Offline upload for device {device_id} failed: {error}")
+
+    def _drain_device(self, device_id: str):
+        """Deliver a device's due entries in order until one fails or the queue is empty"""
+        try:
+            with self.app.app_context():
+                try:
+                    while not self._stopping.is_set() and self._deliver_next(device_id):
+                        pass
+                finally:
+                    db.session.remove()
+        except Exception as e:
+            self.app.logger.error(f"Outbox delivery error for device {device_id}: {e}")
+        finally:
+            with self._lock:
+                self._active_devices.discard(device_id)
+
+    def _deliver_next(self, device_id: str) -> bool:
+        """
+        Deliver the oldest open entry of a device.
+
+        Returns:
+            bool: True if the entry was fiscalized and the next one can follow
+        """
+        entry = FiscalizationOutbox.query.filter(
+            FiscalizationOutbox.device_id == device_id,
+            FiscalizationOutbox.status.in_(OPEN_STATUSES)
+        ).order_by(FiscalizationOutbox.id).first()
+
+        if entry is None or entry.status != PENDING or entry.next_attempt_at > datetime.utcnow():
+            db.session.rollback()
+            return False
+
+        # Claim the entry; the status check keeps two processes from sending it twice
+        table = FiscalizationOutbox.__table__
+        now = datetime.utcnow()
+        claimed = db.session.execute(
+            update(table)
+            .where(table.c.id == entry.id, table.c.status == PENDING)
+            .values(status=SUBMITTING, attempts=table.c.attempts + 1, claimed_by=self.worker_id,
+                    claimed_at=now, updated_at=now)
+        ).rowcount
+        db.session.commit()
+        if not claimed:
+            return False
+        db.session.refresh(entry)
+
+        try:
+            outcome = self.handler(entry)
+        except Exception as e:
+            db.session.rollback()
+            self.app.logger.error(f"Outbox handler error for {entry.tracking_id}: {e}")
+            outcome = {'status': OUTCOME_RETRY, 'error': str(e)}
+
+        return self._record_outcome(entry, outcome)
+
+    def _record_outcome(self, entry: FiscalizationOutbox, outcome: dict) -> bool:
+        """Store the result of a delivery attempt"""
+        now = datetime.utcnow()
+        entry.last_status_code = outcome.get('status_code')
+        entry.claimed_by = None
+        entry.claimed_at = None
+
+        if outcome['status'] == OUTCOME_FISCALIZED:
+            entry.status = FISCALIZED
+            entry.fiscalized_at = now
+            entry.last_error = None
+            entry.response = json.dumps(outcome.get('response'))
+            db.session.commit()
+            return True
+
+        entry.last_error = str(outcome.get('error') or '')
+        retry = outcome['status'] == OUTCOME_RETRY
+        accepted = entry.zimra_receipt_id is not None
+        if accepted or (retry and (not self.max_attempts or entry.attempts < self.max_attempts)):
+            # ZIMRA holds a receipt it accepted: never fail or rewind it, only retry storing it
+            if accepted and self.max_attempts and entry.attempts >= self.max_attempts:
+                self.app.logger.error(
+                    f"Outbox receipt {entry.tracking_id} was accepted by ZIMRA (receipt "
+                    f"{entry.zimra_receipt_id}) but could not be stored: {entry.last_error}"
+                )
+            entry.status = PENDING
+            entry.next_attempt_at = now + timedelta(seconds=self.backoff_delay(entry.attempts))
+            db.session.commit()
+            return False
+
+        self._fail_chain(entry)
+        return False
+
+    def _rewind_global_number(self, device_id: str):
+        """
+        Give back the global numbers of failed entries, in the caller's transaction.
+
+        The device's DeviceGlobalNumber row is locked first, so no receipt is being
+        numbered meanwhile; the counter then drops to the highest number still in use
+        by an invoice or an open outbox entry.
+        """
+        from utils.global_number_allocator import global_number_allocator
+
+        global_number_allocator.lock(device_id)
+        last_invoice = db.session.query(func.max(Invoice.receipt_global_no)).filter(
+            Invoice.device_id == device_id
+        ).scalar()
+        last_queued = db.session.query(func.max(FiscalizationOutbox.receipt_global_no)).filter(
+            FiscalizationOutbox.device_id == device_id,
+            FiscalizationOutbox.status.in_(OPEN_STATUSES)
+        ).scalar()
+        global_number_allocator.release(device_id, max(last_invoice or 0, last_queued or 0))
+
+    def _fail_chain(self, entry: FiscalizationOutbox):
+        """
+        Fail an entry and everything chained behind it, then rewind the chain head and global number.
+
+        Entries ZIMRA already accepted are never failed: the chain stops at the first
+        one, and nothing is rewound, since ZIMRA's chain already continues past it.
+        """
+        from utils.invoice_utils import rewind_chain_head
+
+        entry.status = FAILED
+        chained = FiscalizationOutbox.query.filter(
+            FiscalizationOutbox.device_id == entry.device_id,
+            FiscalizationOutbox.fiscal_day_no == entry.fiscal_day_no,
+            FiscalizationOutbox.id > entry.id,
+            FiscalizationOutbox.status.in_(OPEN_STATUSES)
+        ).order_by(FiscalizationOutbox.id).all()
+        failed = 0
+        accepted_behind = None
+        for later in chained:
+            if later.zimra_receipt_id is not None:
+                accepted_behind = later
+                break
+            later.status = FAILED
+            later.last_error = f"Chained to failed receipt {entry.tracking_id}"
+            failed += 1
+
+        if accepted_behind is None:
+            self._rewind_global_number(entry.device_id)
+            rewind_chain_head(entry.device_id, entry.fiscal_day_no)
+        db.session.commit()
+        self.app.logger.warning(
+            f"Outbox receipt {entry.tracking_id} failed ({entry.last_error}); "
+            f"{failed} chained receipt(s) failed with it"
+        )
+        if accepted_behind is not None:
+            self.app.logger.error(
+                f"Outbox receipt {accepted_behind.tracking_id} was accepted by ZIMRA after failed receipt "
+                f"{entry.tracking_id}; the chain head and global number were not rewound"
+            )
+
+
+# Global dispatcher shared by the application
+outbox_dispatcher = OutboxDispatcher(
+    workers=int(os.environ.get('ZIMRA_OUTBOX_WORKERS', '2')),
+    poll_interval=float(os.environ.get('ZIMRA_OUTBOX_POLL_INTERVAL', '5')),
+    max_attempts=int(os.environ.get('ZIMRA_OUTBOX_MAX_ATTEMPTS', '10')),
+    base_delay=float(os.environ.get('ZIMRA_OUTBOX_RETRY_DELAY', '2')),
+    max_delay=float(os.environ.get('ZIMRA_OUTBOX_MAX_RETRY_DELAY', '300')),
+    offline_upload_interval=float(os.environ.get('ZIMRA_OFFLINE_UPLOAD_INTERVAL', '60')),
+    lease_seconds=float(os.environ.get('ZIMRA_OUTBOX_LEASE_SECONDS', '300'))
+)
@@ -1,4 +1,5 @@
 import datetime
+from sqlalchemy import func
 from app.models import Invoice, InvoiceLineItem
 from app.config import zimra_config
 from app import db
@@ -9,7 +10,152 @@ from utils.invoice_utils import calculate_tax_summary, get_tax_percentage, get_t
     return get_fiscal_day_open_date_time_dao(open_day_date_time) """
 
 
-def generate_counters(private_key: str, device_id: str, date_string: str, close_day_date: str, fiscal_day_no: int) -> dict:
+def line_counter_amounts(tax_code: str, tax_percent, tax_id, line_total) -> tuple:
+    """
+    Resolve the tax fields of a line item and compute its counter contributions.
+    
+    Parameters:
+        tax_code (str): Line tax code ('A' exempt, 'B' 0%, 'C' 15%, 'D' 5%)
+        tax_percent (float): Stored tax percent (may be None for exempt items)
+        tax_id (int): Stored tax ID
+        line_total (float): Line total excluding tax
+        
+    Returns:
+        tuple: (tax_percent, tax_id, tax_amount, sales_amount_with_tax)
+    """
+    tax_code = tax_code or 'C'
+    tax_percent = tax_percent or get_tax_percentage(tax_code)
+    tax_id = tax_id or get_tax_id(tax_code)
+    line_total = float(line_total or 0)
+    
+    # Calculate tax amount
+    if tax_code == 'A':  # Exempt
+        tax_amount = 0.0
+        sales_amount_with_tax = line_total
+    else:
+        tax_amount = round(line_total * (tax_percent / 100), 2)
+        sales_amount_with_tax = line_total + tax_amount
+    
+    return tax_percent, tax_id, tax_amount, sales_amount_with_tax
+
+
+def get_fiscal_day_invoice_totals(device_id: str, fiscal_day_no: int) -> dict:
+    """
+    Get invoice count and receipt total per currency for a fiscal day in one grouped query.
+    
+    Returns:
+        dict: Upper-case currency -> {'invoice_count': int, 'total_amount': float}
+    """
+    rows = db.session.query(
+        Invoice.receipt_currency,
+        func.count(Invoice.id),
+        func.sum(Invoice.receipt_total)
+    ).filter(
+        Invoice.device_id == str(device_id),
+        Invoice.fiscal_day_number == str(fiscal_day_no)
+    ).group_by(Invoice.receipt_currency).all()
+    
+    totals = {}
+    for currency, invoice_count, total_amount in rows:
+        curr = str(currency or 'ZWG').upper()
+        entry = totals.setdefault(curr, {'invoice_count': 0, 'total_amount': 0.0})
+        entry['invoice_count'] += invoice_count
+        entry['total_amount'] += float(total_amount or 0)
+    return totals
+
+
+def get_fiscal_day_line_groups(device_id: str, fiscal_day_no: int) -> list:
+    """
+    Aggregate a fiscal day's line items with a single grouped query over invoice JOIN invoice_line_item.
+    
+    Lines are grouped by currency, money type, tax fields and line total, so per-line tax
+    rounding can be reproduced exactly from each group. Groups are returned in the order
+    their first line was created, which keeps the counter order of the per-invoice loop.
+    
+    Returns:
+        list: Dicts with currency, money_type, tax_code, tax_percent, tax_id, line_total and line_count
+    """
+    first_line_id = func.min(InvoiceLineItem.id)
+    rows = db.session.query(
+        Invoice.receipt_currency,
+        Invoice.money_type,
+        InvoiceLineItem.tax_code,
+        InvoiceLineItem.tax_percent,
+        InvoiceLineItem.tax_id,
+        InvoiceLineItem.receipt_line_total,
+        func.count(InvoiceLineItem.id)
+    ).join(
+        InvoiceLineItem, InvoiceLineItem.invoice_id == Invoice.id
+    ).filter(
+        Invoice.device_id == str(device_id),
+        Invoice.fiscal_day_number == str(fiscal_day_no)
+    ).group_by(
+        Invoice.receipt_currency,
+        Invoice.money_type,
+        InvoiceLineItem.tax_code,
+        InvoiceLineItem.tax_percent,
+        InvoiceLineItem.tax_id,
+        InvoiceLineItem.receipt_line_total
+    ).order_by(first_line_id).all()
+    
+    return [
+        {
+            'currency': str(currency or 'ZWG').upper(),
+            'money_type': money_type,
+            'tax_code': tax_code,
+            'tax_percent': tax_percent,
+            'tax_id': tax_id,
+            'line_total': line_total,
+            'line_count': line_count
+        }
+        for currency, money_type, tax_code, tax_percent, tax_id, line_total, line_count in rows
+    ]
+
+
+def summarize_line_groups(line_groups: list) -> dict:
+    """
+    Accumulate grouped line items into per-currency tax and money type totals.
+    
+    Parameters:
+        line_groups (list): Groups as returned by get_fiscal_day_line_groups
+        
+    Returns:
+        dict: Currency -> {'tax_summary': {tax_key: {...}}, 'balance_by_money_type': {money_type: float}}
+    """
+    summaries = {}
+    for group in line_groups:
+        summary = summaries.setdefault(group['currency'], {'tax_summary': {}, 'balance_by_money_type': {}})
+        tax_summary = summary['tax_summary']
+        balance_by_money_type = summary['balance_by_money_type']
+        
+        tax_percent, tax_id, tax_amount, sales_amount_with_tax = line_counter_amounts(
+            group['tax_code'], group['tax_percent'], group['tax_id'], group['line_total']
+        )
+        line_count = group['line_count']
+        
+        # Add to tax summary
+        tax_key = f"{tax_id}_{tax_percent}"
+        if tax_key not in tax_summary:
+            tax_summary[tax_key] = {
+                'taxID': tax_id,
+                'taxPercent': tax_percent,
+                'salesAmountWithTax': 0.0,
+                'taxAmount': 0.0
+            }
+        tax_summary[tax_key]['salesAmountWithTax'] += sales_amount_with_tax * line_count
+        tax_summary[tax_key]['taxAmount'] += tax_amount * line_count
+        
+        # Add to balance by money type
+        money_type = group['money_type'] or 'Cash'
+        if money_type not in balance_by_money_type:
+            balance_by_money_type[money_type] = 0.0
+        balance_by_money_type[money_type] += sales_amount_with_tax * line_count
+    
+    return summaries
+
+
+def generate_counters(private_key: str, device_id: str, date_string: str, close_day_date: str, fiscal_day_no: int,
+                      use_stored_counters: bool = True) -> dict:
     """
     Generate fiscal day counters for close day operation according to ZIMRA API specification.
     
@@ -21,26 +167,31 @@ def generate_counters(private_key: str, device_id: str, date_string: str, close_
         date_string (str): Fiscal day open date
         close_day_date (str): Close day date
         fiscal_day_no (int): Fiscal day number
+        use_stored_counters (bool): Read the running fiscal_day_counter rows when available
         
     Returns:
         dict: Complete close day payload with counters
     """
     current_date = datetime.datetime.today().strftime("%Y-%m-%d")
     
-    # Get all invoices for this device and fiscal day
-    invoices = Invoice.query.filter_by(
-        device_id=str(device_id),
-        fiscal_day_number=str(fiscal_day_no)  # Use fiscal_day_number and convert to string
-    ).all()
+    # Running counters maintained as receipts are fiscalized (see utils/fiscal_day_counters.py)
+    stored = None
+    if use_stored_counters:
+        from utils.fiscal_day_counters import load_fiscal_day_counters
+        stored = load_fiscal_day_counters(device_id, fiscal_day_no)
+    
+    if stored is not None:
+        invoice_totals, currency_summaries = stored
+    else:
+        # No running counters for this day yet (they are seeded with its first new receipt) - aggregate the invoices directly
+        invoice_totals = get_fiscal_day_invoice_totals(device_id, fiscal_day_no)
+        currency_summaries = summarize_line_groups(get_fiscal_day_line_groups(device_id, fiscal_day_no))
     
     # Calculate total receipt counter (number of invoices, not line items)
-    total_receipt_counter = len(invoices)
+    total_receipt_counter = sum(entry['invoice_count'] for entry in invoice_totals.values())
     
     # Determine which currencies are present in invoices for the fiscal day
-    used_currencies = set()
-    for invoice in invoices:
-        currency = getattr(invoice, 'receipt_currency', None) or 'ZWG'
-        used_currencies.add(str(currency).upper())
+    used_currencies = set(invoice_totals.keys())
 
     # If no invoices found, default to USD to avoid showing ZWG unintentionally
     if not used_currencies:
@@ -48,11 +199,8 @@ def generate_counters(private_key: str, device_id: str, date_string: str, close_
 
     # Helper to build counters for a specific currency based on actual invoice data
     def _build_counters_for_currency(curr: str) -> list:
-        # Filter invoices for this currency
-        currency_invoices = [inv for inv in invoices if (inv.receipt_currency or 'ZWG').upper() == curr]
-        
         # Calculate actual totals from invoices
-        total_amount = sum(float(inv.receipt_total or 0) for inv in currency_invoices)
+        total_amount = invoice_totals.get(curr, {}).get('total_amount', 0.0)
         
         if total_amount == 0:
             # Fallback to hardcoded values if no real data (using configuration)
@@ -111,45 +259,10 @@ def generate_counters(private_key: str, device_id: str, date_string: str, close_
                 }
             ]
         else:
-            # Analyze actual invoice line items to determine which tax types were used
-            tax_summary = {}
-            balance_by_money_type = {}
-            
-            for invoice in currency_invoices:
-                # Get line items for this invoice
-                line_items = InvoiceLineItem.query.filter_by(invoice_id=invoice.id).all()
-                
-                for line_item in line_items:
-                    tax_code = line_item.tax_code or 'C'
-                    tax_percent = line_item.tax_percent or get_tax_percentage(tax_code)
-                    tax_id = line_item.tax_id or get_tax_id(tax_code)
-                    line_total = float(line_item.receipt_line_total or 0)
-                    
-                    # Calculate tax amount
-                    if tax_code == 'A':  # Exempt
-                        tax_amount = 0.0
-                        sales_amount_with_tax = line_total
-                    else:
-                        tax_amount = round(line_total * (tax_percent / 100), 2)
-                        sales_amount_with_tax = line_total + tax_amount
-                    
-                    # Add to tax summary
-                    tax_key = f"{tax_id}_{tax_percent}"
-                    if tax_key not in tax_summary:
-                        tax_summary[tax_key] = {
-                            'taxID': tax_id,
-                            'taxPercent': tax_percent,
-                            'salesAmountWithTax': 0.0,
-                            'taxAmount': 0.0
-                        }
-                    tax_summary[tax_key]['salesAmountWithTax'] += sales_amount_with_tax
-                    tax_summary[tax_key]['taxAmount'] += tax_amount
-                    
-                    # Add to balance by money type
-                    money_type = invoice.money_type or 'Cash'
-                    if money_type not in balance_by_money_type:
-                        balance_by_money_type[money_type] = 0.0
-                    balance_by_money_type[money_type] += sales_amount_with_tax
+            # Per-tax and per-money-type totals for this currency
+            summary = currency_summaries.get(curr, {})
+            tax_summary = summary.get('tax_summary', {})
+            balance_by_money_type = summary.get('balance_by_money_type', {})
             
             # Build counters only for tax types that were actually used
             counters = []
@@ -0,0 +1,150 @@
+from sqlalchemy import func, select, update
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.models import DeviceGlobalNumber, Invoice
+
+
+def _dialect(executor):
+    """Get the SQL dialect for a session or connection"""
+    if hasattr(executor, 'get_bind'):
+        return executor.get_bind().dialect
+    return executor.dialect
+
+
+class GlobalNumberAllocator:
+    """
+    Allocates receiptGlobalNo values from the DeviceGlobalNumber table.
+
+    Each allocation is a single atomic UPDATE ... RETURNING on the device's row, so
+    two Waitress threads (or two service processes) can never hand out the same
+    number. The UPDATE runs inside the caller's transaction: the row stays locked
+    until the invoice is committed, which also keeps a device's receipts reaching
+    FDMS in number order, and a rollback (e.g. FDMS rejected the receipt) gives
+    the number back.
+
+    Numbers are therefore only skipped when they were committed for a receipt that
+    FDMS never accepts. The batch route gives back the unused tail of its range
+    with release(), and the fiscalization outbox does the same for queued receipts
+    that fail. Numbers are never reserved ahead in memory, because a restart would
+    lose them and leave a gap in the sequence FDMS validates.
+    """
+
+    def _seed_value(self, executor, device_id: str) -> int:
+        """Get the highest global number already used by a device's invoices"""
+        highest = executor.execute(
+            select(func.max(Invoice.receipt_global_no)).where(Invoice.device_id == device_id)
+        ).scalar()
+        return highest or 0
+
+    def _ensure_row(self, executor, device_id: str):
+        """Create the DeviceGlobalNumber row for a device if it does not exist yet"""
+        exists = executor.execute(
+            select(DeviceGlobalNumber.id).where(DeviceGlobalNumber.device_id == device_id)
+        ).first()
+        if exists:
+            return
+
+        # Another thread may insert the row concurrently; the unique constraint
+        # on device_id makes the loser fall back to the winner's row.
+        savepoint = executor.begin_nested()
+        try:
+            executor.execute(
+                DeviceGlobalNumber.__table__.insert().values(
+                    device_id=device_id,
+                    current_global_number=self._seed_value(executor, device_id)
+                )
+            )
+            savepoint.commit()
+        except IntegrityError:
+            savepoint.rollback()
+
+    def _reserve_on(self, executor, device_id: str, count: int) -> int:
+        """
+        Advance a device's counter by count and return the first reserved number.
+
+        Args:
+            executor: SQLAlchemy session or connection to run the statements on
+            device_id (str): Device identifier
+            count (int): Number of consecutive numbers to reserve
+
+        Returns:
+            int: First number of the reserved range
+        """
+        self._ensure_row(executor, device_id)
+        table = DeviceGlobalNumber.__table__
+
+        if _dialect(executor).full_returning:
+            last_number = executor.execute(
+                update(table)
+                .where(table.c.device_id == device_id)
+                .values(current_global_number=table.c.current_global_number + count)
+                .returning(table.c.current_global_number)
+            ).scalar()
+        else:
+            # Dialects without UPDATE ... RETURNING: lock the row, then update it
+            current = executor.execute(
+                select(table.c.current_global_number)
+                .where(table.c.device_id == device_id)
+                .with_for_update()
+            ).scalar()
+            last_number = current + count
+            executor.execute(
+                update(table)
+                .where(table.c.device_id == device_id)
+                .values(current_global_number=last_number)
+            )
+
+        return last_number - count + 1
+
+    def reserve(self, device_id: str, count: int = 1) -> int:
+        """
+        Reserve count consecutive numbers inside the current db.session transaction.
+
+        The device row stays locked until the caller commits or rolls back.
+
+        Returns:
+            int: First number of the reserved range
+        """
+        return self._reserve_on(db.session, str(device_id), count)
+
+    def lock(self, device_id: str):
+        """Lock a device's counter row until the current db.session transaction ends"""
+        table = DeviceGlobalNumber.__table__
+        db.session.execute(
+            select(table.c.id).where(table.c.device_id == str(device_id)).with_for_update()
+        )
+
+    def release(self, device_id: str, last_used: int):
+        """
+        Give back the unused tail of a range taken with reserve().
+
+        Only valid in the same transaction as the reserve() call, while the device
+        row is still locked, so no other allocation can have moved past the range.
+
+        Args:
+            device_id (str): Device identifier
+            last_used (int): Last number of the range that was actually used
+        """
+        table = DeviceGlobalNumber.__table__
+        db.session.execute(
+            update(table)
+            .where(table.c.device_id == str(device_id))
+            .where(table.c.current_global_number > last_used)
+            .values(current_global_number=last_used)
+        )
+
+    def next_number(self, device_id: str) -> int:
+        """
+        Get the next receiptGlobalNo for a device, inside the current db.session transaction.
+
+        Args:
+            device_id (str): Device identifier
+
+        Returns:
+            int: Allocated global number
+        """
+        return self.reserve(str(device_id))
+
+
+# Global allocator shared by all request threads
+global_number_allocator = GlobalNumberAllocator()
@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from sqlalchemy import case, or_
+from app import db
+from app.models import Invoice
+
+
+def receipt_request_hash(receipt_data: dict) -> str:
+    """
+    Fingerprint a receipt exactly as posted by the POS.
+
+    Must be taken before prepare_receipt_data, which rewrites line amounts in place.
+    """
+    canonical = json.dumps(receipt_data, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class ReceiptReplayCache:
+    """
+    LRU of recently fiscalized receipts, keyed by device and invoice number.
+
+    A till that retries after a timeout gets its stored response from memory,
+    without a database read. Misses fall back to an indexed lookup on the invoice
+    table, so the cache only has to hold the recent receipts that retries target.
+    """
+
+    def __init__(self, max_entries: int = 10000):
+        """
+        Initialize the cache.
+
+        Args:
+            max_entries (int): Receipts kept before the least recently used one is evicted
+        """
+        self.max_entries = max(1, int(max_entries))
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._keys = {}
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, device_id: str, invoice_no: str = None, idempotency_key: str = None) -> dict:
+        """Get a cached receipt by invoice number or Idempotency-Key, or None"""
+        device_id = str(device_id)
+        with self._lock:
+            if idempotency_key is not None and (device_id, idempotency_key) in self._keys:
+                invoice_no = self._keys[(device_id, idempotency_key)]
+            entry = self._entries.get((device_id, str(invoice_no))) if invoice_no is not None else None
+            if entry is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._entries.move_to_end((device_id, str(invoice_no)))
+            return entry
+
+    def put(self, device_id: str, invoice_no: str, request_hash: str, response: dict, idempotency_key: str = None):
+        """Remember a fiscalized receipt once its transaction has committed"""
+        key = (str(device_id), str(invoice_no))
+        entry = {
+            'invoice_id': str(invoice_no),
+            'idempotency_key': idempotency_key,
+            'request_hash': request_hash,
+            'response': response
+        }
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            if idempotency_key is not None:
+                self._keys[(key[0], idempotency_key)] = key[1]
+            while len(self._entries) > self.max_entries:
+                (evicted_device, _), evicted = self._entries.popitem(last=False)
+                if evicted['idempotency_key'] is not None:
+                    self._keys.pop((evicted_device, evicted['idempotency_key']), None)
+
+    def clear(self):
+        """Forget every cached receipt"""
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+
+    def stats(self) -> dict:
+        """Get cache hit/miss counters"""
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries
+            }
+
+
+# Global replay cache shared by all request threads
+receipt_replay_cache = ReceiptReplayCache(
+    max_entries=int(os.environ.get('ZIMRA_IDEMPOTENCY_CACHE_SIZE', '10000'))
+)
+
+
+def find_fiscalized_receipt(device_id: str, invoice_no: str, idempotency_key: str = None) -> dict:
+    """
+    Find an earlier submission with this invoice number or Idempotency-Key.
+
+    Checks the replay cache, then reads only the idempotency columns of the invoice
+    (served by uq_device_invoice and ix_invoice_device_idempotency_key).
+
+    Parameters:
+        device_id (str): Device identifier
+        invoice_no (str): Invoice number of the new submission
+        idempotency_key (str): Idempotency-Key header, if sent
+
+    Returns:
+        dict: invoice_id, idempotency_key, request_hash and response (None for receipts
+        stored before responses were kept), or None if neither was submitted before
+    """
+    cached = receipt_replay_cache.get(device_id, invoice_no, idempotency_key)
+    if cached is not None:
+        return cached
+
+    conditions = [Invoice.invoice_id == str(invoice_no)]
+    if idempotency_key is not None:
+        conditions.append(Invoice.idempotency_key == idempotency_key)
+    query = db.session.query(
+        Invoice.invoice_id, Invoice.idempotency_key, Invoice.request_hash, Invoice.fiscal_response
+    ).filter(
+        Invoice.device_id == str(device_id),
+        or_(*conditions)
+    )
+    if idempotency_key is not None:
+        # The invoice that owns the key wins over another one with this invoice number
+        query = query.order_by(case((Invoice.idempotency_key == idempotency_key, 0), else_=1))
+    row = query.first()
+    if row is None:
+        return None
+
+    response = json.loads(row.fiscal_response) if row.fiscal_response else None
+    if response is not None and row.request_hash:
+        receipt_replay_cache.put(device_id, row.invoice_id, row.request_hash, response, row.idempotency_key)
+    return {
+        'invoice_id': row.invoice_id,
+        'idempotency_key': row.idempotency_key,
+        'request_hash': row.request_hash,
+        'response': response
+    }
@@ -0,0 +1,145 @@
+from types import SimpleNamespace
+from sqlalchemy.orm import joinedload, selectinload
+from app.models import Invoice
+
+
+def load_invoice(invoice_id: str) -> Invoice:
+    """
+    Load an invoice with its branch profile and line items.
+
+    The branch profile is joined into the invoice query and the line items are
+    fetched with one SELECT ... IN, so a detail fetch is two queries.
+
+    Returns:
+        Invoice: The invoice, or None if not found
+    """
+    return Invoice.query.options(
+        joinedload(Invoice.branch_profile),
+        selectinload(Invoice.line_items)
+    ).filter(Invoice.invoice_id == invoice_id).first()
+
+
+def calculate_tax_summaries(line_items: list) -> list:
+    """Total the line amounts and VAT per tax rate, highest rate first, for the printed invoice"""
+    tax_groups = {}
+    for item in line_items:
+        tax_percent = item.tax_percent or 0
+        if tax_percent not in tax_groups:
+            tax_groups[tax_percent] = {
+                'amount': 0,
+                'vat_amount': 0,
+                'tax_code': item.tax_code
+            }
+
+        amount = item.receipt_line_total or 0
+        tax_groups[tax_percent]['amount'] += amount
+        tax_groups[tax_percent]['vat_amount'] += amount * (tax_percent / 100)
+
+    return [
+        {
+            'label': f"Total {tax_percent}%",
+            'amount': data['amount'],
+            'vat_amount': data['vat_amount']
+        }
+        for tax_percent, data in sorted(tax_groups.items(), reverse=True)
+        if tax_percent > 0
+    ]
+
+
+def build_invoice_detail(invoice: Invoice) -> SimpleNamespace:
+    """
+    Gather everything the JSON, HTML and PDF invoice views show from a loaded invoice.
+
+    Returns:
+        SimpleNamespace: invoice, line_items, branch_address and branch_contact (both the
+        invoice's branch profile, or None) and tax_summaries
+    """
+    line_items = list(invoice.line_items)
+    return SimpleNamespace(
+        invoice=invoice,
+        line_items=line_items,
+        branch_address=invoice.branch_profile,
+        branch_contact=invoice.branch_profile,
+        tax_summaries=calculate_tax_summaries(line_items)
+    )
+
+
+def assemble_invoice(invoice_id: str) -> SimpleNamespace:
+    """
+    Load an invoice and gather what its views show (see build_invoice_detail).
+
+    Parameters:
+        invoice_id (str): Invoice number
+
+    Returns:
+        SimpleNamespace: The invoice detail, or None if the invoice is not found
+    """
+    invoice = load_invoice(invoice_id)
+    if invoice is None:
+        return None
+    return build_invoice_detail(invoice)
+
+
+def load_fiscal_day_invoice_details(device_id: str, fiscal_day_no) -> list:
+    """
+    Load the details of every invoice of a device's fiscal day, in receipt order.
+
+    Three queries whatever the number of invoices (served by ix_invoice_device_fiscal_day).
+    """
+    invoices = Invoice.query.options(
+        joinedload(Invoice.branch_profile),
+        selectinload(Invoice.line_items)
+    ).filter(
+        Invoice.device_id == str(device_id),
+        Invoice.fiscal_day_number == str(fiscal_day_no)
+    ).order_by(Invoice.receipt_global_no).all()
+    return [build_invoice_detail(invoice) for invoice in invoices]
+
+
+def invoice_pdf_data(detail: SimpleNamespace) -> dict:
+    """Build the invoice_data dict taken by invoice_template.generate_invoice_pdf_a4_format"""
+    invoice = detail.invoice
+    branch_address = detail.branch_address
+    branch_contact = detail.branch_contact
+
+    invoice_data = {
+        'invoice_id': invoice.invoice_id,
+        'zimra_receipt_number': invoice.zimra_receipt_number,
+        'device_id': invoice.device_id,
+        'created_at': invoice.created_at.strftime('%Y-%m-%d %H:%M:%S') if invoice.created_at else 'N/A',
+        'is_fiscalized': invoice.is_fiscalized,
+        'receipt_type': invoice.receipt_type,
+        'money_type': invoice.money_type,
+        'receipt_counter': invoice.receipt_counter,
+        'receipt_global_no': invoice.receipt_global_no,
+        'fiscal_day_number': invoice.fiscal_day_number,
+        'operation_id': invoice.operation_id,
+        'verification_number': invoice.verification_number,
+        'hash_string': invoice.hash_string,
+        'tax_payer_name': invoice.tax_payer_name,
+        'tax_payer_tin': invoice.tax_payer_tin,
+        'vat_number': invoice.vat_number,
+        'device_branch_name': invoice.device_branch_name,
+        'debit_credit_note_invoice_ref_date': invoice.debit_credit_note_invoice_ref_date.strftime('%Y-%m-%d %H:%M:%S') if invoice.debit_credit_note_invoice_ref_date else None,
+        'receipt_total': invoice.receipt_total,
+        'notes': invoice.receipt_notes,
+        'qr_code_url': invoice.qr_code_string,
+        'branch_address': f"{branch_address.street}, {branch_address.house_no}, {branch_address.city}, {branch_address.province}" if branch_address else None,
+        'branch_contact': f"Email: {branch_contact.email}, Phone: {branch_contact.phone_number}" if branch_contact else None,
+        'line_items': []
+    }
+
+    # Add line items
+    for item in detail.line_items:
+        invoice_data['line_items'].append({
+            'receipt_line_name': item.receipt_line_name,
+            'receipt_line_quantity': item.receipt_line_quantity,
+            'receipt_line_price': item.receipt_line_price,
+            'receipt_line_total': item.receipt_line_total,
+            'tax_code': item.tax_code,
+            'tax_percent': item.tax_percent,
+            'receipt_line_hs_code': item.receipt_line_hs_code,
+            'tax_id': item.tax_id
+        })
+
+    return invoice_data
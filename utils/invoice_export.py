@@ -0,0 +1,124 @@
+import csv
+import io
+import json
+import os
+from itertools import groupby
+from app import db
+from app.models import Invoice, InvoiceLineItem
+
+
+# Rows fetched per round-trip from the server-side cursor
+EXPORT_BATCH_SIZE = int(os.environ.get('ZIMRA_EXPORT_BATCH_SIZE', '1000'))
+
+# Invoice columns in the export (same fields as the invoice listing)
+INVOICE_EXPORT_COLUMNS = (
+    'id', 'invoice_id', 'device_id', 'receipt_currency', 'money_type', 'receipt_type', 'receipt_total',
+    'zimra_receipt_number', 'operation_id', 'qr_code_string', 'verification_number', 'is_fiscalized',
+    'receipt_counter', 'receipt_global_no', 'fiscal_day_number', 'receipt_notes', 'tax_payer_name',
+    'tax_payer_tin', 'vat_number', 'device_branch_name', 'created_at', 'updated_at'
+)
+
+# Line item columns, prefixed with line_ in the query and the CSV header
+LINE_ITEM_EXPORT_COLUMNS = (
+    'receipt_line_type', 'receipt_line_no', 'receipt_line_hs_code', 'receipt_line_name',
+    'receipt_line_price', 'receipt_line_quantity', 'receipt_line_total', 'tax_code', 'tax_percent', 'tax_id'
+)
+
+
+def serialize_invoice(invoice) -> dict:
+    """Format an invoice (model or export row) for the listing and export APIs"""
+    return {
+        'id': invoice.id,
+        'invoice_id': invoice.invoice_id,
+        'device_id': invoice.device_id,
+        'receipt_currency': invoice.receipt_currency,
+        'money_type': invoice.money_type,
+        'receipt_type': invoice.receipt_type,
+        'receipt_total': float(invoice.receipt_total),
+        'zimra_receipt_number': invoice.zimra_receipt_number,
+        'operation_id': invoice.operation_id,
+        'qr_code_string': invoice.qr_code_string,
+        'verification_number': invoice.verification_number,
+        'is_fiscalized': invoice.is_fiscalized,
+        'receipt_counter': invoice.receipt_counter,
+        'receipt_global_no': invoice.receipt_global_no,
+        'fiscal_day_number': invoice.fiscal_day_number,
+        'receipt_notes': invoice.receipt_notes,
+        'tax_payer_name': invoice.tax_payer_name,
+        'tax_payer_tin': invoice.tax_payer_tin,
+        'vat_number': invoice.vat_number,
+        'device_branch_name': invoice.device_branch_name,
+        'created_at': invoice.created_at.isoformat() if invoice.created_at else None,
+        'updated_at': invoice.updated_at.isoformat() if invoice.updated_at else None
+    }
+
+
+def _serialize_line_item(row) -> dict:
+    """Format the line item columns of an export row"""
+    line_item = {column: getattr(row, f'line_{column}') for column in LINE_ITEM_EXPORT_COLUMNS}
+    for column in ('receipt_line_price', 'receipt_line_quantity', 'receipt_line_total'):
+        if line_item[column] is not None:
+            line_item[column] = float(line_item[column])
+    return line_item
+
+
+def invoice_export_query():
+    """
+    Build the export query: invoice columns outer-joined to their line items.
+
+    Plain columns are selected (no ORM objects, so nothing accumulates in the session),
+    ordered oldest invoice first with each invoice's lines together. Apply the listing
+    filters to the returned query before streaming it.
+    """
+    columns = [getattr(Invoice, column) for column in INVOICE_EXPORT_COLUMNS]
+    columns += [getattr(InvoiceLineItem, column).label(f'line_{column}') for column in LINE_ITEM_EXPORT_COLUMNS]
+    return db.session.query(*columns).outerjoin(
+        InvoiceLineItem, InvoiceLineItem.invoice_id == Invoice.id
+    ).order_by(Invoice.created_at, Invoice.id, InvoiceLineItem.receipt_line_no)
+
+
+def _stream_rows(query):
+    """Iterate an export query through a server-side cursor, EXPORT_BATCH_SIZE rows at a time"""
+    return query.yield_per(EXPORT_BATCH_SIZE)
+
+
+def stream_invoices_jsonl(query):
+    """
+    Yield one JSON line per invoice, with its line items, from an export query.
+
+    Memory use is bounded by one cursor batch plus one invoice, whatever the range.
+    """
+    for _, rows in groupby(_stream_rows(query), key=lambda row: row.id):
+        rows = list(rows)
+        invoice = serialize_invoice(rows[0])
+        invoice['line_items'] = [_serialize_line_item(row) for row in rows if row.line_receipt_line_no is not None]
+        yield json.dumps(invoice, default=str) + '\n'
+
+
+def stream_invoices_csv(query):
+    """
+    Yield CSV text from an export query: one row per line item, with its invoice's columns.
+
+    Invoices without line items get a single row with empty line columns. Output is
+    flushed every EXPORT_BATCH_SIZE rows.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(list(INVOICE_EXPORT_COLUMNS) + [f'line_{column}' for column in LINE_ITEM_EXPORT_COLUMNS])
+
+    pending = 0
+    for row in _stream_rows(query):
+        invoice = serialize_invoice(row)
+        line_item = _serialize_line_item(row)
+        writer.writerow(
+            [invoice[column] for column in INVOICE_EXPORT_COLUMNS]
+            + [line_item[column] for column in LINE_ITEM_EXPORT_COLUMNS]
+        )
+        pending += 1
+        if pending >= EXPORT_BATCH_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+            pending = 0
+
+    yield buffer.getvalue()
@@ -0,0 +1,72 @@
+import base64
+import json
+from datetime import datetime
+from sqlalchemy import and_, or_, tuple_
+from app.models import Invoice
+
+
+# Newest first. Invoices without created_at (legacy rows) come first, which is
+# PostgreSQL's default for DESC, so the (created_at, id) indexes serve it backwards.
+LISTING_ORDER = (Invoice.created_at.desc().nullsfirst(), Invoice.id.desc())
+
+
+def encode_cursor(created_at: datetime, invoice_pk: int) -> str:
+    """Encode an invoice's (created_at, id) position as an opaque URL-safe cursor"""
+    payload = json.dumps(
+        [created_at.isoformat() if created_at is not None else None, invoice_pk],
+        separators=(',', ':')
+    )
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """
+    Decode a cursor made by encode_cursor.
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, invoice_pk = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        return (datetime.fromisoformat(created_at) if created_at is not None else None), int(invoice_pk)
+    except Exception:
+        raise ValueError("Invalid pagination cursor")
+
+
+def paginate_invoices_keyset(query, cursor: str = None, per_page: int = 10) -> tuple:
+    """
+    Fetch one page of invoices, newest first, after a cursor.
+
+    Seeks past the cursor's (created_at, id) with a row comparison served by
+    ix_invoice_created_at_id / ix_invoice_device_created_at_id, so a deep page
+    costs the same as the first one. Invoices without created_at are listed
+    first (see LISTING_ORDER) and paged by id.
+
+    Parameters:
+        query: Filtered Invoice query (unordered)
+        cursor (str): next_cursor of the previous page, or None for the first page
+        per_page (int): Invoices per page
+
+    Returns:
+        tuple: (invoices, next_cursor), next_cursor being None on the last page
+    """
+    if cursor:
+        created_at, invoice_pk = decode_cursor(cursor)
+        if created_at is None:
+            # Still among the undated invoices: the older ones, then every dated invoice
+            query = query.filter(or_(
+                and_(Invoice.created_at.is_(None), Invoice.id < invoice_pk),
+                Invoice.created_at.isnot(None)
+            ))
+        else:
+            query = query.filter(tuple_(Invoice.created_at, Invoice.id) < tuple_(created_at, invoice_pk))
+
+    # One extra row tells whether there is a next page
+    invoices = query.order_by(*LISTING_ORDER).limit(per_page + 1).all()
+    if len(invoices) <= per_page:
+        return invoices, None
+
+    invoices = invoices[:per_page]
+    last = invoices[-1]
+    return invoices, encode_cursor(last.created_at, last.id)
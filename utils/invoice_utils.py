@@ -4,7 +4,7 @@ import base64
 from datetime import datetime
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import padding
-from app.models import Invoice, InvoiceLineItem, DeviceBranchAddress, DeviceBranchContact, DeviceConfig, FiscalDay
+from app.models import Invoice, InvoiceLineItem, FiscalDay, ReceiptChainHead
 from app.config import zimra_config
 from app import db
 
@@ -84,10 +84,10 @@ def get_existing_invoice_info(device_id: str, invoice_id: str) -> dict:
     return {"exists": False}
 
 
-def get_fiscal_day_counter(device_id: str, fiscal_open_date_time: str) -> int:
-    """Get the current fiscal day counter for a device"""
-    # This is a simplified version - you might need to implement based on your business logic
-    return Invoice.query.filter_by(device_id=device_id).count()
+def get_fiscal_day_counter(device_id: str, fiscal_day_no: int) -> int:
+    """Get the number of receipts fiscalized so far in a device's fiscal day"""
+    chain_head = get_chain_head(device_id, fiscal_day_no)
+    return chain_head.receipt_counter if chain_head else 0
 
 
 def get_global_number(device_id: str) -> int:
@@ -108,7 +108,11 @@ def get_global_number(device_id: str) -> int:
 
 def increment_global_number(device_id: str) -> int:
     """
-    Simple approach: Find the last receipt's global number and increment it by 1.
+    Allocate the next global number for a device from the DeviceGlobalNumber table.
+    
+    The allocation is an atomic UPDATE ... RETURNING on the device's row (see
+    utils.global_number_allocator), so concurrent requests never receive the same
+    number. The number is only consumed when the caller's transaction commits.
     
     Args:
         device_id (str): The device identifier
@@ -117,30 +121,21 @@ def increment_global_number(device_id: str) -> int:
         int: The incremented global number for the device
     """
     from flask import current_app
+    from utils.global_number_allocator import global_number_allocator
     
-    # Find the latest invoice for this device that has a non-null global number
-    latest_invoice = (
-        Invoice.query
-        .filter_by(device_id=device_id)
-        .filter(Invoice.receipt_global_no != None)
-        .order_by(Invoice.receipt_global_no.desc())
-        .first()
-    )
-    
-    if latest_invoice and latest_invoice.receipt_global_no is not None:
-        # Get the last global number and increment by 1
-        last_global_number = latest_invoice.receipt_global_no
-        new_global_number = last_global_number + 1
-        current_app.logger.debug(f"Device {device_id}: Last global number was {last_global_number}, new global number is {new_global_number}")
-        return new_global_number
-    else:
-        # No previous invoices or no global number, start from 1
-        current_app.logger.debug(f"Device {device_id}: No previous global number found, starting from 1")
-        return 1
+    new_global_number = global_number_allocator.next_number(device_id)
+    current_app.logger.debug(f"Device {device_id}: allocated global number {new_global_number}")
+    return new_global_number
 
 
 def initialize_device_global_numbers():
-    """Initialize global number records for all devices that don't have one"""
+    """
+    Initialize global number records for all devices that don't have one.
+    
+    Existing records that lag behind the highest global number already stored on
+    the device's invoices are moved forward, so the allocator never re-issues a
+    number that FDMS has seen.
+    """
     from app import db
     from app.models import DeviceGlobalNumber, DeviceInfo
     
@@ -151,16 +146,18 @@ def initialize_device_global_numbers():
         # Check if device already has a global number record
         existing_record = DeviceGlobalNumber.query.filter_by(device_id=device.device_id).first()
         
+        # Get the current highest global number from invoices
+        current_highest = get_global_number(device.device_id)
+        
         if existing_record is None:
-            # Get the current highest global number from invoices
-            current_highest = get_global_number(device.device_id)
-            
             # Create a new record
             new_record = DeviceGlobalNumber(
                 device_id=device.device_id,
                 current_global_number=current_highest
             )
             db.session.add(new_record)
+        elif existing_record.current_global_number < current_highest:
+            existing_record.current_global_number = current_highest
     
     try:
         db.session.commit()
@@ -180,15 +177,111 @@ def get_fiscal_day_open_date_time(open_day_date_time: str) -> str:
         return open_day_date_time
 
 
-def get_previous_hash(device_id: str, fiscal_open_date_time: str) -> str:
+def get_previous_hash(device_id: str, fiscal_day_no: int) -> str:
     """Get the previous receipt hash for chaining"""
-    # Get the most recent invoice for this device and fiscal day
-    latest_invoice = Invoice.query.filter_by(device_id=device_id).order_by(Invoice.receipt_counter.desc()).first()
-    if latest_invoice and latest_invoice.hash_string:
-        return latest_invoice.hash_string
+    chain_head = get_chain_head(device_id, fiscal_day_no)
+    if chain_head and chain_head.last_hash:
+        return chain_head.last_hash
     return ''
 
 
+def get_chain_head(device_id: str, fiscal_day_no: int, before_global_no: int = None):
+    """
+    Get the receipt hash-chain head for a device and fiscal day.
+    
+    The head holds the last receipt hash, the number of receipts and the last global
+    number of the fiscal day, so submit_receipt can chain a new receipt with a single
+    indexed lookup. Fiscal days fiscalized before the head table existed are
+    bootstrapped from their invoices on first access.
+    
+    Parameters:
+        device_id (str): The device ID
+        fiscal_day_no (int): The fiscal day number
+        before_global_no (int): Only bootstrap from receipts numbered below this global number
+        
+    Returns:
+        ReceiptChainHead: The chain head, or None if the fiscal day has no receipts yet
+    """
+    chain_head = ReceiptChainHead.query.filter_by(
+        device_id=str(device_id),
+        fiscal_day_no=int(fiscal_day_no)
+    ).first()
+    if chain_head:
+        return chain_head
+    
+    # Bootstrap from the fiscal day's invoices (only needed once per legacy day)
+    fiscalized = Invoice.query.filter_by(
+        device_id=str(device_id),
+        fiscal_day_number=str(fiscal_day_no),
+        is_fiscalized=True
+    )
+    if before_global_no is not None:
+        fiscalized = fiscalized.filter(Invoice.receipt_global_no < before_global_no)
+    latest_invoice = fiscalized.order_by(Invoice.receipt_global_no.desc()).first()
+    if not latest_invoice:
+        return None
+    
+    chain_head = ReceiptChainHead(
+        device_id=str(device_id),
+        fiscal_day_no=int(fiscal_day_no),
+        last_hash=latest_invoice.hash_string,
+        receipt_counter=fiscalized.count(),
+        last_global_no=latest_invoice.receipt_global_no
+    )
+    db.session.add(chain_head)
+    db.session.flush()
+    return chain_head
+
+
+def advance_chain_head(device_id: str, fiscal_day_no: int, hash_string: str, receipt_global_no: int):
+    """
+    Move the hash-chain head of a fiscal day to a newly fiscalized receipt.
+    
+    Runs in the caller's transaction so the head and the invoice are committed together.
+    
+    Parameters:
+        device_id (str): The device ID
+        fiscal_day_no (int): The fiscal day number
+        hash_string (str): Hash of the receipt that was fiscalized
+        receipt_global_no (int): Global number of the receipt that was fiscalized
+        
+    Returns:
+        ReceiptChainHead: The updated chain head
+    """
+    chain_head = get_chain_head(device_id, fiscal_day_no, before_global_no=receipt_global_no)
+    if chain_head is None:
+        chain_head = ReceiptChainHead(
+            device_id=str(device_id),
+            fiscal_day_no=int(fiscal_day_no),
+            receipt_counter=0
+        )
+        db.session.add(chain_head)
+    
+    chain_head.last_hash = hash_string
+    chain_head.receipt_counter = (chain_head.receipt_counter or 0) + 1
+    chain_head.last_global_no = receipt_global_no
+    return chain_head
+
+
+def rewind_chain_head(device_id: str, fiscal_day_no: int):
+    """
+    Reset a fiscal day's hash-chain head to its last fiscalized invoice.
+    
+    Used when receipts that were chained ahead of ZIMRA (queued for asynchronous
+    fiscalization) are rejected, so the next receipt chains off the last receipt
+    ZIMRA actually accepted. Runs in the caller's transaction.
+    
+    Returns:
+        ReceiptChainHead: The rebuilt chain head, or None if the day has no fiscalized receipts
+    """
+    ReceiptChainHead.query.filter_by(
+        device_id=str(device_id),
+        fiscal_day_no=int(fiscal_day_no)
+    ).delete()
+    db.session.flush()
+    return get_chain_head(device_id, fiscal_day_no)
+
+
 def calculate_tax_summary(receipt_lines: list) -> dict:
     """Calculate tax summary from receipt lines with enhanced logic like Django"""
     # Map letter tax codes to numeric codes for processing
@@ -258,60 +351,37 @@ def get_tax_id(tax_code: str) -> int:
     return zimra_config.get_tax_id(tax_code)
 
 
+def build_invoice_line_item(invoice_id: int, line_no: int, line: dict) -> InvoiceLineItem:
+    """Build an invoice line item from a receipt line"""
+    return InvoiceLineItem(
+        invoice_id=invoice_id,
+        receipt_line_type=line.get('receiptLineType', 'Sale'),
+        receipt_line_no=line_no,
+        receipt_line_hs_code=line.get('receiptLineHSCode', '12345'),
+        receipt_line_name=line.get('receiptLineName'),
+        receipt_line_price=float(line.get('receiptLinePrice', 0)),
+        receipt_line_quantity=float(line.get('receiptLineQuantity', 0)),
+        receipt_line_total=float(line.get('receiptLineTotal', 0)),
+        tax_code=line.get('taxCode', '15'),
+        tax_percent=get_tax_percentage(line.get('taxCode', '15')),
+        tax_id=get_tax_id(line.get('taxCode', '15'))
+    )
+
+
 def create_invoice_line_items(invoice_id: int, receipt_lines: list) -> list:
     """Create invoice line items from receipt lines"""
     line_items = []
     
     for i, line in enumerate(receipt_lines, 1):
-        line_item = InvoiceLineItem(
-            invoice_id=invoice_id,
-            receipt_line_type=line.get('receiptLineType', 'Sale'),
-            receipt_line_no=i,
-            receipt_line_hs_code=line.get('receiptLineHSCode', '12345'),
-            receipt_line_name=line.get('receiptLineName'),
-            receipt_line_price=float(line.get('receiptLinePrice', 0)),
-            receipt_line_quantity=float(line.get('receiptLineQuantity', 0)),
-            receipt_line_total=float(line.get('receiptLineTotal', 0)),
-            tax_code=line.get('taxCode', '15'),
-            tax_percent=get_tax_percentage(line.get('taxCode', '15')),
-            tax_id=get_tax_id(line.get('taxCode', '15'))
-        )
+        line_item = build_invoice_line_item(invoice_id, i, line)
         line_items.append(line_item)
         db.session.add(line_item)
     
     return line_items
 
 
-def create_invoice(invoice_data: dict) -> Invoice:
-    """Create a new invoice"""
-    invoice = Invoice(
-        invoice_id=invoice_data['invoice_id'],
-        device_id=invoice_data['device_id'],
-        receipt_currency=invoice_data['receipt_currency'],
-        money_type=invoice_data['money_type'],
-        receipt_type=invoice_data['receipt_type'],
-        receipt_total=invoice_data['receipt_total']
-    )
-    
-    db.session.add(invoice)
-    db.session.commit()
-    
-    # Create line items
-    if 'line_items' in invoice_data:
-        create_invoice_line_items(invoice.id, invoice_data['line_items'])
-    
-    return invoice
-
-
-def update_fiscalized_invoice(update_data: dict) -> Invoice:
-    """Update invoice with fiscalization data"""
-    from flask import current_app
-    
-    invoice = Invoice.query.filter_by(invoice_id=update_data['invoice_id']).first()
-    
-    if not invoice:
-        raise ValueError(f"Invoice {update_data['invoice_id']} not found")
-    
+def apply_fiscalization_data(invoice: Invoice, update_data: dict):
+    """Copy ZIMRA response, receipt, tax payer and credit/debit note fields onto an invoice"""
     # Update ZIMRA response data
     invoice.zimra_receipt_number = update_data.get('zimra_receipt_number')
     invoice.operation_id = update_data.get('operation_id')
@@ -336,32 +406,84 @@ def update_fiscalized_invoice(update_data: dict) -> Invoice:
     invoice.debit_credit_note_invoice_ref = update_data.get('debit_credit_note_invoice_ref')
     invoice.debit_credit_note_invoice_ref_date = update_data.get('debit_credit_note_invoice_ref_date')
     
-    # Create or update device branch address
-    if 'device_branch_address' in update_data:
-        address_data = update_data['device_branch_address']
-        address = DeviceBranchAddress.query.filter_by(invoice_id=invoice.id).first()
-        if not address:
-            address = DeviceBranchAddress(invoice_id=invoice.id)
-            db.session.add(address)
-        
-        address.city = address_data.get('city')
-        address.house_no = address_data.get('house_no')
-        address.province = address_data.get('province')
-        address.street = address_data.get('street')
-    
-    # Create or update device branch contact
-    if 'device_branch_contact' in update_data:
-        contact_data = update_data['device_branch_contact']
-        contact = DeviceBranchContact.query.filter_by(invoice_id=invoice.id).first()
-        if not contact:
-            contact = DeviceBranchContact(invoice_id=invoice.id)
-            db.session.add(contact)
-        
-        contact.email = contact_data.get('email')
-        contact.phone_number = contact_data.get('phone_number')
+    # Kept so a retried submission can be answered without FDMS
+    invoice.idempotency_key = update_data.get('idempotency_key')
+    invoice.request_hash = update_data.get('request_hash')
+    if update_data.get('fiscal_response') is not None:
+        invoice.fiscal_response = json.dumps(update_data['fiscal_response'], default=str)
+
+
+def save_fiscalized_invoices(records: list, advance_chain: bool = True) -> list:
+    """
+    Bulk-insert already fiscalized invoices with their line items and branch profile reference.
+    
+    This is the single write path for fiscalized receipts. Every row is built in
+    memory; invoices, then their child rows, are flushed as batched INSERTs instead
+    of one round-trip per row, with no read-back of what was just written. The
+    hash-chain head and running fiscal day counters are moved in the same
+    transaction, for every signed receipt - including receipts stored offline, which
+    are saved unfiscalized until ZIMRA acknowledges their SubmitFile upload but are
+    already chained and part of the fiscal day. The caller commits.
+    
+    Args:
+        records (list): (invoice_data, update_data) pairs in submission order, as
+            returned by build_fiscalized_receipt
+        advance_chain (bool): Move the hash-chain head; False when it already moved at signing time
+    
+    Returns:
+        list: Created Invoice objects (with their database IDs) in the same order
+    """
+    # Invoices reference a shared branch profile instead of copying the address and contact
+    from utils.branch_profiles import resolve_branch_profile_ids
+    branch_profile_ids = resolve_branch_profile_ids(records)
+    
+    invoices = []
+    for (invoice_data, update_data), branch_profile_id in zip(records, branch_profile_ids):
+        invoice = Invoice(
+            invoice_id=invoice_data['invoice_id'],
+            device_id=invoice_data['device_id'],
+            receipt_currency=invoice_data['receipt_currency'],
+            money_type=invoice_data['money_type'],
+            receipt_type=invoice_data['receipt_type'],
+            receipt_total=invoice_data['receipt_total']
+        )
+        apply_fiscalization_data(invoice, update_data)
+        invoice.branch_profile_id = branch_profile_id
+        invoices.append(invoice)
+    
+    db.session.add_all(invoices)
+    db.session.flush()
+    
+    children = []
+    counter_entries = []
+    for invoice, (invoice_data, update_data) in zip(invoices, records):
+        line_items = [
+            build_invoice_line_item(invoice.id, i, line)
+            for i, line in enumerate(invoice_data.get('line_items', []), 1)
+        ]
+        children.extend(line_items)
+        counter_entries.append((invoice, line_items))
+    
+    db.session.add_all(children)
+    db.session.flush()
+    
+    # Move the hash-chain head through the receipts in submission order
+    for invoice in invoices:
+        if advance_chain and invoice.hash_string and invoice.fiscal_day_number:
+            advance_chain_head(
+                device_id=invoice.device_id,
+                fiscal_day_no=int(invoice.fiscal_day_number),
+                hash_string=invoice.hash_string,
+                receipt_global_no=invoice.receipt_global_no
+            )
+    
+    from utils.fiscal_day_counters import add_invoices_to_fiscal_counters
+    add_invoices_to_fiscal_counters([
+        (invoice, line_items) for invoice, line_items in counter_entries
+        if invoice.hash_string and invoice.fiscal_day_number
+    ])
     
-    db.session.commit()
-    return invoice
+    return invoices
 
 
 def qr_string_generator(device_id: str, qr_url: str, receipt_date: str, 
@@ -424,11 +546,10 @@ def base64_to_hex_md5(base64_signature: str) -> str:
 
 
 def get_device_config(device_id: str) -> dict:
-    """Get device configuration"""
-    device_config = DeviceConfig.query.filter_by(device_id=device_id).first()
-    if device_config:
-        return json.loads(device_config.config)
-    return {}
+    """Get device configuration (the parsed DeviceConfig JSON, from the device cache)"""
+    from utils.device_cache import device_cache
+    context = device_cache.get(device_id)
+    return context['config'] if context else {}
 
 
 def qr_date() -> str:
@@ -0,0 +1,74 @@
+import os
+import threading
+from cryptography.hazmat.primitives import serialization
+
+
+class PrivateKeyStore:
+    """
+    In-memory cache of parsed device private keys.
+
+    Each device's PEM key is read and parsed once; later lookups return the same
+    RSA key object until the key path changes or the file's modification time
+    moves (e.g. after a certificate renewal).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = {}
+        self._hits = 0
+        self._loads = 0
+
+    def get_key(self, device_id: str, key_path: str):
+        """
+        Get the parsed private key for a device.
+
+        Args:
+            device_id (str): Device identifier
+            key_path (str): Path to the device private key (PEM)
+
+        Returns:
+            RSAPrivateKey: Loaded key object, ready for ReceiptDeviceSignature
+        """
+        device_id = str(device_id)
+        mtime = os.path.getmtime(key_path)
+
+        with self._lock:
+            entry = self._keys.get(device_id)
+            if entry is not None and entry['path'] == key_path and entry['mtime'] == mtime:
+                self._hits += 1
+                return entry['key']
+
+        # Parse outside the lock so one slow load does not block other devices
+        with open(key_path, 'rb') as key_file:
+            key = serialization.load_pem_private_key(key_file.read(), password=None)
+
+        with self._lock:
+            self._loads += 1
+            self._keys[device_id] = {'path': key_path, 'mtime': mtime, 'key': key}
+        return key
+
+    def invalidate(self, device_id: str = None):
+        """Forget the cached key for a device, or every key when no device is given"""
+        with self._lock:
+            if device_id is None:
+                self._keys.clear()
+            else:
+                self._keys.pop(str(device_id), None)
+
+    def stats(self) -> dict:
+        """Get cache hit/load counters"""
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'loads': self._loads,
+                'devices': list(self._keys.keys())
+            }
+
+
+# Global key store shared by all request threads
+private_key_store = PrivateKeyStore()
+
+
+def get_device_private_key(device_id: str, key_path: str):
+    """Get the cached private key object for a device"""
+    return private_key_store.get_key(device_id, key_path)
@@ -0,0 +1,317 @@
+import base64
+import json
+import os
+import zlib
+from datetime import datetime
+import requests
+from sqlalchemy import func
+from app import db
+from app.config import zimra_config
+from app.models import DeviceInfo, FiscalDay, Invoice, OfflineFile, OfflineReceipt
+from utils.fdms_session import get_fdms_session
+
+
+PENDING = 'pending'
+UPLOADED = 'uploaded'
+
+# Fiscal day closed offline, waiting for the SubmitFile that carries its close
+FISCAL_DAY_CLOSE_PENDING = 'FISCAL_DAY_CLOSE_PENDING'
+
+# SubmitFile limits (ZIMRA accepts files of up to 3 MB)
+DEFAULT_BATCH_SIZE = int(os.environ.get('ZIMRA_OFFLINE_BATCH_SIZE', '100'))
+MAX_FILE_BYTES = int(os.environ.get('ZIMRA_OFFLINE_MAX_FILE_BYTES', str(3 * 1024 * 1024)))
+
+
+def compress_payload(receipt: dict) -> bytes:
+    """Serialize a signed receipt as compact, zlib-compressed JSON"""
+    return zlib.compress(json.dumps(receipt, separators=(',', ':')).encode('utf-8'), 9)
+
+
+def decompress_payload(payload: bytes) -> dict:
+    """Restore a signed receipt stored with compress_payload"""
+    return json.loads(zlib.decompress(payload).decode('utf-8'))
+
+
+def is_offline_mode_forced() -> bool:
+    """Check whether ZIMRA_OFFLINE_MODE keeps every device offline"""
+    return os.environ.get('ZIMRA_OFFLINE_MODE', 'false').lower() in ('1', 'true', 'yes')
+
+
+def is_offline_fallback_enabled() -> bool:
+    """Check whether receipts are stored offline when FDMS cannot be reached (ZIMRA_OFFLINE_FALLBACK, off by default)"""
+    return os.environ.get('ZIMRA_OFFLINE_FALLBACK', 'false').lower() in ('1', 'true', 'yes')
+
+
+def store_offline_receipt(invoice, receipt: dict) -> OfflineReceipt:
+    """
+    Keep a locally signed receipt for a later SubmitFile upload, in the caller's transaction.
+
+    Parameters:
+        invoice (Invoice): Invoice already saved for the receipt
+        receipt (dict): Signed SubmitReceipt data, with receiptGlobalNo and receiptDeviceSignature
+
+    Returns:
+        OfflineReceipt: The pending offline receipt
+    """
+    offline_receipt = OfflineReceipt(
+        device_id=str(invoice.device_id),
+        invoice_id=invoice.id,
+        fiscal_day_no=int(invoice.fiscal_day_number),
+        receipt_global_no=receipt['receiptGlobalNo'],
+        payload=compress_payload(receipt),
+        status=PENDING
+    )
+    db.session.add(offline_receipt)
+    return offline_receipt
+
+
+def has_pending_offline_receipts(device_id: str) -> bool:
+    """Check whether a device has offline receipts that ZIMRA has not acknowledged yet"""
+    return db.session.query(OfflineReceipt.id).filter(
+        OfflineReceipt.device_id == str(device_id),
+        OfflineReceipt.status == PENDING
+    ).first() is not None
+
+
+def get_devices_with_pending_offline_receipts() -> list:
+    """Get the devices that have offline receipts waiting to be uploaded"""
+    return [device_id for (device_id,) in db.session.query(OfflineReceipt.device_id).filter(
+        OfflineReceipt.status == PENDING
+    ).distinct().all()]
+
+
+def get_offline_status(device_id: str) -> dict:
+    """
+    Summarize a device's offline receipts and uploaded files.
+
+    Returns:
+        dict: Receipt counts per status and the most recent files
+    """
+    counts = dict(db.session.query(
+        OfflineReceipt.status,
+        func.count(OfflineReceipt.id)
+    ).filter(OfflineReceipt.device_id == str(device_id)).group_by(OfflineReceipt.status).all())
+
+    files = OfflineFile.query.filter_by(device_id=str(device_id)).order_by(OfflineFile.id.desc()).limit(20).all()
+    return {
+        'device_id': str(device_id),
+        'pending_receipts': counts.get(PENDING, 0),
+        'uploaded_receipts': counts.get(UPLOADED, 0),
+        'files': [
+            {
+                'fiscal_day_no': f.fiscal_day_no,
+                'file_sequence': f.file_sequence,
+                'receipt_count': f.receipt_count,
+                'first_global_no': f.first_global_no,
+                'last_global_no': f.last_global_no,
+                'file_size': f.file_size,
+                'operation_id': f.operation_id,
+                'created_at': f.created_at.isoformat() if f.created_at else None
+            }
+            for f in files
+        ]
+    }
+
+
+def close_fiscal_day_offline(fiscal_day: FiscalDay, close_payload: dict, fiscal_day_closed: str):
+    """
+    Close a fiscal day locally while its offline receipts are still pending, in the caller's transaction.
+
+    The signed close is kept on the fiscal day and sent as the footer of the SubmitFile
+    upload that carries the day's last receipt.
+
+    Parameters:
+        fiscal_day (FiscalDay): Open fiscal day
+        close_payload (dict): Signed CloseDay payload (see build_close_day_payload)
+        fiscal_day_closed (str): Close date the payload was signed with
+    """
+    fiscal_day.close_payload = json.dumps({
+        'fiscalDayCounters': close_payload['fiscalDayCounters'],
+        'fiscalDayDeviceSignature': close_payload['fiscalDayDeviceSignature'],
+        'receiptCounter': close_payload['receiptCounter'],
+        'fiscalDayClosed': fiscal_day_closed
+    })
+    fiscal_day.is_open = False
+    fiscal_day.fiscal_status = FISCAL_DAY_CLOSE_PENDING
+
+
+def build_offline_file(device_id: str, fiscal_day: FiscalDay, file_sequence: int, receipts: list,
+                       footer: dict = None) -> dict:
+    """
+    Build a SubmitFile document for receipts of one fiscal day.
+
+    The header identifies the device, fiscal day and file; the content holds the
+    signed receipts as they would have been sent with SubmitReceipt. Only the file
+    that closes the fiscal day has a footer: the fiscal day counters, receipt counter
+    and fiscalDayDeviceSignature of the close, and fiscalDayClosed.
+
+    Parameters:
+        device_id (str): Device identifier
+        fiscal_day (FiscalDay): Fiscal day the receipts belong to
+        file_sequence (int): Sequence number of the file within the fiscal day
+        receipts (list): Signed receipts in global number order
+        footer (dict): Signed close of the fiscal day, for its last file only
+
+    Returns:
+        dict: File with header, content and (optionally) footer sections
+    """
+    document = {
+        'header': {
+            'deviceID': int(device_id),
+            'fiscalDayNo': fiscal_day.fiscal_day_no,
+            'fiscalDayOpened': fiscal_day.fiscal_day_open,
+            'fileSequence': file_sequence
+        },
+        'content': {
+            'receipts': receipts
+        }
+    }
+    if footer is not None:
+        document['footer'] = footer
+    return document
+
+
+def _encode_file(document: dict) -> str:
+    """Base64-encode a SubmitFile document"""
+    return base64.b64encode(json.dumps(document, separators=(',', ':')).encode('utf-8')).decode('ascii')
+
+
+def upload_offline_receipts(device_id: str, batch_size: int = None, max_files: int = None) -> dict:
+    """
+    Upload a device's pending offline receipts to ZIMRA with SubmitFile.
+
+    Receipts go up in global number order, one fiscal day per file, with at most
+    batch_size receipts and MAX_FILE_BYTES per file. The file carrying the last
+    receipt of a fiscal day closed offline also carries the day's signed close.
+    Each acknowledged file is committed before the next one is sent, so an
+    interrupted upload resumes from the first receipt ZIMRA has not acknowledged. The invoices of an acknowledged file are
+    marked fiscalized, with the file's operationID, in the same commit.
+
+    The receipts of a file are locked (SELECT ... FOR UPDATE) until it is committed, so
+    concurrent uploads for a device - the API, the CLI and the outbox dispatcher - wait
+    for each other instead of sending the same file twice.
+
+    Parameters:
+        device_id (str): Device identifier
+        batch_size (int): Receipts per file (defaults to ZIMRA_OFFLINE_BATCH_SIZE)
+        max_files (int): Stop after this many files (None uploads everything)
+
+    Returns:
+        dict: Files and receipts uploaded, receipts still pending, and the error that stopped the upload
+    """
+    from flask import current_app
+
+    device_id = str(device_id)
+    batch_size = max(1, int(batch_size or DEFAULT_BATCH_SIZE))
+    result = {'device_id': device_id, 'files_uploaded': 0, 'receipts_uploaded': 0, 'error': None}
+
+    device = DeviceInfo.query.filter_by(device_id=device_id).first()
+    if not device:
+        raise ValueError(f"Device not found: {device_id}")
+
+    session = get_fdms_session(device_id, device.certificate_path, device.key_path)
+    url = zimra_config.get_api_url(device_id, "SubmitFile")
+    headers = {
+        "Content-Type": "application/json",
+        "Accept": "application/json",
+        "DeviceModelName": device.model_name,
+        "DeviceModelVersion": device.model_version
+    }
+
+    while max_files is None or result['files_uploaded'] < max_files:
+        # Not SKIP LOCKED: a second uploader must wait, not send later receipts out of order
+        batch = OfflineReceipt.query.filter_by(
+            device_id=device_id,
+            status=PENDING
+        ).order_by(OfflineReceipt.receipt_global_no).limit(batch_size).with_for_update().all()
+        if not batch:
+            break
+
+        # One fiscal day per file
+        fiscal_day_no = batch[0].fiscal_day_no
+        batch = [entry for entry in batch if entry.fiscal_day_no == fiscal_day_no]
+        fiscal_day = FiscalDay.query.filter_by(device_id=device_id, fiscal_day_no=fiscal_day_no).first()
+        if not fiscal_day:
+            result['error'] = f"Fiscal day {fiscal_day_no} not found"
+            break
+
+        last_sequence = db.session.query(func.max(OfflineFile.file_sequence)).filter(
+            OfflineFile.device_id == device_id,
+            OfflineFile.fiscal_day_no == fiscal_day_no
+        ).scalar() or 0
+
+        # A day closed offline is closed by the file that carries its last pending receipt
+        day_pending = db.session.query(func.count(OfflineReceipt.id)).filter(
+            OfflineReceipt.device_id == device_id,
+            OfflineReceipt.fiscal_day_no == fiscal_day_no,
+            OfflineReceipt.status == PENDING
+        ).scalar()
+        close_footer = json.loads(fiscal_day.close_payload) if fiscal_day.close_payload else None
+
+        def encode(receipts):
+            footer = close_footer if len(receipts) == day_pending else None
+            return _encode_file(build_offline_file(device_id, fiscal_day, last_sequence + 1, receipts, footer))
+
+        # Shrink the batch until the encoded file fits the size limit
+        receipts = [decompress_payload(entry.payload) for entry in batch]
+        encoded = encode(receipts)
+        while len(encoded) > MAX_FILE_BYTES and len(receipts) > 1:
+            keep = max(1, len(receipts) * MAX_FILE_BYTES // len(encoded))
+            keep = min(keep, len(receipts) - 1)
+            batch, receipts = batch[:keep], receipts[:keep]
+            encoded = encode(receipts)
+
+        try:
+            response = session.post(url, data=json.dumps(encoded), headers=headers, verify=False)
+        except requests.RequestException as e:
+            db.session.rollback()
+            result['error'] = str(e)
+            break
+
+        if response.status_code != 200:
+            db.session.rollback()
+            try:
+                details = response.json()
+            except ValueError:
+                details = response.text
+            result['error'] = {'status_code': response.status_code, 'details': details}
+            break
+
+        zimra_response = response.json()
+        offline_file = OfflineFile(
+            device_id=device_id,
+            fiscal_day_no=fiscal_day_no,
+            file_sequence=last_sequence + 1,
+            receipt_count=len(batch),
+            first_global_no=batch[0].receipt_global_no,
+            last_global_no=batch[-1].receipt_global_no,
+            file_size=len(encoded),
+            operation_id=str(zimra_response.get('operationID', ''))
+        )
+        db.session.add(offline_file)
+        db.session.flush()
+
+        uploaded_at = datetime.utcnow()
+        for entry in batch:
+            entry.status = UPLOADED
+            entry.offline_file_id = offline_file.id
+            entry.uploaded_at = uploaded_at
+        Invoice.query.filter(Invoice.id.in_([entry.invoice_id for entry in batch])).update(
+            {'is_fiscalized': True, 'operation_id': offline_file.operation_id}, synchronize_session=False
+        )
+        if close_footer is not None and len(batch) == day_pending:
+            fiscal_day.fiscal_status = 'FISCAL_DAY_CLOSED'
+        db.session.commit()
+
+        current_app.logger.info(
+            f"Uploaded offline file {offline_file.file_sequence} for device {device_id} day {fiscal_day_no}: "
+            f"receipts {offline_file.first_global_no}-{offline_file.last_global_no}"
+        )
+        result['files_uploaded'] += 1
+        result['receipts_uploaded'] += len(batch)
+
+    result['pending_receipts'] = db.session.query(func.count(OfflineReceipt.id)).filter(
+        OfflineReceipt.device_id == device_id,
+        OfflineReceipt.status == PENDING
+    ).scalar()
+    return result
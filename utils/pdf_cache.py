@@ -0,0 +1,180 @@
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from invoice_template import PDF_TEMPLATE_VERSION
+from utils.invoice_detail import assemble_invoice, invoice_pdf_data
+from utils.pdf_renderer import pdf_render_service
+
+
+logger = logging.getLogger(__name__)
+
+
+class InvoicePdfCache:
+    """
+    On-disk cache of rendered invoice PDFs.
+
+    A fiscalized invoice never changes, so its PDF is fully determined by the device,
+    the invoice number and the template version. The hash of those is both the file
+    name and the ETag; bumping PDF_TEMPLATE_VERSION makes every entry miss.
+    """
+
+    def __init__(self, directory: str, template_version: str):
+        """
+        Initialize the cache.
+
+        Args:
+            directory (str): Directory holding the cached PDFs (created on first write)
+            template_version (str): Version of the PDF layout
+        """
+        self.directory = directory
+        self.template_version = str(template_version)
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._writes = 0
+
+    def key(self, device_id: str, invoice_id: str) -> str:
+        """Content address of an invoice's PDF (also used as its ETag)"""
+        identity = f"{device_id}\0{invoice_id}\0{self.template_version}"
+        return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        """File path of a cache entry, sharded by the first two hex digits"""
+        return os.path.join(self.directory, key[:2], f"{key}.pdf")
+
+    def contains(self, key: str) -> bool:
+        """Whether a PDF is cached (without reading it)"""
+        return os.path.exists(self._path(key))
+
+    def get(self, key: str) -> bytes:
+        """Get a cached PDF, or None"""
+        try:
+            with open(self._path(key), 'rb') as f:
+                pdf_bytes = f.read()
+        except FileNotFoundError:
+            with self._lock:
+                self._misses += 1
+            return None
+        with self._lock:
+            self._hits += 1
+        return pdf_bytes
+
+    def put(self, key: str, pdf_bytes: bytes):
+        """Store a rendered PDF; written to a temporary file first so readers never see part of it"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(pdf_bytes)
+        os.replace(temp_path, path)
+        with self._lock:
+            self._writes += 1
+
+    def stats(self) -> dict:
+        """Get cache hit/miss/write counters"""
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'writes': self._writes,
+                'directory': self.directory,
+                'template_version': self.template_version
+            }
+
+
+# Global PDF cache shared by all request threads
+invoice_pdf_cache = InvoicePdfCache(
+    directory=os.environ.get('ZIMRA_PDF_CACHE_DIR', os.path.join(os.getcwd(), 'pdf_cache')),
+    template_version=PDF_TEMPLATE_VERSION
+)
+
+# Render PDFs in the background right after fiscalization (off by default)
+PDF_PRERENDER_ENABLED = os.environ.get('ZIMRA_PDF_PRERENDER', 'false').lower() == 'true'
+_prerender_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('ZIMRA_PDF_PRERENDER_WORKERS', '1')),
+    thread_name_prefix='pdf-prerender'
+)
+
+
+def invoice_pdf_etag(invoice) -> str:
+    """ETag of an invoice's PDF, or None if the invoice is not fiscalized (and so not cached)"""
+    if not invoice.is_fiscalized:
+        return None
+    return invoice_pdf_cache.key(invoice.device_id, invoice.invoice_id)
+
+
+def render_invoice_pdf(detail) -> bytes:
+    """Render an assembled invoice (see utils.invoice_detail.assemble_invoice) on the PDF worker pool"""
+    return pdf_render_service.render(invoice_pdf_data(detail))
+
+
+def get_invoice_pdf(detail) -> bytes:
+    """
+    Get the PDF of an assembled invoice.
+
+    Fiscalized invoices are read from the cache, or rendered and stored on a miss.
+    Other invoices are rendered every time.
+    """
+    etag = invoice_pdf_etag(detail.invoice)
+    if etag is None:
+        return render_invoice_pdf(detail)
+
+    pdf_bytes = invoice_pdf_cache.get(etag)
+    if pdf_bytes is None:
+        pdf_bytes = render_invoice_pdf(detail)
+        invoice_pdf_cache.put(etag, pdf_bytes)
+    return pdf_bytes
+
+
+def iter_invoice_pdfs(details: list):
+    """
+    Yield (detail, PDF bytes) for several assembled invoices, in order.
+
+    Cached PDFs are read from disk one at a time; the rest are rendered on the worker
+    pool first (fiscalized ones going into the cache as they finish).
+    """
+    missing = [
+        detail for detail in details
+        if invoice_pdf_etag(detail.invoice) is None
+        or not invoice_pdf_cache.contains(invoice_pdf_etag(detail.invoice))
+    ]
+    uncached = {}
+    rendered = pdf_render_service.render_many([invoice_pdf_data(detail) for detail in missing])
+    for detail, pdf_bytes in zip(missing, rendered):
+        etag = invoice_pdf_etag(detail.invoice)
+        if etag is None:
+            uncached[id(detail)] = pdf_bytes
+        else:
+            invoice_pdf_cache.put(etag, pdf_bytes)
+
+    for detail in details:
+        if id(detail) in uncached:
+            yield detail, uncached.pop(id(detail))
+        else:
+            yield detail, get_invoice_pdf(detail)
+
+
+def _prerender(app, invoice_ids: list):
+    """Render and cache the PDFs of fiscalized invoices (runs on the pre-render executor)"""
+    with app.app_context():
+        for invoice_id in invoice_ids:
+            try:
+                detail = assemble_invoice(invoice_id)
+                if detail is not None:
+                    get_invoice_pdf(detail)
+            except Exception as e:
+                logger.warning(f"Could not pre-render PDF for invoice {invoice_id}: {e}")
+
+
+def prerender_invoice_pdfs(app, invoice_ids: list):
+    """
+    Queue committed, fiscalized invoices for PDF rendering when ZIMRA_PDF_PRERENDER=true.
+
+    Parameters:
+        app: Flask application (the worker runs in its own app context)
+        invoice_ids (list): Invoice numbers to render
+    """
+    if PDF_PRERENDER_ENABLED and invoice_ids:
+        _prerender_executor.submit(_prerender, app, list(invoice_ids))
@@ -0,0 +1,193 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from invoice_template import generate_invoice_pdf_a4_format
+
+
+class PdfRenderQueueFull(Exception):
+    """Raised when every render slot is taken and none frees up in time"""
+
+
+class PdfRenderTimeout(Exception):
+    """Raised when a PDF takes longer than the render timeout"""
+
+
+def render_pdf_bytes(invoice_data: dict) -> bytes:
+    """Render an invoice dict (see utils.invoice_detail.invoice_pdf_data) with the A4 template"""
+    return generate_invoice_pdf_a4_format(invoice_data).getvalue()
+
+
+class PdfRenderService:
+    """
+    Renders invoice PDFs in a pool of worker processes.
+
+    ReportLab holds the GIL while it lays out a document, so rendering on the request
+    threads stalls every other request of the process. Workers take the plain invoice
+    dict and return PDF bytes. At most max_pending renders are queued or running; a
+    caller that cannot get a slot within queue_timeout gets PdfRenderQueueFull.
+
+    With workers=0 PDFs are rendered on the calling thread (no pool).
+    """
+
+    def __init__(self, workers: int = 2, max_pending: int = 32, queue_timeout: float = 5.0,
+                 render_timeout: float = 60.0):
+        """
+        Initialize the service.
+
+        Args:
+            workers (int): Worker processes (0 renders in-process)
+            max_pending (int): Renders queued or running at once
+            queue_timeout (float): Seconds to wait for a free slot
+            render_timeout (float): Seconds to wait for a PDF once queued
+        """
+        self.workers = max(0, int(workers))
+        self.max_pending = max(1, int(max_pending))
+        self.queue_timeout = queue_timeout
+        self.render_timeout = render_timeout
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._rendered = 0
+        self._rejected = 0
+        self._timed_out = 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        """Create the worker pool on first use"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def _reset_executor(self):
+        """Drop a pool whose worker died, so the next render starts a new one"""
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def submit(self, invoice_data: dict):
+        """
+        Queue a render and return its future.
+
+        Raises:
+            PdfRenderQueueFull: If no slot frees up within queue_timeout
+        """
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            with self._lock:
+                self._rejected += 1
+            raise PdfRenderQueueFull(f"{self.max_pending} PDF renders already pending")
+
+        try:
+            try:
+                future = self._get_executor().submit(render_pdf_bytes, invoice_data)
+            except BrokenProcessPool:
+                self._reset_executor()
+                future = self._get_executor().submit(render_pdf_bytes, invoice_data)
+        except Exception:
+            self._slots.release()
+            raise
+        # The slot is held until the worker finishes, even if the caller stops waiting
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def _result(self, future, timeout: float) -> bytes:
+        """Wait for a queued render"""
+        try:
+            pdf_bytes = future.result(timeout=timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            with self._lock:
+                self._timed_out += 1
+            raise PdfRenderTimeout(f"PDF rendering took longer than {timeout} seconds")
+        except BrokenProcessPool:
+            self._reset_executor()
+            raise
+        with self._lock:
+            self._rendered += 1
+        return pdf_bytes
+
+    def render(self, invoice_data: dict, timeout: float = None) -> bytes:
+        """
+        Render one invoice PDF.
+
+        Parameters:
+            invoice_data (dict): Invoice dict for the A4 template
+            timeout (float): Seconds to wait for the PDF (default render_timeout)
+
+        Returns:
+            bytes: The PDF
+
+        Raises:
+            PdfRenderQueueFull: If the render queue stays full
+            PdfRenderTimeout: If the PDF is not ready in time
+        """
+        if self.workers == 0:
+            return render_pdf_bytes(invoice_data)
+        return self._result(self.submit(invoice_data), timeout or self.render_timeout)
+
+    def render_many(self, invoice_datas: list, timeout: float = None):
+        """
+        Render several PDFs, yielding them in input order.
+
+        Keeps at most one render per worker in flight, so a bulk job leaves the rest
+        of the queue to single downloads. The timeout applies to each PDF.
+        """
+        if self.workers == 0:
+            for invoice_data in invoice_datas:
+                yield render_pdf_bytes(invoice_data)
+            return
+
+        timeout = timeout or self.render_timeout
+        pending = []
+        try:
+            for invoice_data in invoice_datas:
+                if len(pending) >= self.workers:
+                    yield self._result(pending.pop(0), timeout)
+                pending.append(self.submit(invoice_data))
+            while pending:
+                yield self._result(pending.pop(0), timeout)
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def stats(self) -> dict:
+        """Get render counters"""
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'rendered': self._rendered,
+                'rejected': self._rejected,
+                'timed_out': self._timed_out
+            }
+
+    def close(self):
+        """Shut the worker pool down"""
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+
+# Global render service shared by downloads, pre-rendering and bulk exports
+pdf_render_service = PdfRenderService(
+    workers=int(os.environ.get('ZIMRA_PDF_RENDER_WORKERS', str(min(4, max(1, (os.cpu_count() or 2) // 2))))),
+    max_pending=int(os.environ.get('ZIMRA_PDF_RENDER_QUEUE', '32')),
+    queue_timeout=float(os.environ.get('ZIMRA_PDF_RENDER_QUEUE_TIMEOUT', '5')),
+    render_timeout=float(os.environ.get('ZIMRA_PDF_RENDER_TIMEOUT', '60'))
+)
+
+
+def merge_pdfs(pdfs) -> bytes:
+    """Concatenate PDFs (an iterable of bytes) into one document with PyMuPDF"""
+    import fitz
+
+    merged = fitz.open()
+    try:
+        for pdf_bytes in pdfs:
+            with fitz.open(stream=pdf_bytes, filetype='pdf') as document:
+                merged.insert_pdf(document)
+        return merged.tobytes(garbage=1, deflate=True)
+    finally:
+        merged.close()
@@ -0,0 +1,176 @@
+import hashlib
+import io
+import logging
+import os
+import threading
+from collections import OrderedDict
+import qrcode
+import qrcode.image.svg
+
+
+logger = logging.getLogger(__name__)
+
+# Pixels per QR module in PNGs: 5 keeps a 1 inch print above 200 dpi at a quarter
+# of the pixels (and encode time) of the previous box_size=10
+QR_PNG_BOX_SIZE = int(os.environ.get('ZIMRA_QR_BOX_SIZE', '5'))
+QR_BORDER = 5
+
+FORMATS = {'png': 'image/png', 'svg': 'image/svg+xml'}
+
+
+def _build_qr(data: str) -> qrcode.QRCode:
+    """Encode a QR string once; both image formats are drawn from the same matrix"""
+    qr = qrcode.QRCode(version=1, box_size=QR_PNG_BOX_SIZE, border=QR_BORDER)
+    qr.add_data(data)
+    qr.make(fit=True)
+    return qr
+
+
+def render_qr_png(data: str) -> bytes:
+    """Render a QR code as PNG bytes (uses PIL)"""
+    img = _build_qr(data).make_image(fill_color="black", back_color="white")
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def render_qr_svg(data: str) -> bytes:
+    """Render a QR code as a single-path SVG (no PIL involved)"""
+    img = _build_qr(data).make_image(image_factory=qrcode.image.svg.SvgPathImage)
+    return img.to_string()
+
+
+RENDERERS = {'png': render_qr_png, 'svg': render_qr_svg}
+
+
+class QrImageCache:
+    """
+    Bounded LRU of rendered QR images keyed by format and QR string, with an
+    optional disk tier that survives restarts and is shared between worker processes.
+
+    A receipt's QR string never changes, so entries never go stale.
+    """
+
+    def __init__(self, max_entries: int = 2048, directory: str = None):
+        """
+        Initialize the cache.
+
+        Args:
+            max_entries (int): Images kept in memory before the least recently used one is evicted
+            directory (str): Disk tier directory, or None for memory only
+        """
+        self.max_entries = max(1, int(max_entries))
+        self.directory = directory or None
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def digest(data: str) -> str:
+        """Stable identifier of a QR string (file name on disk and ETag base)"""
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def _path(self, image_format: str, digest: str) -> str:
+        """File path of a disk tier entry"""
+        return os.path.join(self.directory, digest[:2], f"{digest}.{image_format}")
+
+    def _remember(self, key: tuple, image: bytes):
+        """Add an image to the memory tier, evicting the least recently used ones"""
+        with self._lock:
+            self._entries[key] = image
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _read_disk(self, image_format: str, digest: str) -> bytes:
+        """Read an image from the disk tier, or None"""
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(image_format, digest), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write_disk(self, image_format: str, digest: str, image: bytes):
+        """Write an image to the disk tier through a temporary file"""
+        if not self.directory:
+            return
+        path = self._path(image_format, digest)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(image)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not write QR image to {path}: {e}")
+
+    def get(self, data: str, image_format: str = 'png') -> bytes:
+        """
+        Get a QR image, rendering and caching it on a miss.
+
+        Parameters:
+            data (str): QR string (the receipt's verification URL)
+            image_format (str): 'png' or 'svg'
+
+        Returns:
+            bytes: PNG or SVG bytes
+        """
+        key = (image_format, data)
+        with self._lock:
+            image = self._entries.get(key)
+            if image is not None:
+                self._hits += 1
+                self._entries.move_to_end(key)
+                return image
+
+        digest = self.digest(data)
+        image = self._read_disk(image_format, digest)
+        if image is not None:
+            with self._lock:
+                self._disk_hits += 1
+        else:
+            with self._lock:
+                self._misses += 1
+            image = RENDERERS[image_format](data)
+            self._write_disk(image_format, digest, image)
+
+        self._remember(key, image)
+        return image
+
+    def clear(self):
+        """Forget every image held in memory (the disk tier is left alone)"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Get cache hit/miss counters"""
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'disk_hits': self._disk_hits,
+                'misses': self._misses,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'directory': self.directory
+            }
+
+
+# Global QR image cache shared by the HTML, PDF and image endpoints
+qr_image_cache = QrImageCache(
+    max_entries=int(os.environ.get('ZIMRA_QR_CACHE_SIZE', '2048')),
+    directory=os.environ.get('ZIMRA_QR_CACHE_DIR')
+)
+
+
+def get_qr_png(data: str) -> bytes:
+    """Get a cached PNG of a QR string"""
+    return qr_image_cache.get(data, 'png')
+
+
+def get_qr_svg(data: str) -> str:
+    """Get a cached SVG of a QR string, as markup for inlining into HTML"""
+    return qr_image_cache.get(data, 'svg').decode('utf-8')
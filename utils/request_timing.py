@@ -0,0 +1,207 @@
+import cProfile
+import io
+import logging
+import math
+import os
+import pstats
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from flask import Response, current_app, g, has_request_context, request
+
+
+logger = logging.getLogger(__name__)
+
+# ?profile=1 is honoured in debug mode, or everywhere when this is true
+PROFILING_ENABLED = os.environ.get('ZIMRA_PROFILING_ENABLED', 'false').lower() == 'true'
+
+# Functions listed in a cProfile report, by cumulative time
+PROFILE_TOP_FUNCTIONS = int(os.environ.get('ZIMRA_PROFILE_TOP', '60'))
+
+# Name of the whole-request duration in Server-Timing and the stats
+TOTAL_PHASE = 'total'
+
+
+def _percentile(ordered: list, fraction: float) -> float:
+    """Nearest-rank percentile of an ascending list"""
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+class RequestTimings:
+    """
+    Rolling request and phase durations per endpoint.
+
+    Each (endpoint, phase) keeps its last `window` durations in a bounded deque;
+    percentiles are computed from that window when stats are read, so recording
+    a request costs an append under the lock.
+    """
+
+    def __init__(self, window: int = 1024):
+        """
+        Initialize the timings.
+
+        Args:
+            window (int): Durations kept per endpoint and phase
+        """
+        self.window = max(1, int(window))
+        self._lock = threading.Lock()
+        self._samples = defaultdict(lambda: deque(maxlen=self.window))
+        self._counts = defaultdict(int)
+
+    def record(self, endpoint: str, phases: dict):
+        """
+        Record one request.
+
+        Args:
+            endpoint (str): Flask endpoint name
+            phases (dict): Phase name -> duration in milliseconds, including TOTAL_PHASE
+        """
+        with self._lock:
+            for phase, duration in phases.items():
+                key = (endpoint, phase)
+                self._samples[key].append(duration)
+                self._counts[key] += 1
+
+    def clear(self):
+        """Drop every recorded duration"""
+        with self._lock:
+            self._samples.clear()
+            self._counts.clear()
+
+    def stats(self) -> dict:
+        """Get p50/p95/p99 (ms) over the rolling window, per endpoint and phase"""
+        with self._lock:
+            snapshot = {key: (sorted(samples), self._counts[key]) for key, samples in self._samples.items()}
+
+        endpoints = {}
+        for (endpoint, phase), (ordered, count) in sorted(snapshot.items()):
+            endpoints.setdefault(endpoint, {})[phase] = {
+                'count': count,
+                'window': len(ordered),
+                'mean_ms': round(sum(ordered) / len(ordered), 3),
+                'p50_ms': round(_percentile(ordered, 0.50), 3),
+                'p95_ms': round(_percentile(ordered, 0.95), 3),
+                'p99_ms': round(_percentile(ordered, 0.99), 3),
+                'max_ms': round(ordered[-1], 3)
+            }
+        return {
+            'window': self.window,
+            'profiling_enabled': PROFILING_ENABLED,
+            'endpoints': endpoints
+        }
+
+
+# Global request timings shared by all request threads
+request_timings = RequestTimings(window=int(os.environ.get('ZIMRA_TIMING_WINDOW', '1024')))
+
+
+@contextmanager
+def timing_span(phase: str):
+    """
+    Time a phase of the current request handler.
+
+    The duration is added to the request's Server-Timing header and the endpoint's
+    phase stats; a phase entered several times is summed. Outside a request (or a
+    blueprint without init_request_timing) the block just runs.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if has_request_context():
+            spans = g.get('timing_spans')
+            if spans is not None:
+                spans[phase] = spans.get(phase, 0.0) + (time.perf_counter() - start) * 1000
+
+
+def _profiling_allowed() -> bool:
+    """?profile is only honoured in debug mode or with ZIMRA_PROFILING_ENABLED=true"""
+    return PROFILING_ENABLED or current_app.debug
+
+
+def _start_profiler(mode: str):
+    """Start a pyinstrument (if asked for and installed) or cProfile profiler"""
+    if mode == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            logger.debug("pyinstrument is not installed, profiling with cProfile")
+        else:
+            profiler = Profiler()
+            profiler.start()
+            return 'pyinstrument', profiler
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return 'cprofile', profiler
+
+
+def _stop_profiler():
+    """Stop the request's profiler, if any, and return (kind, profiler)"""
+    profile = g.pop('timing_profiler', None)
+    if profile is None:
+        return None
+    kind, profiler = profile
+    if kind == 'pyinstrument':
+        profiler.stop()
+    else:
+        profiler.disable()
+    return profile
+
+
+def _profile_report(kind: str, profiler) -> str:
+    """Render a stopped profiler as text"""
+    if kind == 'pyinstrument':
+        return profiler.output_text(unicode=True, color=False)
+    output = io.StringIO()
+    stats = pstats.Stats(profiler, stream=output)
+    stats.strip_dirs().sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+    return output.getvalue()
+
+
+def _server_timing_header(phases: dict) -> str:
+    """Format phase durations as a Server-Timing header value"""
+    return ', '.join(f"{phase};dur={duration:.2f}" for phase, duration in phases.items())
+
+
+def _before_request():
+    """Start the request clock, and the profiler for an allowed ?profile request"""
+    g.timing_spans = {}
+    g.timing_start = time.perf_counter()
+
+    mode = request.args.get('profile')
+    if mode and mode.lower() not in ('0', 'false') and _profiling_allowed():
+        g.timing_profiler = _start_profiler(mode.lower())
+
+
+def _after_request(response):
+    """Record the request's phases, set Server-Timing, and swap in the profile report if profiled"""
+    start = g.get('timing_start')
+    if start is None:
+        return response
+
+    phases = dict(g.get('timing_spans') or {})
+    phases[TOTAL_PHASE] = (time.perf_counter() - start) * 1000
+    request_timings.record(request.endpoint or request.path, phases)
+
+    profile = _stop_profiler()
+    if profile is not None:
+        response = Response(_profile_report(*profile), mimetype='text/plain',
+                            headers={'X-Profiled-Status': str(response.status_code),
+                                     'X-Profiler': profile[0]})
+
+    response.headers['Server-Timing'] = _server_timing_header(phases)
+    return response
+
+
+def _teardown_request(exc):
+    """Make sure a profiler never outlives its request (after_request is skipped on errors)"""
+    _stop_profiler()
+
+
+def init_request_timing(blueprint):
+    """Time every request of a blueprint, with Server-Timing headers and ?profile support"""
+    blueprint.before_request(_before_request)
+    blueprint.after_request(_after_request)
+    blueprint.teardown_request(_teardown_request)
@@ -0,0 +1,136 @@
+import gzip
+import hashlib
+import os
+import threading
+from email.utils import formatdate
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+from flask import Response, current_app, has_app_context
+
+try:
+    import brotli  # Optional: pages are also pre-compressed with brotli when installed
+except ImportError:
+    brotli = None
+
+
+class StaticPage:
+    """An HTML page held in memory with its pre-compressed variants and validators"""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self.body = f.read()
+        self.mtime = os.path.getmtime(path)
+        self.etag = hashlib.sha256(self.body).hexdigest()[:32]
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+        self.encoded = {'gzip': gzip.compress(self.body, compresslevel=9)}
+        if brotli is not None:
+            self.encoded['br'] = brotli.compress(self.body)
+
+
+class TemplateRegistry:
+    """
+    Compiled Jinja templates and in-memory static pages served from one directory.
+
+    Templates are compiled once per process (and their bytecode is cached on disk
+    for the next process); pages are read and compressed once. Neither touches
+    the disk again unless auto_reload is on or the current app runs in debug mode
+    (checked at lookup time, since app.run(debug=True) turns debug on after create_app).
+    """
+
+    def __init__(self, directory: str = 'static', bytecode_cache_dir: str = None, auto_reload: bool = False):
+        """
+        Initialize the registry.
+
+        Args:
+            directory (str): Directory holding the templates and pages
+            bytecode_cache_dir (str): Jinja bytecode cache directory (default: a per-user temp directory)
+            auto_reload (bool): Always re-read templates and pages when their files change
+        """
+        self.directory = os.path.abspath(directory)
+        self.environment = Environment(
+            loader=FileSystemLoader(self.directory),
+            bytecode_cache=FileSystemBytecodeCache(bytecode_cache_dir) if bytecode_cache_dir else FileSystemBytecodeCache(),
+            auto_reload=auto_reload
+        )
+        self.auto_reload = auto_reload
+        self._lock = threading.Lock()
+        self._pages = {}
+
+    def init_app(self, app):
+        """Register the registry with the app; reloading follows app.debug at lookup time"""
+        app.extensions['template_registry'] = self
+
+    def _reloading(self) -> bool:
+        """Re-read changed files when auto_reload is on or the current app runs in debug mode"""
+        return self.auto_reload or (has_app_context() and current_app.debug)
+
+    def render(self, name: str, **context) -> str:
+        """Render a template, compiling it on first use"""
+        self.environment.auto_reload = self._reloading()
+        return self.environment.get_template(name).render(**context)
+
+    def get_page(self, name: str) -> StaticPage:
+        """
+        Get a static page, reading it on first use.
+
+        Raises:
+            FileNotFoundError: If the page does not exist
+        """
+        path = os.path.join(self.directory, name)
+        reloading = self._reloading()
+        page = self._pages.get(name)
+        if page is not None and not (reloading and os.path.getmtime(path) != page.mtime):
+            return page
+
+        with self._lock:
+            page = self._pages.get(name)
+            if page is None or (reloading and os.path.getmtime(path) != page.mtime):
+                page = StaticPage(path)
+                self._pages[name] = page
+            return page
+
+    def page_response(self, name: str, request) -> Response:
+        """
+        Serve a static page from memory.
+
+        Answers If-None-Match / If-Modified-Since with 304 and sends the brotli or gzip
+        variant when the client accepts it.
+
+        Raises:
+            FileNotFoundError: If the page does not exist
+        """
+        page = self.get_page(name)
+        headers = {
+            'ETag': f'"{page.etag}"',
+            'Last-Modified': page.last_modified,
+            'Cache-Control': 'no-cache',
+            'Vary': 'Accept-Encoding'
+        }
+
+        if request.if_none_match:
+            not_modified = page.etag in request.if_none_match
+        else:
+            not_modified = (request.if_modified_since is not None
+                            and request.if_modified_since.timestamp() >= int(page.mtime))
+        if not_modified:
+            return Response(status=304, headers=headers)
+
+        body = page.body
+        for encoding in ('br', 'gzip'):
+            if encoding in page.encoded and request.accept_encodings[encoding]:
+                body = page.encoded[encoding]
+                headers['Content-Encoding'] = encoding
+                break
+        return Response(body, mimetype='text/html', headers=headers)
+
+    def clear(self):
+        """Drop the compiled templates and the pages held in memory"""
+        with self._lock:
+            self._pages.clear()
+            self.environment.cache.clear()
+
+
+# Global registry for the HTML pages and templates in static/
+template_registry = TemplateRegistry(
+    directory=os.environ.get('ZIMRA_TEMPLATE_DIR', 'static'),
+    bytecode_cache_dir=os.environ.get('ZIMRA_TEMPLATE_CACHE_DIR')
+)
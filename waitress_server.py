@@ -42,7 +42,11 @@ def run_waitress_server(host='0.0.0.0', port=5000, threads=4):
         threads (int): Number of threads (default: 4)
     """
     app = create_waitress_app()
-    
+
+    # Deliver receipts left in the fiscalization outbox by a previous run
+    from utils.fiscalization_outbox import outbox_dispatcher
+    outbox_dispatcher.start()
+
     logger.info(f"Starting Waitress server on {host}:{port}")
     logger.info(f"Server configuration: threads={threads}")
     